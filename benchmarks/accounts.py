@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# One server for many accounts: clients log in to random accounts with LOGIN
+# and CRAM-MD5 and ask the fake upstream who it thinks they are. The login
+# time with one account configured and with many has to stay the same, and
+# wrong passwords and unknown users are turned away. LOGIN arguments come as
+# atoms, quoted strings and literals.
+#
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import random
+import sys
+import time
+
+from typing import Any, Dict, List
+
+import common
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.config
+import oauth2imap.oauth2 as oauth2
+
+
+def accounts_config(count: int) -> Dict[str, Any]:
+    return {
+        f"acct{num}": {
+            "upstream": {"username": f"user{num}@example.com"},
+            "downstream": {"username": f"login{num}", "password": f"secret{num}"},
+        }
+        for num in range(count)
+    }
+
+
+def write_tokens(env: common.Environment) -> None:
+    for account in oauth2imap.config.accounts(env.config).values():  # type: ignore[union-attr]
+        provider = oauth2.get_upstream_provider(account)
+        assert provider
+        oauth2.write_token(account, provider, oauth2.Token({
+            "access_token": "bench-access-token",
+            "access_token_expiration": "2999-01-01T00:00:00",
+            "refresh_token": "bench-refresh-token",
+        }))
+
+
+async def cram_md5(client: common.Client, username: str, password: str) -> bytes:
+    client.tagnum += 1
+    tag = f"B{client.tagnum}".encode()
+
+    client.writer.write(tag + b" AUTHENTICATE CRAM-MD5\r\n")
+    await client.writer.drain()
+
+    challenge = base64.b64decode((await client.reader.readline())[2:].strip())
+    digest = hmac.new(password.encode(), challenge, hashlib.md5).hexdigest()
+    client.writer.write(base64.b64encode(f"{username} {digest}".encode()) + b"\r\n")
+    await client.writer.drain()
+
+    while True:
+        line = await client.reader.readline()
+        if not line or line.startswith(tag + b" "):
+            return line
+
+
+async def login_literal(client: common.Client, username: str, password: str) -> bytes:
+    client.tagnum += 1
+    tag = f"B{client.tagnum}".encode()
+
+    client.writer.write(tag + f" LOGIN {{{len(username)}}}\r\n".encode())
+    await client.writer.drain()
+    if not (await client.reader.readline()).startswith(b"+"):
+        raise ConnectionError("no continuation for the user name literal")
+
+    client.writer.write(username.encode() + f" {{{len(password)}+}}\r\n".encode() +
+                        password.encode() + b"\r\n")
+    await client.writer.drain()
+
+    while True:
+        line = await client.reader.readline()
+        if not line or line.startswith(tag + b" "):
+            return line
+
+
+async def whoami(client: common.Client) -> str:
+    client.tagnum += 1
+    tag = f"B{client.tagnum} ".encode()
+
+    client.writer.write(tag + b"ID NIL\r\n")
+    await client.writer.drain()
+
+    user = ""
+    while True:
+        line = await client.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line.startswith(b"* ID "):
+            user = line.split(b'"user" "', 1)[1].split(b'"', 1)[0].decode()
+        if line.startswith(tag):
+            return user
+
+
+async def drive(env: common.Environment, args: argparse.Namespace, accounts: int) -> List[float]:
+    times: List[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(num: int) -> None:
+        async with semaphore:
+            client = await common.Client.connect(env.downstream_port)
+
+            start = time.monotonic()
+            if accounts == 1:
+                status = await client.command(f"LOGIN {common.DOWNSTREAM_USER} {common.DOWNSTREAM_PASSWORD}")
+                expected = "user@example.com"
+            elif num % 4 == 1:
+                status = await client.command(f"LOGIN login{num % accounts} secret{num % accounts}")
+                expected = f"user{num % accounts}@example.com"
+            elif num % 4 == 3:
+                status = await client.command(f'LOGIN "login{num % accounts}" "secret{num % accounts}"')
+                expected = f"user{num % accounts}@example.com"
+            else:
+                status = await cram_md5(client, f"login{num % accounts}", f"secret{num % accounts}")
+                expected = f"user{num % accounts}@example.com"
+            times.append(time.monotonic() - start)
+
+            if b" OK " not in status:
+                raise ConnectionError(f"login failed: {status!r}")
+
+            user = await whoami(client)
+            if user != expected:
+                raise ValueError(f"logged in to {user!r} instead of {expected!r}")
+
+            await client.logout()
+            await client.close()
+
+    await asyncio.gather(*[one(num) for num in range(args.connections)])
+
+    if accounts > 1:
+        client = await common.Client.connect(env.downstream_port)
+        status = await login_literal(client, "login1", "secret1")
+        if b" OK " not in status or await whoami(client) != "user1@example.com":
+            raise ValueError(f"LOGIN with literals failed: {status!r}")
+        await client.close()
+
+        for login in ("LOGIN login1 secret2", "LOGIN nobody secret1", 'LOGIN "login1" "secret2"'):
+            client = await common.Client.connect(env.downstream_port)
+            status = await client.command(login)
+            if b" NO " not in status:
+                raise ValueError(f"{login!r} was not refused: {status!r}")
+            await client.close()
+
+        client = await common.Client.connect(env.downstream_port)
+        status = await cram_md5(client, "login1", "secret2")
+        if b" NO " not in status:
+            raise ValueError(f"CRAM-MD5 with a wrong password was not refused: {status!r}")
+        await client.close()
+
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="logins to many accounts of one server")
+    parser.add_argument("--accounts", type=int, default=500)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--engine", default="asyncio")
+    args = parser.parse_args()
+
+    print(f"{'accounts':>8} {'login p50 ms':>13} {'login p99 ms':>13}")
+
+    for accounts in (1, args.accounts):
+        with common.Environment(messages=10) as env:
+            if accounts > 1:
+                del env.config["downstream"]["username"], env.config["downstream"]["password"]
+                env.config["accounts"] = accounts_config(accounts)
+                env.write_config()
+                write_tokens(env)
+
+            env.start_upstream()
+            env.start_server("--engine", args.engine)
+
+            times = asyncio.run(drive(env, args, accounts))
+
+        print(f"{accounts:>8} {common.percentile(times, 50) * 1000:>13.2f} "
+              f"{common.percentile(times, 99) * 1000:>13.2f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
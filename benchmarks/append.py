@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Throughput of APPEND with large messages through the proxy compared to
+# appending them to the fake upstream directly, with synchronizing and
+# non-synchronizing (LITERAL+) literals.
+#
+
+import argparse
+import asyncio
+import threading
+import time
+
+from typing import Tuple
+
+import common
+
+
+async def append_all(port: int, messages: int, size: int, sync: bool,
+                     direct: Tuple[str, ...] = ()) -> float:
+    message = (b"x" * 78 + b"\r\n") * (size // 80)
+
+    client = await common.Client.connect(port, *direct)
+    try:
+        await client.login()
+
+        start = time.monotonic()
+        for _ in range(messages):
+            status = await client.append("INBOX", message, sync)
+            if b" OK " not in status:
+                raise ConnectionError(f"append failed: {status!r}")
+        elapsed = time.monotonic() - start
+
+        # The session must still be usable after the literals.
+        status = await client.command("NOOP")
+        if b" OK " not in status:
+            raise ConnectionError(f"noop failed: {status!r}")
+
+        await client.logout()
+    finally:
+        await client.close()
+
+    return messages * len(message) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="APPEND throughput")
+    parser.add_argument("--messages", type=int, default=8)
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024, help="message size in bytes.")
+    parser.add_argument("--engine", default="asyncio")
+    args = parser.parse_args()
+
+    with common.Environment(messages=1, size=1024) as env:
+        env.start_upstream()
+        server = env.start_server("--engine", args.engine)
+
+        for sync in (True, False):
+            kind = "sync" if sync else "LITERAL+"
+
+            rate = asyncio.run(append_all(env.upstream_port, args.messages, args.size, sync,
+                                          (env.cert,)))
+            print(f"{'direct':<8} {kind:<10} {rate / 2**20:>9.1f} MiB/s")
+
+            peak = common.rss_kb(server.pid)
+            done = threading.Event()
+
+            def sample() -> None:
+                nonlocal peak
+                while not done.wait(0.05):
+                    peak = max(peak, common.rss_kb(server.pid))
+
+            sampler = threading.Thread(target=sample)
+            sampler.start()
+            try:
+                rate = asyncio.run(append_all(env.downstream_port, args.messages, args.size, sync))
+            finally:
+                done.set()
+                sampler.join()
+
+            print(f"{'proxy':<8} {kind:<10} {rate / 2**20:>9.1f} MiB/s  (peak RSS {peak / 1024:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Fetch the same large messages by UID twice through the server with the body
+# cache on: the first pass fills the cache from the upstream server, the
+# second is served from it. The responses of both passes must be the same.
+# Then the upstream server comes back with another UIDVALIDITY, which has to
+# empty the cache.
+#
+
+import argparse
+import asyncio
+import glob
+import os.path
+import sys
+import time
+
+from typing import Dict, List, Tuple
+
+import common
+
+
+async def fetch_all(env: common.Environment, args: argparse.Namespace,
+                    item: str) -> Tuple[float, Dict[int, bytes]]:
+    client = await common.Client.connect(env.downstream_port)
+    await client.login()
+    await client.command("SELECT INBOX")
+
+    responses: Dict[int, bytes] = {}
+    received = 0
+
+    start = time.monotonic()
+    for uid in range(1, args.messages + 1):
+        client.writer.write(f"U{uid} UID FETCH {uid} ({item})\r\n".encode())
+        await client.writer.drain()
+
+        parts: List[bytes] = []
+        while True:
+            line = await client.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            parts.append(line)
+
+            if line.endswith(b"}\r\n"):
+                size = int(line[line.rindex(b"{") + 1:-3])
+                parts.append(await client.reader.readexactly(size))
+
+            if line.startswith(f"U{uid} ".encode()):
+                break
+
+        responses[uid] = b"".join(parts[:-1])
+        received += sum(len(part) for part in parts)
+    elapsed = time.monotonic() - start
+
+    await client.logout()
+    await client.close()
+
+    return received / elapsed / 2**20, responses
+
+
+def bodies(env: common.Environment) -> int:
+    return len(glob.glob(os.path.join(env.home, "cache", "??", "*")))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="full message fetches with the body cache")
+    parser.add_argument("--messages", type=int, default=8)
+    parser.add_argument("--size", type=int, default=4 * 2**20, help="size of each message.")
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency (ms).")
+    parser.add_argument("--engine", default="fork")
+    args = parser.parse_args()
+
+    with common.Environment(messages=args.messages, size=args.size, latency=args.latency,
+                            config={"body-cache": {"dir": "~/cache"}}) as env:
+        env.start_upstream()
+        env.start_server("--engine", args.engine)
+
+        cold, first = asyncio.run(fetch_all(env, args, "BODY.PEEK[]"))
+        warm, second = asyncio.run(fetch_all(env, args, "BODY.PEEK[]"))
+        seen, third = asyncio.run(fetch_all(env, args, "UID FLAGS BODY[]"))
+
+        print(f"{'upstream':<10} {cold:>8.1f} MiB/s")
+        print(f"{'cache':<10} {warm:>8.1f} MiB/s")
+        print(f"{'cache+seen':<10} {seen:>8.1f} MiB/s")
+
+        # The fake server adds FLAGS and RFC822.SIZE to any other FETCH.
+        for uid, response in list(second.items()) + list(third.items()):
+            if response.split(b"}\r\n", 1)[1] != first[uid].split(b"}\r\n", 1)[1]:
+                print(f"BODY[] of {uid} from the cache differs: {response[:80]!r}", file=sys.stderr)
+                return 1
+
+        cached = bodies(env)
+        if cached != args.messages:
+            print(f"{cached} bodies cached instead of {args.messages}", file=sys.stderr)
+            return 1
+
+        # The same messages in a mailbox recreated on the server.
+        upstream = env.procs.pop(0)
+        upstream.terminate()
+        upstream.wait()
+        env.fakeimap_args += ["--uidvalidity", "2"]
+        env.start_upstream()
+
+        asyncio.run(fetch_all(env, args, "FLAGS"))
+        print(f"bodies cached: {cached} before UIDVALIDITY changed, {bodies(env)} after")
+
+        if bodies(env):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Helpers shared by the benchmarks: a throw-away environment with a
+# self-signed certificate, a fake upstream, a fake token endpoint and an
+# oauth2imap process.
+#
+
+import asyncio
+import json
+import os
+import os.path
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.oauth2 as oauth2
+
+import faketoken
+
+DOWNSTREAM_USER = "bench"
+DOWNSTREAM_PASSWORD = "secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def wait_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"port {port} did not open")
+
+
+def rss_kb(pid: int) -> int:
+    """Resident memory of the process and all its descendants."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="utf-8") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, []))
+        try:
+            with open(f"/proc/{p}/status", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+class Environment:
+    """Temporary HOME with a config pointing at a fake upstream."""
+
+    def __init__(self, messages: int = 100, size: int = 16384, latency: float = 0,
+                 config: Dict[str, Any] | None = None, sizes: List[int] | None = None,
+                 token_delay: float = 0, expired: bool = False):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="oauth2imap-bench-")
+        self.home = self.tmpdir.name
+        self.upstream_port = free_port()
+        self.downstream_port = free_port()
+        self.procs: List[subprocess.Popen[bytes]] = []
+
+        # Nothing ever reaches a real token endpoint.
+        self.token = faketoken.TokenServer(0, delay=token_delay).start()
+
+        self.cert = os.path.join(self.home, "cert.pem")
+        self.key = os.path.join(self.home, "key.pem")
+
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                        "-days", "1", "-subj", "/CN=localhost",
+                        "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+                        "-keyout", self.key, "-out", self.cert],
+                       check=True, capture_output=True)
+
+        self.config: Dict[str, Dict[str, Any]] = {
+            "upstream": {
+                "provider": "microsoft",
+                "imap-endpoint": "localhost",
+                "imap-port": self.upstream_port,
+                "client-id": "bench-client",
+                "username": "user@example.com",
+                "tokens-file": os.path.join(self.home, "tokens"),
+                "token-endpoint": self.token.url,
+            },
+            "downstream": {
+                "server": "127.0.0.1",
+                "port": self.downstream_port,
+                "username": DOWNSTREAM_USER,
+                "password": DOWNSTREAM_PASSWORD,
+            },
+        }
+        for section, values in (config or {}).items():
+            self.config.setdefault(section, {}).update(values)
+
+        self.write_config()
+        # An expired token makes the first session wait for a refresh.
+        self.write_tokens(timedelta(days=-1) if expired else timedelta(days=1))
+
+        self.fakeimap_args = ["--messages", str(messages), "--size", str(size),
+                              "--latency", str(latency)]
+        if sizes:
+            self.fakeimap_args += ["--sizes", ",".join(str(n) for n in sizes)]
+
+    def write_config(self) -> None:
+        def write(f: Any, name: str, values: Dict[str, Any]) -> None:
+            f.write(f"[{name}]\n")
+            for key, value in values.items():
+                if not isinstance(value, dict):
+                    f.write(f"{key} = {json.dumps(value)}\n")
+            f.write("\n")
+            # Nested tables, like those of the accounts, come after the keys.
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    write(f, f"{name}.{key}", value)
+
+        with open(os.path.join(self.home, ".oauth2imaprc"), "w", encoding="utf-8") as f:
+            for section, values in self.config.items():
+                write(f, section, values)
+
+    def write_tokens(self, expires: timedelta = timedelta(days=1)) -> None:
+        provider = oauth2.get_upstream_provider(self.config)
+        assert provider
+        oauth2.write_token(self.config, provider, oauth2.Token({
+            "access_token": "bench-access-token",
+            "access_token_expiration": (datetime.now() + expires).isoformat(),
+            "refresh_token": "bench-refresh-token",
+        }))
+
+    def env(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["HOME"] = self.home
+        env["SSL_CERT_FILE"] = self.cert
+        env["PYTHONPATH"] = TOPDIR
+        return env
+
+    def spawn(self, args: List[str], **kwargs: Any) -> "subprocess.Popen[bytes]":
+        proc = subprocess.Popen(args, env=self.env(), **kwargs)
+        self.procs.append(proc)
+        return proc
+
+    def start_upstream(self) -> None:
+        self.spawn([sys.executable, os.path.join(TOPDIR, "benchmarks", "fakeimap.py"),
+                    "--port", str(self.upstream_port),
+                    "--cert", self.cert, "--key", self.key] + self.fakeimap_args)
+        wait_port(self.upstream_port)
+
+    def start_server(self, *args: str) -> "subprocess.Popen[bytes]":
+        proc = self.spawn([sys.executable, "-m", "oauth2imap.command", "server", *args])
+        wait_port(self.downstream_port)
+        return proc
+
+    async def start_tunnel(self, *args: str) -> "Client":
+        # A tunnel process per client, talking IMAP over its stdin and stdout.
+        proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "oauth2imap.command", "tunnel", *args,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env(),
+                limit=2**24)
+        assert proc.stdin and proc.stdout
+
+        client = Client(proc.stdout, proc.stdin, proc)
+        await client.greeting()
+        return client
+
+    def stop(self) -> None:
+        self.token.shutdown()
+        self.token.server_close()
+
+        for proc in reversed(self.procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.procs = []
+        self.tmpdir.cleanup()
+
+    def __enter__(self) -> "Environment":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.stop()
+
+
+class Client:
+    """A scripted downstream client speaking just enough IMAP."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 proc: "asyncio.subprocess.Process | None" = None):
+        self.reader = reader
+        self.writer = writer
+        self.proc = proc
+        self.tagnum = 0
+        self.received = 0
+
+    @classmethod
+    async def connect(cls, port: int, cafile: str | None = None) -> "Client":
+        ctx = None
+        if cafile:
+            ctx = ssl.create_default_context(cafile=cafile)
+        reader, writer = await asyncio.open_connection("localhost" if ctx else "127.0.0.1", port,
+                                                       ssl=ctx, limit=2**24)
+        client = cls(reader, writer)
+        await client.greeting()
+        return client
+
+    async def greeting(self) -> bytes:
+        line = await self.reader.readline()
+        if not line.startswith((b"* OK", b"* PREAUTH")):
+            raise ConnectionError(f"bad greeting: {line!r}")
+        return line
+
+    async def command(self, cmd: str) -> bytes:
+        self.tagnum += 1
+        tag = f"B{self.tagnum}".encode()
+
+        self.writer.write(tag + b" " + cmd.encode() + b"\r\n")
+        await self.writer.drain()
+
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            self.received += len(line)
+
+            if line.endswith(b"}\r\n"):
+                size = int(line[line.rindex(b"{") + 1:-3])
+                await self.reader.readexactly(size)
+                self.received += size
+                continue
+
+            if line.startswith(tag + b" "):
+                return line
+
+    async def pipeline(self, cmds: List[str]) -> None:
+        tags = set()
+        for cmd in cmds:
+            self.tagnum += 1
+            tag = f"B{self.tagnum}".encode()
+            tags.add(tag)
+            self.writer.write(tag + b" " + cmd.encode() + b"\r\n")
+        await self.writer.drain()
+
+        while tags:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            self.received += len(line)
+
+            if line.endswith(b"}\r\n"):
+                size = int(line[line.rindex(b"{") + 1:-3])
+                await self.reader.readexactly(size)
+                self.received += size
+                continue
+
+            tags.discard(line.split(b" ", 1)[0])
+
+    async def append(self, mailbox: str, message: bytes, sync: bool = True) -> bytes:
+        self.tagnum += 1
+        tag = f"B{self.tagnum}".encode()
+
+        self.writer.write(tag + f" APPEND {mailbox} {{{len(message)}{'' if sync else '+'}}}\r\n".encode())
+
+        if sync:
+            await self.writer.drain()
+            line = await self.reader.readline()
+            if not line.startswith(b"+"):
+                return line
+
+        self.writer.write(message)
+        self.writer.write(b"\r\n")
+        await self.writer.drain()
+
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            if line.startswith(tag + b" "):
+                return line
+
+    async def login(self) -> None:
+        status = await self.command(f"LOGIN {DOWNSTREAM_USER} {DOWNSTREAM_PASSWORD}")
+        if b" OK " not in status:
+            raise ConnectionError(f"login failed: {status!r}")
+
+    async def logout(self) -> None:
+        try:
+            await self.command("LOGOUT")
+        except ConnectionError:
+            # The server may close the connection right after BYE.
+            pass
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+        if self.proc:
+            await self.proc.wait()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Compare connection rate and memory of the server engines.
+#
+# Every connection logs in, selects INBOX and logs out. Memory is the peak
+# resident size of the server and all its child processes. Then one client
+# sends a series of mixed commands, one at a time, whose latency shows the
+# small responses held back on the way to the client.
+#
+
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+from typing import Any, Dict, List
+
+import common
+
+
+async def one_connection(port: int) -> None:
+    client = await common.Client.connect(port)
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+        await client.logout()
+    finally:
+        await client.close()
+
+
+async def command_times(port: int, commands: int) -> List[float]:
+    workload = ["NOOP", "FETCH 1 (FLAGS)", "STATUS INBOX (MESSAGES)", "UID FETCH 2 (UID RFC822.SIZE)"]
+
+    client = await common.Client.connect(port)
+    times: List[float] = []
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+
+        for num in range(commands):
+            start = time.monotonic()
+            await client.command(workload[num % len(workload)])
+            times.append(time.monotonic() - start)
+
+        await client.logout()
+    finally:
+        await client.close()
+
+    return times
+
+
+async def drive(port: int, connections: int, concurrency: int) -> float:
+    queue = list(range(connections))
+
+    async def worker() -> None:
+        while queue:
+            queue.pop()
+            await one_connection(port)
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.monotonic() - start
+
+
+def run_engine(engine: str, args: argparse.Namespace) -> Dict[str, float]:
+    config: Dict[str, Dict[str, Any]] = {}
+    if args.pool:
+        config["pool"] = {"size": args.pool, "min-idle": args.pool}
+    if engine == "prefork":
+        config["workers"] = {"count": args.workers, "max-sessions": args.max_sessions}
+
+    with common.Environment(messages=10, latency=args.latency, config=config) as env:
+        env.start_upstream()
+        server = env.start_server("--engine", engine)
+
+        peak = common.rss_kb(server.pid)
+        done = threading.Event()
+
+        def sample() -> None:
+            nonlocal peak
+            while not done.wait(0.05):
+                peak = max(peak, common.rss_kb(server.pid))
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            elapsed = asyncio.run(drive(env.downstream_port, args.connections, args.concurrency))
+        finally:
+            done.set()
+            sampler.join()
+
+        times = asyncio.run(command_times(env.downstream_port, args.commands))
+
+    return {
+        "conn/s": args.connections / elapsed,
+        "peak RSS MiB": peak / 1024,
+        "cmd p50 ms": common.percentile(times, 50) * 1000,
+        "cmd p90 ms": common.percentile(times, 90) * 1000,
+        "cmd max ms": max(times) * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="compare server engines")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--commands", type=int, default=200, help="mixed commands timed one by one.")
+    parser.add_argument("--latency", type=float, default=0, help="upstream latency (ms).")
+    parser.add_argument("--pool", type=int, default=0,
+                        help="keep this many authenticated upstream connections (asyncio, prefork).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes of the prefork engine.")
+    parser.add_argument("--max-sessions", type=int, default=0,
+                        help="sessions after which a prefork worker is replaced.")
+    parser.add_argument("--engine", action="append", dest="engines",
+                        help="engine to measure (default: all).")
+    args = parser.parse_args()
+
+    engines: List[str] = args.engines or ["fork", "asyncio", "prefork"]
+
+    columns = ["conn/s", "peak RSS MiB", "cmd p50 ms", "cmd p90 ms", "cmd max ms"]
+
+    print(f"{'engine':<10}" + "".join(f" {name:>13}" for name in columns))
+    for engine in engines:
+        res = run_engine(engine, args)
+        print(f"{engine:<10}" + "".join(f" {res[name]:>13.1f}" for name in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# A minimal IMAP4rev1 server used as the upstream in benchmarks. It accepts
+# any credentials and serves a single synthetic mailbox.
+#
+
+import argparse
+import asyncio
+import base64
+import ssl
+import time
+
+from typing import List, Set, Tuple
+
+CAPABILITIES = "IMAP4rev1 AUTH=XOAUTH2 AUTH=OAUTHBEARER SASL-IR IDLE UIDPLUS UNSELECT LITERAL+ ENABLE CONDSTORE"
+
+
+def make_message(num: int, size: int) -> bytes:
+    header = (f"From: sender{num}@example.com\r\n"
+              f"To: user@example.com\r\n"
+              f"Subject: message {num}\r\n"
+              f"Message-ID: <{num}@fakeimap>\r\n"
+              f"\r\n").encode()
+    line = b"x" * 74 + b"\r\n"
+    body = line * max(0, (size - len(header)) // len(line))
+    return header + body
+
+
+def parse_sequence(seqset: str, last: int) -> List[int]:
+    nums: List[int] = []
+    for part in seqset.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            lo = last if a == "*" else int(a)
+            hi = last if b == "*" else int(b)
+            nums.extend(range(min(lo, hi), min(max(lo, hi), last) + 1))
+        else:
+            n = last if part == "*" else int(part)
+            if n <= last:
+                nums.append(n)
+    return nums
+
+
+def sasl_user(response: str) -> str:
+    # The user of an XOAUTH2 or OAUTHBEARER initial response.
+    try:
+        fields = base64.b64decode(response).decode().replace(",", "\x01").split("\x01")
+    except (ValueError, UnicodeDecodeError):
+        return ""
+    for field in fields:
+        if field.startswith(("user=", "a=")):
+            return field.split("=", 1)[1]
+    return ""
+
+
+class Mailbox:
+    def __init__(self, messages: int, sizes: List[int], uidvalidity: int = 1):
+        # The sizes are used in turn.
+        self.messages = [make_message(i, sizes[(i - 1) % len(sizes)]) for i in range(1, messages + 1)]
+        self.uidvalidity = uidvalidity
+        # Set and replaced whenever a message is added.
+        self.changed = asyncio.Event()
+        # The sessions that have the mailbox selected.
+        self.sessions: Set["Session"] = set()
+        # The messages marked \Deleted.
+        self.deleted: Set[int] = set()
+
+    def add(self, size: int) -> None:
+        self.messages.append(make_message(len(self.messages) + 1, size))
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def notify(self, origin: "Session", line: str) -> None:
+        # What a session has changed is reported to the other ones.
+        for session in self.sessions:
+            if session is not origin:
+                session.notices.append(line)
+
+    def expunge(self) -> List[int]:
+        nums = sorted(self.deleted, reverse=True)
+        for num in nums:
+            del self.messages[num - 1]
+        self.deleted.clear()
+        return nums
+
+
+class Session:
+    def __init__(self, args: argparse.Namespace, mailbox: Mailbox,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.args = args
+        self.mailbox = mailbox
+        self.reader = reader
+        self.writer = writer
+        # Who the client has authenticated as.
+        self.user = ""
+        # The extensions the client has enabled.
+        self.enabled: List[str] = []
+        # The changes made by the other sessions not reported yet.
+        self.notices: List[str] = []
+
+    def send(self, line: str) -> None:
+        self.writer.write(line.encode() + b"\r\n")
+
+    async def complete(self, tag: str, text: str) -> None:
+        self.send(f"{tag} {text}")
+        await self.writer.drain()
+
+    async def read_literals(self, line: bytes) -> None:
+        # Skips the literals of a command. Their contents are never used.
+        while line.endswith(b"}\r\n"):
+            size = int(line[line.rindex(b"{") + 1:line.rindex(b"}")].rstrip(b"+"))
+            if not line.endswith(b"+}\r\n"):
+                self.send("+ Ready for literal data")
+                await self.writer.drain()
+            while size > 0:
+                size -= len(await self.reader.readexactly(min(size, 2**20)))
+            line = await self.reader.readline()
+
+    async def fetch(self, tag: str, args: List[str], uid: bool) -> None:
+        items = " ".join(args[1:]).upper()
+        last = len(self.mailbox.messages)
+
+        # Short responses are sent in large pieces like a real server does.
+        out: List[bytes] = []
+        pending = 0
+
+        for num in parse_sequence(args[0], last):
+            msg = self.mailbox.messages[num - 1]
+            if "BODY[]" in items or "BODY.PEEK[]" in items or "RFC822" in items:
+                name = "RFC822" if "RFC822" in items else "BODY[]"
+                parts = [f"* {num} FETCH (UID {num} {name} {{{len(msg)}}}\r\n".encode(), msg, b")\r\n"]
+            elif "HEADER" in items:
+                hdr = msg[:msg.index(b"\r\n\r\n") + 4]
+                parts = [f"* {num} FETCH (UID {num} BODY[HEADER] {{{len(hdr)}}}\r\n".encode(), hdr, b")\r\n"]
+            else:
+                parts = [f"* {num} FETCH (UID {num} FLAGS (\\Seen) RFC822.SIZE {len(msg)})\r\n".encode()]
+
+            out.extend(parts)
+            pending += sum(len(p) for p in parts)
+
+            if pending >= 65536:
+                self.writer.writelines(out)
+                await self.writer.drain()
+                out, pending = [], 0
+
+        self.writer.writelines(out)
+        await self.complete(tag, f"OK {'UID ' if uid else ''}FETCH completed")
+
+    async def idle(self, queue: "asyncio.Queue[Tuple[float, bytes]]") -> None:
+        # Reports new messages until the client is done.
+        known = len(self.mailbox.messages)
+        done = asyncio.ensure_future(queue.get())
+        try:
+            while not done.done():
+                changed = asyncio.ensure_future(self.mailbox.changed.wait())
+                await asyncio.wait([done, changed], return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+
+                if len(self.mailbox.messages) != known:
+                    known = len(self.mailbox.messages)
+                    self.send(f"* {known} EXISTS")
+                    await self.writer.drain()
+        finally:
+            done.cancel()
+
+    async def read_commands(self, queue: "asyncio.Queue[Tuple[float, bytes]]") -> None:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                await queue.put((0, b""))
+                return
+
+            if line.endswith(b"}\r\n"):
+                await self.read_literals(line)
+
+            await queue.put((time.monotonic(), line))
+
+    async def run(self) -> None:
+        self.send("* OK fakeimap IMAP4rev1 Service Ready")
+        await self.writer.drain()
+
+        #
+        # Commands are read as soon as they arrive so that the latency acts
+        # like a network round trip: pipelined commands are delayed once.
+        #
+        queue: "asyncio.Queue[Tuple[float, bytes]]" = asyncio.Queue()
+        reader = asyncio.create_task(self.read_commands(queue))
+        try:
+            await self.process(queue)
+        finally:
+            self.mailbox.sessions.discard(self)
+            reader.cancel()
+
+    def store(self, args: List[str]) -> None:
+        flags = " ".join(args[2:])
+        for num in parse_sequence(args[0], len(self.mailbox.messages)):
+            if "\\DELETED" in flags.upper() and args[1].startswith("+"):
+                self.mailbox.deleted.add(num)
+            if ".SILENT" not in args[1].upper():
+                self.send(f"* {num} FETCH (FLAGS {flags})")
+            self.mailbox.notify(self, f"* {num} FETCH (FLAGS {flags})")
+
+    def expunge(self, report: bool) -> None:
+        for num in self.mailbox.expunge():
+            if report:
+                self.send(f"* {num} EXPUNGE")
+            self.mailbox.notify(self, f"* {num} EXPUNGE")
+
+    async def process(self, queue: "asyncio.Queue[Tuple[float, bytes]]") -> None:
+        while True:
+            received, line = await queue.get()
+            if not line:
+                return
+
+            if self.args.latency:
+                await asyncio.sleep(max(0.0, received + self.args.latency / 1000 - time.monotonic()))
+
+            words = line.decode("utf-8", "replace").split()
+            if len(words) < 2:
+                continue
+
+            tag, cmd, args = words[0], words[1].upper(), words[2:]
+
+            for notice in self.notices:
+                self.send(notice)
+            self.notices.clear()
+
+            uid = False
+            if cmd == "UID" and args:
+                uid = True
+                cmd, args = args[0].upper(), args[1:]
+
+            match cmd:
+                case "CAPABILITY":
+                    self.send(f"* CAPABILITY {CAPABILITIES}")
+                    await self.complete(tag, "OK CAPABILITY completed")
+                case "AUTHENTICATE":
+                    if len(args) < 2:
+                        self.send("+ ")
+                        await self.writer.drain()
+                        _, response = await queue.get()
+                        args.append(response.decode().strip())
+                    self.user = sasl_user(args[1])
+                    await self.complete(tag, "OK AUTHENTICATE completed")
+                case "ID":
+                    self.send(f'* ID ("name" "fakeimap" "user" "{self.user}" '
+                              f'"enabled" "{" ".join(self.enabled)}")')
+                    await self.complete(tag, "OK ID completed")
+                case "ENABLE":
+                    self.enabled.extend(arg.upper() for arg in args)
+                    self.send(f"* ENABLED {' '.join(args)}")
+                    await self.complete(tag, "OK ENABLE completed")
+                case "LOGIN":
+                    await self.complete(tag, "OK LOGIN completed")
+                case "SELECT" | "EXAMINE":
+                    self.mailbox.sessions.add(self)
+                    self.send(f"* {len(self.mailbox.messages)} EXISTS")
+                    self.send("* 0 RECENT")
+                    self.send(f"* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid")
+                    self.send(f"* OK [UIDNEXT {len(self.mailbox.messages) + 1}] Predicted next UID")
+                    self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+                    await self.complete(tag, f"OK [READ-WRITE] {cmd} completed")
+                case "FETCH":
+                    await self.fetch(tag, args, uid)
+                case "SEARCH":
+                    nums = " ".join(str(i) for i in range(1, len(self.mailbox.messages) + 1))
+                    self.send(f"* SEARCH {nums}")
+                    await self.complete(tag, "OK SEARCH completed")
+                case "LIST" | "LSUB":
+                    self.send(f'* {cmd} (\\HasNoChildren) "/" INBOX')
+                    if "STATUS" in (arg.upper().strip("()") for arg in args):
+                        self.send(f"* STATUS INBOX (MESSAGES {len(self.mailbox.messages)} UNSEEN 0)")
+                    self.send(f'* {cmd} (\\HasNoChildren) "/" Sent')
+                    await self.complete(tag, f"OK {cmd} completed")
+                case "STATUS":
+                    self.send(f"* STATUS {args[0]} (MESSAGES {len(self.mailbox.messages)} UNSEEN 0)")
+                    await self.complete(tag, "OK STATUS completed")
+                case "NAMESPACE":
+                    self.send('* NAMESPACE (("" "/")) NIL NIL')
+                    await self.complete(tag, "OK NAMESPACE completed")
+                case "APPEND":
+                    if self.args.keep_appended:
+                        self.mailbox.add(1024)
+                    await self.complete(tag, "OK APPEND completed")
+                case "IDLE":
+                    self.send("+ idling")
+                    await self.writer.drain()
+                    await self.idle(queue)
+                    await self.complete(tag, "OK IDLE terminated")
+                case "LOGOUT":
+                    self.mailbox.sessions.discard(self)
+                    self.send("* BYE fakeimap logging out")
+                    await self.complete(tag, "OK LOGOUT completed")
+                    return
+                case "STORE" if len(args) > 2:
+                    self.store(args)
+                    await self.complete(tag, f"OK {cmd} completed")
+                case "EXPUNGE" | "CLOSE":
+                    self.expunge(report=cmd == "EXPUNGE")
+                    if cmd == "CLOSE":
+                        self.mailbox.sessions.discard(self)
+                    await self.complete(tag, f"OK {cmd} completed")
+                case "UNSELECT":
+                    self.mailbox.sessions.discard(self)
+                    await self.complete(tag, f"OK {cmd} completed")
+                case "NOOP" | "CHECK" | "STORE":
+                    await self.complete(tag, f"OK {cmd} completed")
+                case _:
+                    await self.complete(tag, "BAD unknown command")
+
+
+async def serve(args: argparse.Namespace) -> None:
+    sizes = [int(n) for n in args.sizes.split(",")] if args.sizes else [args.size]
+    mailbox = Mailbox(args.messages, sizes, args.uidvalidity)
+
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(args.cert, args.key)
+
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await Session(args, mailbox, reader, writer).run()
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handler, args.host, args.port, ssl=ctx,
+                                        reuse_address=True, limit=2**24)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="fake upstream IMAP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10993)
+    parser.add_argument("--cert", required=True, help="PEM certificate.")
+    parser.add_argument("--key", required=True, help="PEM private key.")
+    parser.add_argument("--messages", type=int, default=100, help="messages in INBOX.")
+    parser.add_argument("--size", type=int, default=16384, help="size of each message in bytes.")
+    parser.add_argument("--sizes", default="", help="comma-separated message sizes used in turn (overrides --size).")
+    parser.add_argument("--latency", type=float, default=0, help="delay before each tagged response (ms).")
+    parser.add_argument("--uidvalidity", type=int, default=1, help="UIDVALIDITY of INBOX.")
+    parser.add_argument("--keep-appended", action="store_true",
+                        help="add appended messages to INBOX (as 1 KiB messages).")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# A minimal OAuth2 token endpoint used in benchmarks. It grants every
+# refresh_token request and counts how many it has served.
+#
+
+import argparse
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+from typing import Any
+
+
+class TokenServer(http.server.ThreadingHTTPServer):
+    def __init__(self, port: int, expires_in: int = 3600, delay: float = 0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", port), TokenHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/token"
+
+    def start(self) -> "TokenServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class TokenHandler(http.server.BaseHTTPRequestHandler):
+    server: TokenServer
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        params = urllib.parse.parse_qs(self.rfile.read(length).decode())
+
+        with self.server.lock:
+            self.server.requests += 1
+            num = self.server.requests
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if params.get("grant_type") != ["refresh_token"]:
+            body = {"error": "unsupported_grant_type"}
+        else:
+            body = {
+                "access_token": f"fake-access-token-{num}",
+                "refresh_token": f"fake-refresh-token-{num}",
+                "expires_in": self.server.expires_in,
+            }
+
+        data = json.dumps(body).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_: Any) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="fake OAuth2 token endpoint")
+    parser.add_argument("--port", type=int, default=10080)
+    parser.add_argument("--expires-in", type=int, default=3600, help="token lifetime (seconds).")
+    parser.add_argument("--delay", type=float, default=0, help="delay before each response (seconds).")
+    args = parser.parse_args()
+
+    with TokenServer(args.port, args.expires_in, args.delay) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
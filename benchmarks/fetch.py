@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Throughput of FETCH BODY[] for large messages through the proxy compared to
+# fetching them from the fake upstream directly.
+#
+
+import argparse
+import asyncio
+import threading
+import time
+
+from typing import Tuple
+
+import common
+
+
+async def fetch_all(port: int, messages: int, direct: Tuple[str, ...] = ()) -> Tuple[float, int]:
+    client = await common.Client.connect(port, *direct)
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+
+        received = client.received
+        start = time.monotonic()
+        for num in range(1, messages + 1):
+            await client.command(f"FETCH {num} (BODY.PEEK[])")
+        elapsed = time.monotonic() - start
+
+        await client.logout()
+    finally:
+        await client.close()
+
+    return elapsed, client.received - received
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FETCH BODY[] throughput")
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--size", type=int, default=32 * 1024 * 1024, help="message size in bytes.")
+    parser.add_argument("--engine", default="asyncio")
+    args = parser.parse_args()
+
+    with common.Environment(messages=args.messages, size=args.size) as env:
+        env.start_upstream()
+        server = env.start_server("--engine", args.engine)
+
+        elapsed, nbytes = asyncio.run(fetch_all(env.upstream_port, args.messages, (env.cert,)))
+        print(f"{'direct':<10} {nbytes / elapsed / 2**20:>9.1f} MiB/s")
+
+        peak = common.rss_kb(server.pid)
+        done = threading.Event()
+
+        def sample() -> None:
+            nonlocal peak
+            while not done.wait(0.05):
+                peak = max(peak, common.rss_kb(server.pid))
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            elapsed, nbytes = asyncio.run(fetch_all(env.downstream_port, args.messages))
+        finally:
+            done.set()
+            sampler.join()
+
+        print(f"{'proxy':<10} {nbytes / elapsed / 2**20:>9.1f} MiB/s  (peak RSS {peak / 1024:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure how long a client waits for the greeting, for the answer to its
+# first command (CAPABILITY) and for its LOGIN to complete.
+#
+
+import argparse
+import asyncio
+import time
+
+from typing import Dict, List
+
+import common
+
+
+async def one_connection(port: int, times: Dict[str, List[float]]) -> None:
+    start = time.monotonic()
+
+    client = await common.Client.connect(port)
+    try:
+        times["greeting"].append(time.monotonic() - start)
+
+        await client.command("CAPABILITY")
+        times["capability"].append(time.monotonic() - start)
+
+        await client.login()
+        times["login"].append(time.monotonic() - start)
+
+        await client.logout()
+    finally:
+        await client.close()
+
+
+async def drive(port: int, connections: int) -> Dict[str, List[float]]:
+    times: Dict[str, List[float]] = {"greeting": [], "capability": [], "login": []}
+    for _ in range(connections):
+        await one_connection(port, times)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="time to the greeting and the first responses")
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=50, help="upstream latency (ms).")
+    parser.add_argument("--engine", default="fork")
+    args = parser.parse_args()
+
+    with common.Environment(messages=10, latency=args.latency) as env:
+        env.start_upstream()
+        env.start_server("--engine", args.engine)
+
+        times = asyncio.run(drive(env.downstream_port, args.connections))
+
+    print(f"{'after':<12} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, values in times.items():
+        print(f"{name:<12} {common.percentile(values, 50) * 1000:>8.1f} "
+              f"{common.percentile(values, 99) * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
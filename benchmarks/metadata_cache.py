@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# A mail checker like mutt's: LIST, LSUB and a STATUS of every mailbox,
+# repeated, with and without the metadata cache. Then an APPEND to one
+# mailbox and a SELECT of another one, which reports EXISTS, after which
+# their STATUS has to come from the server again. The same goes for the
+# selected mailbox after the commands setting \Seen or removing messages,
+# and after another session has changed flags or expunged messages, and
+# for a LIST returning the STATUS too.
+#
+
+import argparse
+import asyncio
+import sys
+import time
+
+from typing import List, Tuple
+
+import common
+
+
+async def command(client: common.Client, cmd: str) -> bytes:
+    # The whole response without the tag.
+    client.tagnum += 1
+    tag = f"M{client.tagnum} ".encode()
+
+    client.writer.write(tag + cmd.encode() + b"\r\n")
+    await client.writer.drain()
+
+    lines: List[bytes] = []
+    while True:
+        line = await client.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line.startswith(tag):
+            return b"".join(lines) + line[len(tag):]
+        lines.append(line)
+
+
+async def check(client: common.Client, mailboxes: int) -> List[bytes]:
+    return [await command(client, 'LIST "" "*"'), await command(client, 'LSUB "" "*"')] + \
+           [await command(client, f"STATUS Folder{num} (MESSAGES UNSEEN)") for num in range(mailboxes)]
+
+
+async def drive(env: common.Environment, args: argparse.Namespace) -> List[float]:
+    client = await common.Client.connect(env.downstream_port)
+    await client.login()
+
+    times: List[float] = []
+    first: List[bytes] = []
+
+    for _ in range(args.rounds):
+        start = time.monotonic()
+        responses = await check(client, args.mailboxes)
+        times.append(time.monotonic() - start)
+
+        if first and responses != first:
+            raise ValueError("the responses differ between the rounds")
+        first = first or responses
+
+    await client.append("Folder0", b"Subject: new\r\n\r\nnew message\r\n")
+
+    start = time.monotonic()
+    await command(client, "STATUS Folder0 (MESSAGES UNSEEN)")
+    times.append(time.monotonic() - start)
+
+    await command(client, "STATUS INBOX (MESSAGES UNSEEN)")
+    await command(client, "SELECT INBOX")
+
+    start = time.monotonic()
+    await command(client, "STATUS INBOX (MESSAGES UNSEEN)")
+    times.append(time.monotonic() - start)
+
+    await client.logout()
+    await client.close()
+
+    return times
+
+
+STATUS = "STATUS INBOX (MESSAGES UNSEEN)"
+LIST_STATUS = 'LIST "" "*" RETURN (STATUS (MESSAGES UNSEEN))'
+
+# What is done after the STATUS of INBOX has been cached (by the client, the
+# other session) and whether the STATUS may still come from the cache.
+CHANGES: List[Tuple[str, str, List[Tuple[str, str]], bool]] = [
+    ("FETCH BODY.PEEK[]",     STATUS, [("client", "FETCH 1 (BODY.PEEK[])")], True),
+    ("FETCH BODY[]",          STATUS, [("client", "FETCH 1 (BODY[])")], False),
+    ("FETCH BINARY[]",        STATUS, [("client", "FETCH 1 (BINARY[])")], False),
+    ("FETCH RFC822",          STATUS, [("client", "FETCH 1 (RFC822)")], False),
+    ("UID FETCH RFC822.TEXT", STATUS, [("client", "UID FETCH 1 (RFC822.TEXT)")], False),
+    ("UID FETCH BODY[]",      STATUS, [("client", "UID FETCH 2 (BODY[])")], False),
+    ("cached UID FETCH",      STATUS, [("client", "UID FETCH 2 (BODY[])")], False),
+    ("other STORE",           STATUS, [("other", "STORE 3 +FLAGS (\\Flagged)"), ("client", "NOOP")], False),
+    ("other STORE \\Deleted", STATUS, [("other", "STORE 4 +FLAGS.SILENT (\\Deleted)"), ("client", "NOOP")], False),
+    ("other EXPUNGE",         STATUS, [("other", "EXPUNGE"), ("client", "NOOP")], False),
+    ("LIST RETURN STATUS",    LIST_STATUS, [("client", "STORE 5 +FLAGS (\\Seen)")], False),
+    ("SELECT",                "STATUS INBOX (RECENT)", [("client", "SELECT INBOX")], False),
+    ("CLOSE",                 STATUS, [("client", "CLOSE")], False),
+]
+
+
+async def stale(env: common.Environment) -> List[float]:
+    client = await common.Client.connect(env.downstream_port)
+    await client.login()
+    await command(client, "SELECT INBOX")
+
+    other = await common.Client.connect(env.downstream_port)
+    await other.login()
+    await command(other, "SELECT INBOX")
+
+    times: List[float] = []
+
+    for _, probe, commands, _ in CHANGES:
+        await command(client, probe)
+
+        for who, cmd in commands:
+            await command(client if who == "client" else other, cmd)
+
+        start = time.monotonic()
+        await command(client, probe)
+        times.append(time.monotonic() - start)
+
+    for peer in (client, other):
+        await peer.logout()
+        await peer.close()
+
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="LIST, LSUB and STATUS with the metadata cache")
+    parser.add_argument("--mailboxes", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency (ms).")
+    parser.add_argument("--engine", default="fork")
+    args = parser.parse_args()
+
+    print(f"{'cache':<6} {'first round ms':>15} {'next rounds ms':>15} {'after APPEND ms':>16} "
+          f"{'after EXISTS ms':>16}")
+
+    failed = False
+    for ttl in (0, 300):
+        with common.Environment(messages=10, latency=args.latency,
+                                config={"metadata-cache": {"ttl": ttl}}) as env:
+            env.start_upstream()
+            env.start_server("--engine", args.engine)
+
+            times = asyncio.run(drive(env, args))
+
+        rounds = times[1:-2]
+        print(f"{'on' if ttl else 'off':<6} {times[0] * 1000:>15.1f} "
+              f"{sum(rounds) / len(rounds) * 1000:>15.1f} {times[-2] * 1000:>16.1f} "
+              f"{times[-1] * 1000:>16.1f}")
+
+        # The STATUS after the changes is not answered from the cache.
+        if min(times[-2:]) * 1000 < args.latency / 2:
+            failed = True
+
+    print()
+    print(f"{'after':<22} {'again ms':>10}  from")
+
+    with common.Environment(messages=10, latency=args.latency,
+                            config={"metadata-cache": {"ttl": 300}, "body-cache": {"dir": "~/cache"}}) as env:
+        env.start_upstream()
+        env.start_server("--engine", args.engine)
+
+        times = asyncio.run(stale(env))
+
+    for (name, _, _, cached), elapsed in zip(CHANGES, times):
+        hit = elapsed * 1000 < args.latency / 2
+        print(f"{name:<22} {elapsed * 1000:>10.1f}  {'cache' if hit else 'server'}")
+
+        if hit != cached:
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
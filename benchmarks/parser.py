@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure the per-line work of the relay over sample server responses
+# (benchmarks/responses.txt) and client commands.
+#
+# The "decode" variant is the way lines were handled before: a regular
+# expression for the literal, a decode of the whole line and a split.
+#
+
+import argparse
+import os.path
+import re
+import timeit
+
+from typing import Callable, List, Tuple
+
+import common
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.imap as imap
+
+LiteralRe = br'.*{(?P<size>\d+)}\r\n$'
+
+COMMANDS = [
+    b"A1 CAPABILITY\r\n",
+    b"A2 LOGIN bench secret\r\n",
+    b"A3 LIST \"\" \"*\"\r\n",
+    b"A4 SELECT INBOX\r\n",
+    b"A5 UID FETCH 1:* (UID FLAGS RFC822.SIZE INTERNALDATE)\r\n",
+    b"A6 UID FETCH 1001:1050 (UID FLAGS ENVELOPE BODYSTRUCTURE)\r\n",
+    b"A7 UID FETCH 1001 (BODY.PEEK[HEADER.FIELDS (FROM TO CC SUBJECT DATE MESSAGE-ID)])\r\n",
+    b"A8 UID SEARCH SINCE 01-Apr-2024 NOT DELETED\r\n",
+    b"A9 IDLE\r\n",
+    b"DONE\r\n",
+    b"A10 LOGOUT\r\n",
+]
+
+
+def load_responses() -> List[bytes]:
+    with open(os.path.join(common.TOPDIR, "benchmarks", "responses.txt"), "rb") as f:
+        return [line.rstrip(b"\n") + b"\r\n" for line in f if not line.startswith(b"#")]
+
+
+def decode_server(line: bytes) -> Tuple[str, str] | int:
+    m = re.match(LiteralRe, line)
+    if m:
+        return int(m.group("size"))
+
+    s = line.decode("utf-8", "replace").rstrip("\r\n").split(" ")
+    if len(s) > 1:
+        if s[0] == "*" and s[1] in ('OK', 'NO', 'BAD', 'PREAUTH', 'BYE'):
+            return "*", s[1]
+        if s[0] == "+":
+            return "+", ""
+        if s[1] in ('OK', 'NO', 'BAD'):
+            return s[0], s[1]
+    return "", ""
+
+
+def bytes_server(line: bytes) -> Tuple[str, str] | int:
+    size, _ = imap.parse_literal(line)
+    if size >= 0:
+        return size
+    return imap.parse_server_command(line)
+
+
+def decode_client(line: bytes) -> Tuple[str, str, str]:
+    tag, args = line.decode("utf-8", "replace").rstrip("\r\n").split(" ", 1)
+    args = args.strip()
+    if " " in args:
+        cmd, args = args.split(" ", 1)
+        return tag, cmd.upper(), args
+    return tag, args.upper(), ""
+
+
+def measure(func: Callable[[bytes], object], lines: List[bytes], number: int) -> float:
+    def run() -> None:
+        for line in lines:
+            try:
+                func(line)
+            except ValueError:
+                pass
+
+    return min(timeit.repeat(run, number=number, repeat=5)) / number / len(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="line parser micro-benchmark")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    responses = load_responses()
+
+    for a, b in zip(map(decode_server, responses), map(bytes_server, responses)):
+        assert a == b, (a, b)
+
+    sets = [
+        ("responses", responses, decode_server, bytes_server),
+        ("commands", COMMANDS, decode_client, imap.parse_client_command),
+    ]
+
+    print(f"{'lines':<10} {'count':>6} {'avg bytes':>10} {'decode ns':>10} {'bytes ns':>10}")
+    for name, lines, old, new in sets:
+        avg = sum(map(len, lines)) / len(lines)
+        t_old = measure(old, lines, args.number) * 1e9
+        t_new = measure(new, lines, args.number) * 1e9
+        print(f"{name:<10} {len(lines):>6} {avg:>10.0f} {t_old:>10.0f} {t_new:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
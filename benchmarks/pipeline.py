@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure a batch of commands sent one by one and pipelined, and check that
+# IDLE can be terminated by the client.
+#
+
+import argparse
+import asyncio
+import time
+
+import common
+
+
+async def drive(port: int, commands: int) -> None:
+    client = await common.Client.connect(port)
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+
+        cmds = [f"UID FETCH {i % 10 + 1} (FLAGS)" for i in range(commands)]
+
+        start = time.monotonic()
+        for cmd in cmds:
+            await client.command(cmd)
+        serial = time.monotonic() - start
+
+        start = time.monotonic()
+        await client.pipeline(cmds)
+        pipelined = time.monotonic() - start
+
+        print(f"{'mode':<10} {'commands':>9} {'seconds':>9} {'cmd/s':>9}")
+        print(f"{'serial':<10} {commands:>9} {serial:>9.3f} {commands / serial:>9.1f}")
+        print(f"{'pipelined':<10} {commands:>9} {pipelined:>9.3f} {commands / pipelined:>9.1f}")
+
+        client.tagnum += 1
+        tag = f"B{client.tagnum}".encode()
+        client.writer.write(tag + b" IDLE\r\n")
+        await client.writer.drain()
+        cont = await client.reader.readline()
+        client.writer.write(b"DONE\r\n")
+        await client.writer.drain()
+        done = await asyncio.wait_for(client.reader.readline(), 5)
+        print("IDLE:", "ok" if cont.startswith(b"+") and done.startswith(tag + b" OK") else "failed")
+
+        await client.logout()
+    finally:
+        await client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="serial vs pipelined commands")
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency (ms).")
+    parser.add_argument("--engine", default="asyncio")
+    args = parser.parse_args()
+
+    with common.Environment(messages=10, latency=args.latency) as env:
+        env.start_upstream()
+        env.start_server("--engine", args.engine)
+        asyncio.run(drive(env.downstream_port, args.commands))
+
+
+if __name__ == "__main__":
+    main()
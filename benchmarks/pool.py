@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Short sessions through the upstream connection pool: the login time with
+# and without the pool. Some of the clients enable CONDSTORE, and the
+# connection they used must not get to the next client, which would find
+# the extension enabled without asking for it.
+#
+
+import argparse
+import asyncio
+import sys
+import time
+
+from typing import List
+
+import common
+
+
+async def enabled(client: common.Client) -> str:
+    # The extensions the fake upstream server has enabled on the connection.
+    client.tagnum += 1
+    tag = f"B{client.tagnum} ".encode()
+
+    client.writer.write(tag + b"ID NIL\r\n")
+    await client.writer.drain()
+
+    extensions = ""
+    while True:
+        line = await client.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line.startswith(b"* ID "):
+            extensions = line.split(b'"enabled" "', 1)[1].split(b'"', 1)[0].decode()
+        if line.startswith(tag):
+            return extensions
+
+
+async def drive(env: common.Environment, args: argparse.Namespace) -> List[float]:
+    times: List[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(num: int) -> None:
+        async with semaphore:
+            client = await common.Client.connect(env.downstream_port)
+
+            start = time.monotonic()
+            await client.login()
+            times.append(time.monotonic() - start)
+
+            extensions = await enabled(client)
+            if extensions:
+                raise ValueError(f"got a connection with {extensions} enabled")
+
+            await client.command("SELECT INBOX")
+            if num % args.enable == 0:
+                await client.command("ENABLE CONDSTORE")
+
+            await client.logout()
+            await client.close()
+
+    await asyncio.gather(*[one(num) for num in range(args.sessions)])
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="sessions through the upstream connection pool")
+    parser.add_argument("--sessions", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--pool", type=int, default=4, help="pooled connections per account.")
+    parser.add_argument("--enable", type=int, default=3, help="every this many sessions enable CONDSTORE.")
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency (ms).")
+    args = parser.parse_args()
+
+    print(f"{'pool':<5} {'login p50 ms':>13} {'login p99 ms':>13}")
+
+    for size in (0, args.pool):
+        with common.Environment(messages=10, latency=args.latency,
+                                config={"pool": {"size": size}}) as env:
+            env.start_upstream()
+            env.start_server("--engine", "asyncio")
+
+            times = asyncio.run(drive(env, args))
+
+        print(f"{size:<5} {common.percentile(times, 50) * 1000:>13.1f} "
+              f"{common.percentile(times, 99) * 1000:>13.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure the provider lookups done while setting up a connection.
+#
+# A connection resolves the upstream provider three times (the server, the
+# upstream authentication and the token lookup) and computes the token key
+# twice.
+#
+
+import argparse
+import timeit
+
+from typing import Any, Dict
+
+import common  # pylint: disable=unused-import
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.oauth2 as oauth2
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="provider lookups per connection")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    config: Dict[str, Any] = {
+        "upstream": {
+            "provider": "microsoft",
+            "client-id": "bench-client",
+            "username": "user@example.com",
+            "tokens-file": "/dev/null",
+        },
+    }
+
+    def uncached() -> None:
+        for _ in range(3):
+            provider = oauth2.resolve_provider(config["upstream"])
+        assert provider
+        for _ in range(2):
+            oauth2.get_token_key(oauth2.Provider(provider))
+
+    def cached() -> None:
+        for _ in range(3):
+            provider = oauth2.get_upstream_provider(config)
+        assert provider
+        for _ in range(2):
+            oauth2.get_token_key(provider)
+
+    for name, func in (("uncached", uncached), ("cached", cached)):
+        elapsed = min(timeit.repeat(func, number=args.number, repeat=3))
+        print(f"{name:<10} {elapsed / args.number * 1e6:8.2f} us per connection")
+
+
+if __name__ == "__main__":
+    main()
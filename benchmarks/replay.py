@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Record sessions of a scripted client through the server, check that the
+# records carry no credentials, and play them back with `oauth2imap replay`.
+#
+
+import argparse
+import asyncio
+import base64
+import glob
+import gzip
+import os.path
+import subprocess
+import sys
+import time
+
+import common
+
+
+async def drive(env: common.Environment, args: argparse.Namespace) -> None:
+    client = await common.Client.connect(env.downstream_port)
+    await client.login()
+
+    await client.command("SELECT INBOX")
+    await client.pipeline([f"FETCH {num} (FLAGS BODY.PEEK[HEADER])" for num in range(1, 11)])
+    for num in range(1, args.big_messages + 1):
+        await client.command(f"FETCH {num} (BODY.PEEK[])")
+    await client.append("INBOX", b"Subject: replay\r\n\r\n" + b"x" * 65536)
+    await client.command("UID SEARCH ALL")
+    await client.command("LOGIN someone else")
+    await client.logout()
+    await client.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="record and replay a session")
+    parser.add_argument("--engine", default="fork")
+    parser.add_argument("--big-messages", type=int, default=4)
+    parser.add_argument("--size", type=int, default=2**20, help="size of the messages.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with common.Environment(messages=10, size=args.size) as env:
+        recdir = os.path.join(env.home, "records")
+        env.config["record"] = {"dir": recdir}
+        env.write_config()
+
+        env.start_upstream()
+        server = env.start_server("--engine", args.engine)
+
+        asyncio.run(drive(env, args))
+
+        # The server closes the record once the session is over.
+        time.sleep(0.5)
+        server.terminate()
+        server.wait()
+
+        files = sorted(glob.glob(os.path.join(recdir, "*.rec.gz")))
+        if not files:
+            print("no session was recorded", file=sys.stderr)
+            return 1
+
+        secrets = (common.DOWNSTREAM_PASSWORD.encode(), b"bench-access-token", b"else",
+                   base64.b64encode(b"user=user@example.com\x01auth=Bearer bench-access-token\x01\x01"))
+        for path in files:
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            print(f"{os.path.basename(path)}: {os.path.getsize(path)} bytes compressed, "
+                  f"{len(data)} bytes")
+            for secret in secrets:
+                if secret in data:
+                    print(f"{path}: record has {secret!r}", file=sys.stderr)
+                    return 1
+
+        return subprocess.run([sys.executable, "-m", "oauth2imap.command", "replay",
+                               "--repeat", str(args.repeat), *files],
+                              env=env.env(), check=False).returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
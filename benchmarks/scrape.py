@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Check that the metrics endpoint adds up what the sessions did in either
+# engine and measure what counting costs a busy session.
+#
+
+import argparse
+import asyncio
+import time
+import urllib.request
+
+from typing import Dict, Tuple
+
+import common
+
+
+async def one_connection(port: int, fetches: int) -> int:
+    client = await common.Client.connect(port)
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+        for num in range(fetches):
+            await client.command(f"FETCH {num % 10 + 1} (FLAGS)")
+        await client.logout()
+    finally:
+        await client.close()
+    return client.received
+
+
+async def drive(port: int, connections: int, fetches: int) -> Tuple[float, int]:
+    start = time.monotonic()
+    received = await asyncio.gather(*[one_connection(port, fetches) for _ in range(connections)])
+    return time.monotonic() - start, sum(received)
+
+
+def scrape(port: int) -> Dict[str, float]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+        text = response.read().decode()
+
+    values: Dict[str, float] = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+def run(engine: str, connections: int, fetches: int, metrics_port: int | None) -> float:
+    config = {"metrics": {"port": metrics_port}} if metrics_port else None
+
+    with common.Environment(messages=10, config=config) as env:
+        env.start_upstream()
+        env.start_server("--engine", engine)
+
+        elapsed, received = asyncio.run(drive(env.downstream_port, connections, fetches))
+
+        if metrics_port:
+            # Forked children flush when they exit.
+            time.sleep(0.5)
+            values = scrape(metrics_port)
+
+            fetch = values.get('oauth2imap_command_duration_seconds_count{command="FETCH"}', 0)
+            sent = values.get('oauth2imap_sent_bytes_total{direction="downstream"}', 0)
+
+            # One more connection is made by the wait for the port to open.
+            print(f"{engine}: connections={values['oauth2imap_connections_total']:g}"
+                  f" (expected {connections + 1})"
+                  f" fetch={fetch:g} (expected {connections * fetches})"
+                  f" active={values['oauth2imap_sessions_active']:g}"
+                  f" downstream bytes={sent:g} (client got {received})")
+
+    return connections * fetches / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="metrics endpoint consistency and overhead")
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--fetches", type=int, default=500)
+    args = parser.parse_args()
+
+    for engine in ("fork", "asyncio"):
+        without = run(engine, args.connections, args.fetches, None)
+        with_metrics = run(engine, args.connections, args.fetches, common.free_port())
+        print(f"{engine}: {without:.0f} commands/s without metrics,"
+              f" {with_metrics:.0f} commands/s with metrics")
+
+
+if __name__ == "__main__":
+    main()
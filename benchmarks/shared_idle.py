@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Many clients in IDLE on the same mailbox, with and without sharing the
+# upstream IDLE: the upstream connections open while they wait, how soon each
+# of them hears of the messages another client appends, and that the message
+# numbers they know match the server's once they are done.
+#
+
+import argparse
+import asyncio
+import sys
+import time
+
+from typing import List, Tuple
+
+import common
+
+
+def upstream_connections(port: int) -> int:
+    # Established connections to the fake upstream server.
+    count = 0
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path, encoding="ascii") as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == "01" and int(fields[2].rsplit(":", 1)[1], 16) == port:
+                        count += 1
+        except OSError:
+            pass
+    return count
+
+
+async def wait_exists(client: common.Client, exists: int) -> float:
+    while True:
+        line = await client.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line == f"* {exists} EXISTS\r\n".encode():
+            return time.monotonic()
+
+
+async def drive(env: common.Environment, args: argparse.Namespace) -> Tuple[int, List[float], float]:
+    clients = [await common.Client.connect(env.downstream_port) for _ in range(args.clients)]
+
+    for client in clients:
+        await client.login()
+        await client.command("SELECT INBOX")
+        client.writer.write(b"I IDLE\r\n")
+        await client.writer.drain()
+        line = await client.reader.readline()
+        if not line.startswith(b"+"):
+            raise ConnectionError(f"IDLE refused: {line!r}")
+
+    # The connections given up are closed or back in the pool by now.
+    await asyncio.sleep(1)
+    connections = upstream_connections(env.upstream_port)
+
+    appender = await common.Client.connect(env.downstream_port)
+    await appender.login()
+
+    delays: List[float] = []
+    for num in range(1, args.rounds + 1):
+        waiters = [asyncio.create_task(wait_exists(client, args.messages + num)) for client in clients]
+        await appender.append("INBOX", b"Subject: new\r\n\r\nnew message\r\n")
+        appended = time.monotonic()
+        delays.extend(max(0.0, seen - appended) for seen in await asyncio.gather(*waiters))
+
+    await appender.logout()
+    await appender.close()
+
+    # Done with IDLE, everybody knows the same messages as the server.
+    start = time.monotonic()
+    for client in clients:
+        client.writer.write(b"DONE\r\n")
+        await client.writer.drain()
+        while True:
+            line = await client.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            if line.startswith(b"I "):
+                break
+        if not line.startswith(b"I OK"):
+            raise ConnectionError(f"IDLE failed: {line!r}")
+    done = (time.monotonic() - start) / len(clients)
+
+    last = args.messages + args.rounds
+    for client in clients:
+        client.tagnum += 1
+        client.writer.write(f"B{client.tagnum} FETCH {last} (UID)\r\n".encode())
+        await client.writer.drain()
+        found = False
+        while True:
+            line = await client.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed")
+            found = found or line.startswith(f"* {last} FETCH (UID {last} ".encode())
+            if line.startswith(f"B{client.tagnum} ".encode()):
+                break
+        if not found:
+            raise ValueError(f"message {last} is not where the client expects it")
+
+        await client.logout()
+        await client.close()
+
+    return connections, delays, done
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="clients in IDLE on one mailbox")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=5, help="messages appended.")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--pool", type=int, default=4, help="pooled connections per account.")
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency (ms).")
+    args = parser.parse_args()
+
+    print(f"{'shared':<7} {'upstream':>9} {'notify p50 ms':>14} {'notify max ms':>14} "
+          f"{'DONE ms':>8}")
+
+    for shared in (False, True):
+        with common.Environment(messages=args.messages, latency=args.latency,
+                                config={"idle": {"shared": shared},
+                                        "pool": {"size": args.pool}}) as env:
+            env.fakeimap_args.append("--keep-appended")
+            env.start_upstream()
+            env.start_server("--engine", "asyncio")
+
+            connections, delays, done = asyncio.run(drive(env, args))
+
+        print(f"{'on' if shared else 'off':<7} {connections:>9} "
+              f"{common.percentile(delays, 50) * 1000:>14.1f} {max(delays) * 1000:>14.1f} "
+              f"{done * 1000:>8.1f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
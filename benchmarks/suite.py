@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Run the standard set of measurements against both server engines and the
+# tunnel: connection rate, FETCH throughput, command latency and memory per
+# session. The results can be saved and compared with a saved baseline to
+# catch regressions.
+#
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from typing import Awaitable, Callable, Dict, List
+
+import common
+
+MODES = ("fork", "asyncio", "tunnel")
+
+# What is better for each result: "+" higher, "-" lower.
+RESULTS = {
+    "conn/s":         "+",
+    "fetch MiB/s":    "+",
+    "p50 ms":         "-",
+    "p99 ms":         "-",
+    "RSS/session KiB": "-",
+}
+
+
+def connect(env: common.Environment, mode: str) -> Callable[[], Awaitable[common.Client]]:
+    async def server() -> common.Client:
+        client = await common.Client.connect(env.downstream_port)
+        await client.login()
+        return client
+
+    async def tunnel() -> common.Client:
+        return await env.start_tunnel()
+
+    if mode == "tunnel":
+        return tunnel
+
+    env.start_server("--engine", mode)
+    return server
+
+
+async def close(client: common.Client) -> None:
+    await client.logout()
+    await client.close()
+
+
+async def connections(env: common.Environment, mode: str, args: argparse.Namespace) -> float:
+    open_client = connect(env, mode)
+    todo = list(range(args.connections))
+
+    async def worker() -> None:
+        while todo:
+            todo.pop()
+            client = await open_client()
+            await client.command("SELECT INBOX")
+            await close(client)
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    return args.connections / (time.monotonic() - start)
+
+
+async def fetch(env: common.Environment, mode: str, args: argparse.Namespace) -> float:
+    client = await connect(env, mode)()
+    await client.command("SELECT INBOX")
+
+    received = client.received
+    start = time.monotonic()
+    for num in range(1, args.big_messages + 1):
+        await client.command(f"FETCH {num} (BODY.PEEK[])")
+    elapsed = time.monotonic() - start
+
+    await close(client)
+    return (client.received - received) / elapsed / 2**20
+
+
+async def latency(env: common.Environment, mode: str, args: argparse.Namespace) -> List[float]:
+    client = await connect(env, mode)()
+    await client.command("SELECT INBOX")
+
+    workload = ["NOOP", "FETCH {} (FLAGS)", "FETCH {} (BODY.PEEK[HEADER])", "UID FETCH {} (FLAGS)",
+                "STATUS INBOX (MESSAGES UNSEEN)", "SEARCH ALL"]
+    times: List[float] = []
+
+    for num in range(args.commands):
+        cmd = workload[num % len(workload)].format(num % 10 + 1)
+        start = time.monotonic()
+        await client.command(cmd)
+        times.append(time.monotonic() - start)
+
+    await close(client)
+    return times
+
+
+async def memory(env: common.Environment, mode: str, args: argparse.Namespace) -> float:
+    open_client = connect(env, mode)
+
+    if mode == "tunnel":
+        baseline = 0
+    else:
+        # Let the server settle after the first connection.
+        await close(await open_client())
+        await asyncio.sleep(0.2)
+        baseline = common.rss_kb(env.procs[-1].pid)
+
+    clients = [await open_client() for _ in range(args.sessions)]
+    for client in clients:
+        await client.command("SELECT INBOX")
+        await client.command("FETCH 1:10 (FLAGS)")
+
+    await asyncio.sleep(0.2)
+
+    if mode == "tunnel":
+        total = sum(common.rss_kb(client.proc.pid) for client in clients if client.proc)
+    else:
+        total = common.rss_kb(env.procs[-1].pid)
+
+    for client in clients:
+        await close(client)
+
+    return (total - baseline) / args.sessions
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> Dict[str, float]:
+    res: Dict[str, float] = {}
+
+    with common.Environment(messages=10) as env:
+        env.start_upstream()
+        res["conn/s"] = asyncio.run(connections(env, mode, args))
+
+    with common.Environment(messages=args.big_messages, size=args.size) as env:
+        env.start_upstream()
+        res["fetch MiB/s"] = asyncio.run(fetch(env, mode, args))
+
+    with common.Environment(messages=10, latency=args.latency) as env:
+        env.start_upstream()
+        times = asyncio.run(latency(env, mode, args))
+        res["p50 ms"] = common.percentile(times, 50) * 1000
+        res["p99 ms"] = common.percentile(times, 99) * 1000
+
+    with common.Environment(messages=10) as env:
+        env.start_upstream()
+        res["RSS/session KiB"] = asyncio.run(memory(env, mode, args))
+
+    return res
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="the standard benchmark suite")
+    parser.add_argument("--mode", action="append", dest="modes", choices=MODES,
+                        help="mode to measure (default: all).")
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--big-messages", type=int, default=4)
+    parser.add_argument("--size", type=int, default=8 * 2**20, help="size of the fetched messages.")
+    parser.add_argument("--commands", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0, help="upstream latency (ms).")
+    parser.add_argument("--sessions", type=int, default=20, help="sessions held for the memory use.")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE.")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with results saved earlier.")
+    parser.add_argument("--tolerance", type=float, default=10,
+                        help="change in percent reported as a regression.")
+    args = parser.parse_args()
+
+    baseline: Dict[str, Dict[str, float]] = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results: Dict[str, Dict[str, float]] = {}
+    regressions = 0
+
+    print(f"{'mode':<8}", *[f"{name:>16}" for name in RESULTS])
+
+    for mode in args.modes or MODES:
+        results[mode] = run_mode(mode, args)
+
+        row = [f"{mode:<8}"]
+        for name, better in RESULTS.items():
+            value = results[mode][name]
+            cell = f"{value:.1f}"
+
+            old = baseline.get(mode, {}).get(name)
+            if old:
+                change = (value - old) / old * 100
+                cell += f" ({change:+.0f}%)"
+                if (change if better == "-" else -change) > args.tolerance:
+                    cell += "!"
+                    regressions += 1
+
+            row.append(f"{cell:>16}")
+        print(*row)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    if regressions:
+        print(f"{regressions} results are worse than the baseline by more than {args.tolerance:g}%",
+              file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
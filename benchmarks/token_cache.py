@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure the token store: writes while filling it with many accounts, then
+# reads while another thread keeps replacing the token of one of them.
+#
+
+import argparse
+import os.path
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+import common  # pylint: disable=unused-import
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.oauth2 as oauth2
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="tokens file reads")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=3, help="seconds to read.")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--writes-per-sec", type=float, default=1,
+                        help="token updates per second during the reads.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="oauth2imap-bench-") as tmpdir:
+        config: Dict[str, Any] = {
+            "upstream": {
+                "provider": "microsoft",
+                "tokens-file": ("sqlite://" if args.backend == "sqlite" else "") +
+                               os.path.join(tmpdir, "tokens"),
+            },
+        }
+        expiration = (datetime.now() + timedelta(days=1)).isoformat()
+
+        start = time.monotonic()
+        for num in range(args.accounts):
+            config["upstream"]["username"] = f"user{num}@example.com"
+            provider = oauth2.get_upstream_provider(config)
+            assert provider
+            oauth2.write_token(config, provider, oauth2.Token({
+                "access_token": f"access-{num}",
+                "access_token_expiration": expiration,
+                "refresh_token": f"refresh-{num}",
+            }))
+
+        filled = time.monotonic() - start
+
+        provider = oauth2.get_upstream_provider(config)
+        assert provider
+
+        done = threading.Event()
+        writes = 0
+
+        def writer() -> None:
+            nonlocal writes
+            while not done.wait(1 / args.writes_per_sec):
+                writes += 1
+                oauth2.write_token(config, provider, oauth2.Token({
+                    "access_token": f"access-{writes}",
+                    "access_token_expiration": expiration,
+                    "refresh_token": "refresh",
+                }))
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+
+        reads = 0
+        start = time.monotonic()
+        try:
+            while time.monotonic() - start < args.duration:
+                if not oauth2.read_token(config, provider):
+                    raise RuntimeError("token is missing")
+                reads += 1
+        finally:
+            elapsed = time.monotonic() - start
+            done.set()
+            thread.join()
+
+        print(f"accounts:   {args.accounts}")
+        print(f"file size:  {os.path.getsize(os.path.join(tmpdir, 'tokens'))}")
+        print(f"fill:       {args.accounts / filled:.0f} writes/s")
+        print(f"writes:     {writes}")
+        print(f"reads/s:    {reads / elapsed:.0f}")
+        print(f"per read:   {elapsed / reads * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Check that concurrent sessions refresh an expired token only once.
+#
+# Several processes, each with several threads, ask for an access token
+# at the same moment while the stored one has expired. The token endpoint
+# counts the refresh requests it receives.
+#
+
+import argparse
+import multiprocessing
+import os.path
+import sys
+import threading
+import time
+
+from datetime import timedelta
+from typing import Any, Dict, List
+
+import common
+
+# pylint: disable-next=wrong-import-position
+import oauth2imap.oauth2 as oauth2
+
+
+def worker(config: Dict[str, Any], threads: int, start: Any, results: Any) -> None:
+    tokens: List[str | None] = []
+
+    def get() -> None:
+        start.wait()
+        tokens.append(oauth2.get_access_token(config))
+
+    pool = [threading.Thread(target=get) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    results.put(tokens)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="concurrent token refresh")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="token endpoint response time (seconds).")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    args = parser.parse_args()
+
+    with common.Environment(token_delay=args.delay) as env:
+        server = env.token
+        if args.backend == "sqlite":
+            env.config["upstream"]["tokens-file"] = "sqlite://" + os.path.join(env.home, "tokens.db")
+        env.write_tokens(expires=timedelta(seconds=-1))
+
+        ctx = multiprocessing.get_context("fork")
+        start = ctx.Barrier(args.processes)
+        results = ctx.Queue()
+
+        procs = [ctx.Process(target=worker, args=(env.config, args.threads, start, results))
+                 for _ in range(args.processes)]
+
+        began = time.monotonic()
+        for p in procs:
+            p.start()
+
+        tokens: List[str | None] = []
+        for _ in procs:
+            tokens.extend(results.get())
+        for p in procs:
+            p.join()
+        elapsed = time.monotonic() - began
+
+    print(f"callers:          {len(tokens)}")
+    print(f"refresh requests: {server.requests}")
+    print(f"distinct tokens:  {len(set(tokens))}")
+    print(f"elapsed:          {elapsed:.3f}s")
+
+    if server.requests != 1 or len(set(tokens)) != 1 or None in tokens:
+        print("FAIL", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
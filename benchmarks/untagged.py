@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# Measure a large untagged response: FETCH 1:* (FLAGS) over a big mailbox.
+#
+# Besides the time, the number of TCP segments sent in the network
+# namespace is reported. Every write to a socket with TCP_NODELAY goes out
+# as at least one segment, so it follows the number of writes of the proxy
+# (plus the segments of the upstream server and the ACKs of the client).
+#
+
+import argparse
+import asyncio
+import time
+
+from typing import Tuple
+
+import common
+
+
+def tcp_out_segments() -> int:
+    with open("/proc/net/snmp", encoding="utf-8") as f:
+        rows = [line.split() for line in f if line.startswith("Tcp:")]
+    return int(dict(zip(rows[0], rows[1]))["OutSegs"])
+
+
+async def fetch_flags(port: int, repeat: int) -> Tuple[float, int, int]:
+    client = await common.Client.connect(port)
+    try:
+        await client.login()
+        await client.command("SELECT INBOX")
+
+        before = tcp_out_segments()
+        start = time.monotonic()
+
+        for _ in range(repeat):
+            await client.command("FETCH 1:* (FLAGS)")
+
+        elapsed = time.monotonic() - start
+        after = tcp_out_segments()
+
+        await client.logout()
+    finally:
+        await client.close()
+
+    return elapsed, after - before, client.received
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="large untagged responses")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with common.Environment(messages=args.messages, size=256) as env:
+        env.start_upstream()
+        env.start_server("--engine", "asyncio")
+
+        elapsed, segments, received = asyncio.run(
+                fetch_flags(env.downstream_port, args.repeat))
+
+    lines = args.messages * args.repeat
+
+    print(f"responses:   {lines} lines, {received / 2**20:.1f} MiB")
+    print(f"elapsed:     {elapsed:.3f}s ({lines / elapsed:.0f} lines/s)")
+    print(f"segments:    {segments} ({segments / lines:.3f} per line)")
+
+
+if __name__ == "__main__":
+    main()
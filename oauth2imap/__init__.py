@@ -1,14 +1,22 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
 
+import os
 import os.path
+import atexit
+import queue
 import logging
+import logging.handlers
 
 __VERSION__ = '1'
 
 EX_SUCCESS = 0 # Successful exit status.
 EX_FAILURE = 1 # Failing exit status.
 
+# Below DEBUG: the protocol data itself, literals included.
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
 logger = logging.getLogger("oauth2imap")
 
 class Error:
@@ -16,6 +24,48 @@ class Error:
         self.message = message
 
 
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue never leaves the process, so the message is formatted by
+        # the writer thread instead of the thread that logs it.
+        return record
+
+
+log_listener: logging.handlers.QueueListener | None = None
+
+
+def start_log_listener(handler: logging.Handler) -> logging.handlers.QueueListener:
+    global log_listener
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+
+    for old in list(logger.handlers):
+        if isinstance(old, LogQueueHandler):
+            logger.removeHandler(old)
+
+    logger.addHandler(LogQueueHandler(log_queue))
+
+    log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    log_listener.start()
+
+    return log_listener
+
+
+def flush_logger() -> None:
+    # Writes out what has been logged so far. Must be called before os._exit().
+    global log_listener
+
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+def __restart_log_listener() -> None:
+    # The writer thread is not inherited by a child, its queue is.
+    if log_listener:
+        start_log_listener(log_listener.handlers[0])
+
+
 def setup_logger(logger: logging.Logger, level: int, fmt: str,
                  logfile: str | None) -> logging.Logger:
     formatter = logging.Formatter(fmt=fmt)
@@ -32,6 +82,16 @@ def setup_logger(logger: logging.Logger, level: int, fmt: str,
     handler.setFormatter(formatter)
 
     logger.setLevel(level)
-    logger.addHandler(handler)
+
+    #
+    # Records are handed to a background thread that formats and writes
+    # them, so neither the event loop nor a session waits for the disk or
+    # the terminal.
+    #
+    start_log_listener(handler)
 
     return logger
+
+
+atexit.register(flush_logger)
+os.register_at_fork(after_in_child=__restart_log_listener)
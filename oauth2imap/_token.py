@@ -4,6 +4,7 @@
 
 __author__ = 'Alexey Gladkov <legion@kernel.org>'
 
+import os.path
 import argparse
 import socket
 import secrets
@@ -18,6 +19,7 @@ from typing import Dict, Any
 import oauth2imap
 import oauth2imap.config
 import oauth2imap.oauth2 as oauth2
+import oauth2imap.tokenstore as tokenstore
 
 logger = oauth2imap.logger
 
@@ -76,14 +78,42 @@ def get_available_port() -> int:
     return int(port)
 
 
-# pylint: disable-next=unused-argument
+def migrate(config: Dict[str,Any], filename: str) -> int:
+    source = tokenstore.JsonStore(os.path.expanduser(filename))
+    target = oauth2.get_token_store(config)
+
+    tokens = source.items()
+
+    with target.lease():
+        for token_key, token in tokens.items():
+            target.put(token_key, token)
+
+    logger.info("%d tokens migrated from `%s'", len(tokens), filename)
+    return oauth2imap.EX_SUCCESS
+
+
+def show_expiring(config: Dict[str,Any], minutes: float) -> int:
+    for token_key, token in oauth2.get_token_store(config).expiring(minutes * 60).items():
+        print(token_key, token.get("access_token_expiration", ""))
+    return oauth2imap.EX_SUCCESS
+
+
 def main(cmdargs: argparse.Namespace) -> int:
     config = oauth2imap.config.read()
 
+    if not isinstance(config, oauth2imap.Error):
+        config = oauth2imap.config.select(config, cmdargs.account)
+
     if isinstance(config, oauth2imap.Error):
         logger.critical("%s", config.message)
         return oauth2imap.EX_FAILURE
 
+    if cmdargs.migrate_from:
+        return migrate(config, cmdargs.migrate_from)
+
+    if cmdargs.expiring is not None:
+        return show_expiring(config, cmdargs.expiring)
+
     provider = oauth2.get_upstream_provider(config)
     if not provider:
         return oauth2imap.EX_FAILURE
@@ -12,43 +12,46 @@ import os
 import random
 import time
 
-from typing import Callable, Tuple
+from typing import Awaitable, Callable, List, Tuple
 
 import oauth2imap
 
 logger = oauth2imap.logger
 
-def cram_md5(user: str, password: str, interact: Callable[[str], str]) -> Tuple[bool, str]:
+async def cram_md5(passwords: Callable[[str], str | None],
+                   interact: Callable[[str], Awaitable[str]]) -> Tuple[bool, str, str]:
     pid = os.getpid()
     now = time.time_ns()
     rnd = random.randrange(2**32 - 1)
     shared = f"<{pid}.{now}.{rnd}@oauth2imap>"
 
-    line = interact(base64.b64encode(shared.encode()).decode())
+    line = await interact(base64.b64encode(shared.encode()).decode())
 
     try:
         buf = base64.standard_b64decode(line).decode()
     except binascii.Error:
-        return (False, "couldn't decode your credentials")
+        return (False, "couldn't decode your credentials", "")
 
     fields = buf.split(" ")
 
     if len(fields) != 2:
-        return (False, "wrong number of fields in the token")
+        return (False, "wrong number of fields in the token", "")
 
-    hexdigest = hmac.new(password.encode(),
+    # The user names the password the digest is made with.
+    password = passwords(fields[0])
+
+    hexdigest = hmac.new((password or "").encode(),
                          shared.encode(),
                          hashlib.md5).hexdigest()
 
-    if hmac.compare_digest(user, fields[0]) and hmac.compare_digest(hexdigest, fields[1]):
-        return (True, "authentication successful")
+    if password is not None and hmac.compare_digest(hexdigest, fields[1]):
+        return (True, "authentication successful", fields[0])
 
-    return (False, "authenticate failure")
+    return (False, "authenticate failure", "")
 
 
-def plain(user: str, password: str, arg: str) -> Tuple[bool, str]:
+def plain(user: str, password: str, given: List[str]) -> Tuple[bool, str]:
     known = [ user, password ]
-    given = arg.split(" ", 1)
     valid = 0
 
     for i,_ in enumerate(known):
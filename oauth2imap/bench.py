@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import random
+import time
+
+from typing import Dict, List, Tuple, Any
+
+import oauth2imap
+import oauth2imap.config
+
+logger = oauth2imap.logger
+
+CRLF = b"\r\n"
+
+# Operations of the workload and their default weights. APPEND is left out
+# unless asked for because it changes the mailbox.
+WORKLOAD = {
+    "select":  1.0,
+    "search":  2.0,
+    "headers": 4.0,
+    "body":    2.0,
+    "idle":    0.5,
+    "append":  0.0,
+}
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.times: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.received = 0
+
+    def add(self, name: str, seconds: float) -> None:
+        self.times.setdefault(name, []).append(seconds)
+
+    def error(self, name: str) -> None:
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class Client:
+    """A downstream client of the proxy doing the operations of the workload."""
+
+    def __init__(self, num: int, args: argparse.Namespace, stats: Stats):
+        self.num = num
+        self.args = args
+        self.stats = stats
+        self.tagnum = 0
+        self.exists = 0
+        self.reader: asyncio.StreamReader
+        self.writer: asyncio.StreamWriter
+
+    async def readline(self) -> bytes:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("server closed the connection")
+
+        self.stats.received += len(line)
+        return line
+
+    async def send(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def next_tag(self) -> bytes:
+        self.tagnum += 1
+        return b"C%d" % self.tagnum
+
+    async def wait(self, tag: bytes) -> Tuple[bytes, List[bytes]]:
+        # Reads up to the tagged completion, skipping literals.
+        untagged: List[bytes] = []
+
+        while True:
+            line = await self.readline()
+
+            if line.endswith(b"}" + CRLF):
+                size = int(line[line.rindex(b"{") + 1:-3])
+                await self.reader.readexactly(size)
+                self.stats.received += size
+
+            if line.startswith(tag + b" "):
+                return line.split(b" ", 2)[1], untagged
+
+            untagged.append(line)
+
+    async def command(self, cmd: str) -> Tuple[bytes, List[bytes]]:
+        tag = self.next_tag()
+        await self.send(tag + b" " + cmd.encode() + CRLF)
+        return await self.wait(tag)
+
+    async def login(self) -> bool:
+        greeting = await self.readline()
+        if not greeting.startswith(b"* OK"):
+            return False
+
+        user, password = self.args.username, self.args.password
+
+        if self.args.auth == "login":
+            status, _ = await self.command(f"LOGIN {user} {password}")
+            return status == b"OK"
+
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc2195#section-2
+        #
+        # The data encoded in the first ready response contains a
+        # presumptively arbitrary string of random digits, a timestamp, and
+        # the fully-qualified primary host name of the server.
+        #
+        tag = self.next_tag()
+        await self.send(tag + b" AUTHENTICATE CRAM-MD5" + CRLF)
+
+        line = await self.readline()
+        if not line.startswith(b"+ "):
+            return False
+
+        challenge = base64.b64decode(line[2:].strip())
+        digest = hmac.new(password.encode(), challenge, hashlib.md5).hexdigest()
+
+        await self.send(base64.b64encode(f"{user} {digest}".encode()) + CRLF)
+
+        status, _ = await self.wait(tag)
+        return status == b"OK"
+
+    async def select(self) -> bytes:
+        status, untagged = await self.command(f"SELECT {self.args.mailbox}")
+        for line in untagged:
+            words = line.split()
+            if len(words) == 3 and words[2].upper() == b"EXISTS":
+                self.exists = int(words[1])
+        return status
+
+    def message(self) -> int:
+        return random.randint(1, self.exists) if self.exists else 1
+
+    async def idle(self) -> bytes:
+        tag = self.next_tag()
+        await self.send(tag + b" IDLE" + CRLF)
+
+        line = await self.readline()
+        if not line.startswith(b"+"):
+            return line.split(b" ", 2)[1]
+
+        await asyncio.sleep(self.args.idle_time)
+        await self.send(b"DONE" + CRLF)
+
+        status, _ = await self.wait(tag)
+        return status
+
+    async def append(self) -> bytes:
+        size = self.args.append_size
+        body = (b"From: bench@oauth2imap\r\nSubject: oauth2imap bench\r\n\r\n" +
+                b"x" * size)[:max(size, 64)]
+
+        tag = self.next_tag()
+        await self.send(tag + b" APPEND %s {%d}" % (self.args.mailbox.encode(), len(body)) + CRLF)
+
+        line = await self.readline()
+        if not line.startswith(b"+"):
+            return line.split(b" ", 2)[1]
+
+        await self.send(body + CRLF)
+
+        status, _ = await self.wait(tag)
+        return status
+
+    async def operation(self, name: str) -> bytes:
+        match name:
+            case "select":
+                return await self.select()
+            case "search":
+                status, _ = await self.command("UID SEARCH ALL")
+                return status
+            case "headers":
+                status, _ = await self.command(f"FETCH {self.message()} (BODY.PEEK[HEADER])")
+                return status
+            case "body":
+                status, _ = await self.command(f"FETCH {self.message()} (BODY.PEEK[])")
+                return status
+            case "idle":
+                return await self.idle()
+            case "append":
+                return await self.append()
+        raise ValueError(name)
+
+    async def run(self, pacer: "Pacer", deadline: float, mix: List[Tuple[str, float]]) -> None:
+        names = [name for name, _ in mix]
+        weights = [weight for _, weight in mix]
+
+        start = time.monotonic()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port,
+                                                                     limit=2**24)
+            if not await self.login():
+                self.stats.error("login")
+                return
+            self.stats.add("login", time.monotonic() - start)
+
+            if await self.select() != b"OK":
+                self.stats.error("select")
+                return
+
+            while True:
+                if not await pacer.wait(deadline):
+                    break
+
+                name = random.choices(names, weights)[0]
+
+                start = time.monotonic()
+                status = await self.operation(name)
+
+                if status == b"OK":
+                    self.stats.add(name, time.monotonic() - start)
+                else:
+                    self.stats.error(name)
+
+            await self.command("LOGOUT")
+
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            logger.warning("client %d: %s", self.num, e)
+            self.stats.error("connection")
+
+        finally:
+            if hasattr(self, "writer"):
+                self.writer.close()
+
+
+class Pacer:
+    """Spreads the operations of all the clients at a fixed rate, if one is set."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next = time.monotonic()
+
+    async def wait(self, deadline: float) -> bool:
+        now = time.monotonic()
+
+        if self.interval:
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+            if slot >= deadline:
+                return False
+            await asyncio.sleep(slot - now)
+            return True
+
+        return now < deadline
+
+
+def parse_mix(text: str) -> List[Tuple[str, float]]:
+    weights = dict(WORKLOAD)
+
+    for item in filter(None, text.split(",")):
+        name, _, weight = item.partition("=")
+        if name.strip() not in WORKLOAD:
+            raise ValueError(f"unknown operation '{name.strip()}'")
+        weights[name.strip()] = float(weight or 1)
+
+    return [(name, weight) for name, weight in weights.items() if weight > 0]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(stats: Stats, elapsed: float) -> None:
+    ops = sum(len(v) for k, v in stats.times.items() if k != "login")
+
+    print(f"duration:   {elapsed:.1f}s")
+    print(f"operations: {ops} ({ops / elapsed:.1f}/s)")
+    print(f"received:   {stats.received / 2**20:.1f} MiB ({stats.received / 2**20 / elapsed:.1f} MiB/s)")
+    print()
+    print(f"{'operation':<10} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+
+    for name in ["login"] + list(WORKLOAD):
+        times = stats.times.get(name, [])
+        errors = stats.errors.get(name, 0)
+        if not times and not errors:
+            continue
+
+        cells = [f"{percentile(times, p) * 1000:>9.1f}" for p in (50, 90, 99)] if times else [f"{'-':>9}"] * 3
+        cells.append(f"{max(times) * 1000:>9.1f}" if times else f"{'-':>9}")
+
+        print(f"{name:<10} {len(times):>7} {errors:>7}", *cells)
+
+    if stats.errors.get("connection"):
+        print(f"\nconnections lost: {stats.errors['connection']}")
+
+
+def main(cmdargs: argparse.Namespace) -> int:
+    config: Dict[str, Any] = {}
+
+    if cmdargs.port is None or cmdargs.username is None or cmdargs.password is None:
+        read = oauth2imap.config.read()
+        if isinstance(read, oauth2imap.Error):
+            logger.critical("%s: use --port, --username and --password", read.message)
+            return oauth2imap.EX_FAILURE
+        config = read.get("downstream", {})
+
+    for param, key in (("host", "server"), ("port", "port"), ("username", "username"), ("password", "password")):
+        if getattr(cmdargs, param) is None:
+            if key not in config:
+                logger.critical("no %s given and none in the downstream config", param)
+                return oauth2imap.EX_FAILURE
+            setattr(cmdargs, param, config[key])
+
+    try:
+        mix = parse_mix(cmdargs.mix)
+    except ValueError as e:
+        logger.critical("bad workload mix: %s", e)
+        return oauth2imap.EX_FAILURE
+
+    stats = Stats()
+
+    async def run() -> float:
+        pacer = Pacer(cmdargs.rate)
+        start = time.monotonic()
+        deadline = start + cmdargs.duration
+
+        await asyncio.gather(*[Client(num, cmdargs, stats).run(pacer, deadline, mix)
+                               for num in range(cmdargs.clients)])
+
+        return time.monotonic() - start
+
+    try:
+        elapsed = asyncio.run(run())
+    except KeyboardInterrupt:
+        return oauth2imap.EX_FAILURE
+
+    report(stats, elapsed)
+
+    return oauth2imap.EX_FAILURE if stats.errors else oauth2imap.EX_SUCCESS
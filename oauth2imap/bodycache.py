@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import asyncio
+import hashlib
+import mmap
+import os
+import os.path
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import oauth2imap
+import oauth2imap.metrics as metrics
+
+logger = oauth2imap.logger
+
+# Seconds between updates of the last use of an entry on hits.
+TOUCH_INTERVAL = 60
+
+# Literals are given to the client in pieces of this size.
+CHUNK = 256 * 1024
+
+# A client command fetching the full body of one message by UID, after "UID".
+UID_FETCH_BODY = re.compile(rb"FETCH (\d+) (\([A-Z0-9.\[\] ]+\)|[A-Z0-9.\[\]]+)\r\n\Z", re.IGNORECASE)
+
+# Fetch items that give the full body, and the other items served along with it.
+BODY_ITEMS = {b"BODY[]": b"BODY[]", b"BODY.PEEK[]": b"BODY[]", b"RFC822": b"RFC822"}
+FETCH_ATTRIBUTES = (b"UID", b"FLAGS", b"INTERNALDATE", b"RFC822.SIZE")
+
+# The head of a FETCH response with the UID ahead of a full body literal.
+FETCH_BODY = re.compile(rb"\* \d+ FETCH \((?:.* )?UID (\d+) (?:.* )?(?:BODY\[\]|RFC822) \{\d+\}\r\n\Z")
+
+
+class BodyCache:
+    """Full message bodies on disk stored by their SHA-256 and indexed by UID."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            account     TEXT    NOT NULL,
+            mailbox     BLOB    NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            uid         INTEGER NOT NULL,
+            digest      TEXT    NOT NULL,
+            size        INTEGER NOT NULL,
+            used        REAL    NOT NULL,
+            PRIMARY KEY (account, mailbox, uidvalidity, uid)
+        );
+        CREATE INDEX IF NOT EXISTS messages_used ON messages (used);
+        CREATE INDEX IF NOT EXISTS messages_digest ON messages (digest);
+
+        -- The size of all the messages, kept up to date as they come and go.
+        CREATE TABLE IF NOT EXISTS total (
+            size        INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_added AFTER INSERT ON messages BEGIN
+            UPDATE total SET size = size + NEW.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_removed AFTER DELETE ON messages BEGIN
+            UPDATE total SET size = size - OLD.size;
+        END;
+        INSERT INTO total (size)
+            SELECT (SELECT COALESCE(SUM(size), 0) FROM messages) WHERE NOT EXISTS (SELECT 1 FROM total);
+    """
+
+    def __init__(self, path: str, size: int, message_size: int):
+        self.path = path
+        # Bytes of bodies kept.
+        self.size = size
+        # Larger bodies are not kept.
+        self.message_size = message_size
+        self.local = threading.local()
+
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def db(self) -> sqlite3.Connection:
+        # Connections are not shared between threads or inherited by children.
+        conn: sqlite3.Connection | None = getattr(self.local, "conn", None)
+
+        if conn and getattr(self.local, "pid", 0) == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(os.path.join(self.path, "index.db"), timeout=30,
+                               isolation_level=None)
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        #
+        # From: https://www.sqlite.org/lang_conflict.html
+        #
+        # When the REPLACE conflict resolution strategy deletes rows in order
+        # to satisfy a constraint, delete triggers fire if and only if
+        # recursive triggers are enabled.
+        #
+        conn.execute("PRAGMA recursive_triggers=ON")
+        # The total is counted once, by whoever creates it.
+        conn.executescript("BEGIN IMMEDIATE;" + self.schema + "COMMIT;")
+
+        self.local.conn = conn
+        self.local.pid  = os.getpid()
+
+        return conn
+
+    def body_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest)
+
+    def cacheable(self, size: int) -> bool:
+        return 0 < size <= self.message_size
+
+    def validate(self, account: str, mailbox: bytes, uidvalidity: int) -> None:
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.3.1.1
+        #
+        # If unique identifiers from an earlier session fail to persist in
+        # this session, the unique identifier validity value MUST be greater
+        # than the one used in the earlier session.
+        #
+        try:
+            db = self.db()
+
+            stale = db.execute("""
+                SELECT 1 FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity != ? LIMIT 1
+            """, (account, mailbox, uidvalidity)).fetchone()
+            if not stale:
+                return
+
+            logger.info("body cache: UIDVALIDITY of %r changed, dropping its messages", mailbox)
+
+            digests = [row[0] for row in db.execute("""
+                DELETE FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity != ?
+                RETURNING digest
+            """, (account, mailbox, uidvalidity))]
+
+            self.unlink_unused(digests)
+
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("body cache: unable to check UIDVALIDITY: %s", e)
+
+    def get(self, account: str, mailbox: bytes, uidvalidity: int, uid: int) -> mmap.mmap | None:
+        key = (account, mailbox, uidvalidity, uid)
+
+        try:
+            db = self.db()
+            row = db.execute("""
+                SELECT digest, used FROM messages
+                WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?
+            """, key).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("body cache: %s", e)
+            return None
+
+        if not row:
+            return None
+
+        digest, used = row
+        data: mmap.mmap | None = None
+
+        try:
+            try:
+                with open(self.body_path(digest), "rb") as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                logger.warning("body cache: %s: %s", digest, e)
+                db.execute("""
+                    DELETE FROM messages
+                    WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?
+                """, key)
+                return None
+
+            now = time.time()
+            if now - used > TOUCH_INTERVAL:
+                db.execute("""
+                    UPDATE messages SET used = ?
+                    WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?
+                """, (now,) + key)
+
+        except sqlite3.Error as e:
+            # Only the bookkeeping has failed.
+            logger.warning("body cache: %s", e)
+
+        return data
+
+    def put(self, account: str, mailbox: bytes, uidvalidity: int, uid: int,
+            chunks: List[bytes]) -> None:
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+
+        name = digest.hexdigest()
+        path = self.body_path(name)
+
+        try:
+            if not os.path.exists(path):
+                #
+                # Written aside and renamed, so a body is either complete or
+                # not there at all, whoever else is storing the same one.
+                #
+                os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".body-")
+                try:
+                    with os.fdopen(fd, "wb") as file:
+                        file.writelines(chunks)
+                    os.rename(tmpname, path)
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
+
+            self.db().execute("""
+                INSERT OR REPLACE INTO messages (account, mailbox, uidvalidity, uid, digest, size, used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (account, mailbox, uidvalidity, uid, name, size, time.time()))
+
+            self.evict()
+
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("body cache: unable to store a message: %s", e)
+
+    def evict(self) -> None:
+        db = self.db()
+
+        # Bodies shared by several messages are counted more than once.
+        total = db.execute("SELECT size FROM total").fetchone()[0]
+
+        digests = []
+        while total > self.size:
+            row = db.execute("""
+                DELETE FROM messages WHERE rowid = (SELECT rowid FROM messages ORDER BY used LIMIT 1)
+                RETURNING digest, size
+            """).fetchone()
+            if not row:
+                break
+            digests.append(row[0])
+            total -= row[1]
+
+        self.unlink_unused(digests)
+
+    def unlink_unused(self, digests: List[str]) -> None:
+        db = self.db()
+
+        for digest in set(digests):
+            if db.execute("SELECT 1 FROM messages WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                continue
+            try:
+                os.unlink(self.body_path(digest))
+            except FileNotFoundError:
+                pass
+
+
+class Session:
+    """The body cache as used by one client session."""
+
+    def __init__(self, cache: BodyCache, account: str):
+        self.cache   = cache
+        self.account = account
+
+        # The selected mailbox and its UIDVALIDITY.
+        self.mailbox: Tuple[bytes, int] | None = None
+
+        # Commands answered from the cache: the UID, the response item and the body.
+        self.hits: Dict[str, Tuple[bytes, bytes, mmap.mmap]] = {}
+
+    def select(self, name: bytes, uidvalidity: int) -> None:
+        self.mailbox = None
+
+        if name and uidvalidity:
+            self.mailbox = (name, uidvalidity)
+            # Nothing waits for it: the entries are looked up by UIDVALIDITY.
+            asyncio.get_running_loop().run_in_executor(
+                    None, self.cache.validate, self.account, name, uidvalidity)
+
+    async def fetch(self, tag: str, args: bytes) -> Tuple[bytes, bytes] | None:
+        #
+        # A full body of a message in the cache is not fetched again. The
+        # command becomes a FETCH of the UID and the other data asked for,
+        # which gives the sequence number of the message or nothing if it
+        # has been expunged, and the body is put into the response to it.
+        # It must be done only when nothing else is in flight, so the
+        # response is known to be for this command.
+        #
+        # Gives the command to send instead and the flags to set on the
+        # message along with it, if any.
+        #
+        if not self.mailbox:
+            return None
+
+        match = UID_FETCH_BODY.match(args)
+        if not match:
+            return None
+
+        uid = match.group(1)
+        items = match.group(2).strip(b"()").upper().split()
+        bodies = [item for item in items if item in BODY_ITEMS]
+
+        if len(bodies) != 1 or not all(item in BODY_ITEMS or item in FETCH_ATTRIBUTES for item in items):
+            return None
+
+        # The index and the file are not to hold up the other sessions.
+        data = await asyncio.get_running_loop().run_in_executor(
+                None, self.cache.get, self.account, self.mailbox[0], self.mailbox[1], int(uid))
+        if not data:
+            metrics.body_cache.inc(value="miss")
+            return None
+
+        metrics.body_cache.inc(value="hit")
+
+        attrs = [b"UID"] + [item for item in items if item in FETCH_ATTRIBUTES and item != b"UID"]
+        store = b""
+
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-6.4.5
+        #
+        # BODY[<section>]<<partial>>
+        #    The text of a particular body section. (...) The \Seen flag is
+        #    implicitly set; if this causes the flags to change, they SHOULD
+        #    be included as part of the FETCH responses.
+        #
+        if bodies[0] != b"BODY.PEEK[]":
+            store = b"UID STORE %s +FLAGS.SILENT (\\Seen)\r\n" % uid
+            if b"FLAGS" not in attrs:
+                attrs.append(b"FLAGS")
+
+        self.hits[tag] = (uid, BODY_ITEMS[bodies[0]], data)
+
+        return b"%s UID FETCH %s (%s)\r\n" % (tag.encode(), uid, b" ".join(attrs)), store
+
+    async def respond(self, uid: bytes, line: bytes,
+                      forward: Callable[[bytes], Awaitable[None]]) -> bool:
+        # Puts a cached body into the FETCH response it has been asked for with.
+        for tag, (hit, item, data) in self.hits.items():
+            if hit == uid:
+                break
+        else:
+            return False
+
+        del self.hits[tag]
+
+        try:
+            await forward(line[:-3] + b" %s {%d}\r\n" % (item, len(data)))
+            for offset in range(0, len(data), CHUNK):
+                await forward(data[offset:offset + CHUNK])
+            await forward(b")\r\n")
+        finally:
+            data.close()
+
+        return True
+
+    def completed(self, tag: str) -> None:
+        hit = self.hits.pop(tag, None)
+        if hit:
+            # The message is not there anymore.
+            hit[2].close()
+
+    def body_uid(self, line: bytes, size: int) -> int:
+        # The UID of a full body coming from the server, if it is to be cached.
+        if not self.mailbox or not self.cache.cacheable(size):
+            return 0
+
+        match = FETCH_BODY.match(line)
+        if not match:
+            return 0
+
+        return int(match.group(1))
+
+    async def store(self, uid: int, chunks: List[bytes]) -> None:
+        if not self.mailbox:
+            return
+
+        await asyncio.get_running_loop().run_in_executor(
+                None, self.cache.put, self.account, self.mailbox[0], self.mailbox[1], uid, chunks)
+        metrics.body_cache.inc(value="store")
+
+    def close(self) -> None:
+        for _, _, data in self.hits.values():
+            data.close()
+        self.hits.clear()
+
+
+cache: BodyCache | None = None
+
+
+def setup(config: Dict[str, Any]) -> None:
+    global cache
+
+    params = config.get("body-cache", {})
+    if "dir" not in params:
+        return
+
+    cache = BodyCache(os.path.expanduser(str(params["dir"])),
+                      int(float(params.get("size", 1024)) * 2**20),
+                      int(float(params.get("max-message", 64)) * 2**20))
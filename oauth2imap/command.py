@@ -29,6 +29,21 @@ def cmd_token(cmdargs: argparse.Namespace) -> int:
     return oauth2imap._token.main(cmdargs)
 
 
+def cmd_trace(cmdargs: argparse.Namespace) -> int:
+    import oauth2imap.trace
+    return oauth2imap.trace.main(cmdargs)
+
+
+def cmd_bench(cmdargs: argparse.Namespace) -> int:
+    import oauth2imap.bench
+    return oauth2imap.bench.main(cmdargs)
+
+
+def cmd_replay(cmdargs: argparse.Namespace) -> int:
+    import oauth2imap.record
+    return oauth2imap.record.main(cmdargs)
+
+
 def add_common_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-l", "--logfile",
                         dest="logfile", action='store', default=None,
@@ -36,7 +51,8 @@ def add_common_arguments(parser: argparse.ArgumentParser) -> None:
                         help="append logs messages to FILENAME instead of stdout.")
     parser.add_argument("-v", "--verbose",
                         dest="verbose", action='count', default=0,
-                        help="print a message for each action.")
+                        help="print a message for each action (-vv adds commands and\n"
+                             "status lines, -vvv all the protocol data).")
     parser.add_argument('-q', '--quiet',
                         dest="quiet", action='store_true', default=False,
                         help='output critical information only.')
@@ -79,6 +95,14 @@ authentication method for access.
                                 epilog=epilog,
                                 add_help=False)
     sp0.set_defaults(func=cmd_server)
+
+    sp0.add_argument("--engine",
+                     dest="engine", choices=["fork", "asyncio", "prefork"],
+                     default="fork",
+                     help="how to serve connections: a forked process per connection,\n"
+                          "coroutines in a single asyncio event loop, or such loops in\n"
+                          "several pre-forked worker processes.")
+
     add_common_arguments(sp0)
 
     # oauth2imap tunnel
@@ -92,6 +116,12 @@ commands are received from stdin and the result will be written to stdout.
                                 epilog=epilog,
                                 add_help=False)
     sp1.set_defaults(func=cmd_tunnel)
+
+    sp1.add_argument("--account",
+                     dest="account", action='store', default=None,
+                     metavar="NAME",
+                     help="account from the [accounts] of the config to use.")
+
     add_common_arguments(sp1)
 
     # oauth2imap token
@@ -109,9 +139,127 @@ Subcommand to maintain xoauth2 tokens.
                      dest="authflow", choices=["authcode", "localhostauthcode"],
                      default="authcode",
                      help="authorization mode.")
+    sp2.add_argument("--migrate-from",
+                     dest="migrate_from", action='store', default=None,
+                     metavar="FILENAME",
+                     help="copy all tokens from the JSON tokens FILENAME into\n"
+                          "the configured tokens-file.")
+    sp2.add_argument("--expiring",
+                     dest="expiring", action='store', type=float, default=None,
+                     metavar="MINUTES",
+                     help="list tokens expiring in the next MINUTES.")
+    sp2.add_argument("--account",
+                     dest="account", action='store', default=None,
+                     metavar="NAME",
+                     help="account from the [accounts] of the config to use.")
 
     add_common_arguments(sp2)
 
+    # oauth2imap trace
+    sp3_description = """\
+Subcommand to summarize the command trace written by the server: percentiles
+of the command latency and its parts per command.
+"""
+    sp3 = subparsers.add_parser("trace",
+                                description=sp3_description,
+                                help=sp3_description,
+                                epilog=epilog,
+                                add_help=False)
+    sp3.set_defaults(func=cmd_trace)
+
+    sp3.add_argument("files",
+                     nargs="+", metavar="FILENAME",
+                     help="trace files to read.")
+
+    add_common_arguments(sp3)
+
+    # oauth2imap bench
+    sp4_description = """\
+Subcommand to load a running server with concurrent clients logging in through
+the downstream authentication and running a mix of operations.
+"""
+    sp4 = subparsers.add_parser("bench",
+                                description=sp4_description,
+                                help=sp4_description,
+                                epilog=epilog,
+                                add_help=False)
+    sp4.set_defaults(func=cmd_bench)
+
+    sp4.add_argument("--host",
+                     dest="host", action='store', default=None,
+                     help="server address (default: downstream server from the config).")
+    sp4.add_argument("--port",
+                     dest="port", action='store', type=int, default=None,
+                     help="server port (default: downstream port from the config).")
+    sp4.add_argument("--username",
+                     dest="username", action='store', default=None,
+                     help="downstream username (default: from the config).")
+    sp4.add_argument("--password",
+                     dest="password", action='store', default=None,
+                     help="downstream password (default: from the config).")
+    sp4.add_argument("--auth",
+                     dest="auth", choices=["cram-md5", "login"],
+                     default="cram-md5",
+                     help="how the clients log in.")
+    sp4.add_argument("--clients",
+                     dest="clients", action='store', type=int, default=10,
+                     metavar="N",
+                     help="number of concurrent clients.")
+    sp4.add_argument("--duration",
+                     dest="duration", action='store', type=float, default=30,
+                     metavar="SECONDS",
+                     help="how long to run.")
+    sp4.add_argument("--rate",
+                     dest="rate", action='store', type=float, default=0,
+                     metavar="OPS",
+                     help="operations per second of all clients together\n"
+                          "(default: as fast as the server answers).")
+    sp4.add_argument("--mix",
+                     dest="mix", action='store', default="",
+                     metavar="OP=WEIGHT,...",
+                     help="weights of the operations: select, search, headers,\n"
+                          "body, idle and append (default: select=1,search=2,\n"
+                          "headers=4,body=2,idle=0.5,append=0).")
+    sp4.add_argument("--mailbox",
+                     dest="mailbox", action='store', default="INBOX",
+                     help="mailbox to work on.")
+    sp4.add_argument("--idle-time",
+                     dest="idle_time", action='store', type=float, default=1,
+                     metavar="SECONDS",
+                     help="how long an IDLE lasts.")
+    sp4.add_argument("--append-size",
+                     dest="append_size", action='store', type=int, default=16384,
+                     metavar="BYTES",
+                     help="size of the appended messages.")
+
+    add_common_arguments(sp4)
+
+    # oauth2imap replay
+    sp5_description = """\
+Subcommand to play recorded sessions back through the proxy with the upstream
+server played from the record as well. Nothing goes to the network.
+"""
+    sp5 = subparsers.add_parser("replay",
+                                description=sp5_description,
+                                help=sp5_description,
+                                epilog=epilog,
+                                add_help=False)
+    sp5.set_defaults(func=cmd_replay)
+
+    sp5.add_argument("--realtime",
+                     dest="realtime", action='store_true', default=False,
+                     help="keep the recorded pauses instead of going as fast\n"
+                     "as possible.")
+    sp5.add_argument("--repeat",
+                     dest="repeat", action='store', type=int, default=1,
+                     metavar="N",
+                     help="play each record N times and report the best time.")
+    sp5.add_argument("files",
+                     nargs="+", metavar="FILENAME",
+                     help="session records.")
+
+    add_common_arguments(sp5)
+
     return parser
 
 
@@ -121,8 +269,10 @@ def setup_logger(cmdargs: argparse.Namespace) -> None:
             level = logging.WARNING
         case 1:
             level = logging.INFO
-        case _:
+        case 2:
             level = logging.DEBUG
+        case _:
+            level = oauth2imap.TRACE
 
     if cmdargs.quiet:
         level = logging.CRITICAL
@@ -30,3 +30,69 @@ def read() -> Dict[str, Any] | oauth2imap.Error:
 
     logger.info("config has been read")
     return config
+
+
+def account_config(config: Dict[str, Any], name: str) -> Dict[str, Any]:
+    #
+    # The sections of an account are laid over those of the whole config,
+    # except for the downstream credentials, which are never shared.
+    #
+    merged = { key: value for key, value in config.items() if key != "accounts" }
+
+    for section, values in config["accounts"][name].items():
+        if not isinstance(values, dict):
+            merged[section] = values
+            continue
+
+        base = config.get(section, {})
+        if section == "downstream":
+            base = { k: v for k, v in base.items() if k not in ("username", "password") }
+
+        merged[section] = base | values
+
+    return merged
+
+
+def accounts(config: Dict[str, Any]) -> Dict[str, Dict[str, Any]] | oauth2imap.Error:
+    """The configs of the accounts by the downstream username selecting them."""
+    if "accounts" not in config:
+        return { str(config.get("downstream", {}).get("username", "")): config }
+
+    routes: Dict[str, Dict[str, Any]] = {}
+
+    for name in config["accounts"]:
+        account = account_config(config, name)
+
+        if "upstream" not in account:
+            return oauth2imap.Error(f"account `{name}' has no upstream section")
+
+        downstream = account.setdefault("downstream", {})
+        username = str(downstream.setdefault("username", name))
+
+        if "password" not in downstream:
+            return oauth2imap.Error(f"account `{name}' has no downstream password")
+
+        if username in routes:
+            return oauth2imap.Error(f"downstream username `{username}' is used by several accounts")
+
+        routes[username] = account
+
+    return routes
+
+
+def select(config: Dict[str, Any], name: str | None) -> Dict[str, Any] | oauth2imap.Error:
+    """The config of the named account, or the only one there is."""
+    if "accounts" not in config:
+        if name:
+            return oauth2imap.Error("config has no accounts")
+        return config
+
+    if name is None:
+        if len(config["accounts"]) != 1:
+            return oauth2imap.Error("config has several accounts, choose one with --account")
+        name = next(iter(config["accounts"]))
+
+    if name not in config["accounts"]:
+        return oauth2imap.Error(f"account `{name}' not found")
+
+    return account_config(config, name)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import collections
+import time
+
+from typing import Any, Deque, Set, Tuple
+
+import oauth2imap
+
+logger = oauth2imap.logger
+
+# Lines of the protocol exchange kept per session, at most 64 KiB with the
+# lines cut to LINE_PREVIEW.
+HISTORY_LINES = 256
+
+# Longer lines are cut to this many bytes.
+LINE_PREVIEW = 256
+
+# Bytes kept from the beginning of each piece of a literal.
+LITERAL_PREVIEW = 32
+
+
+class History:
+    """The last lines a session has exchanged, kept to be dumped when it fails."""
+
+    def __init__(self, name: Any, lines: int = HISTORY_LINES):
+        self.name = name
+        # The oldest entries fall out by themselves.
+        self.entries: Deque[Tuple[float, str, bytes]] = collections.deque(maxlen=lines)
+
+    def add(self, direction: str, data: bytes, preview: int = LINE_PREVIEW) -> None:
+        if len(data) > preview:
+            data = data[:preview] + b"... (%d octets)" % len(data)
+
+        self.entries.append((time.monotonic(), direction, data))
+
+    def literal(self, direction: str, data: bytes) -> None:
+        self.add(direction, data, LITERAL_PREVIEW)
+
+    def dump(self, reason: str) -> None:
+        now = time.monotonic()
+
+        lines = [f"{self.name}: {reason}, the last {len(self.entries)} exchanges:"]
+        for stamp, direction, data in self.entries:
+            lines.append(f"  {stamp - now:+9.3f} {direction} {data!r}")
+
+        logger.warning("%s", "\n".join(lines))
+
+
+# Histories of the sessions in progress.
+live: Set[History] = set()
+
+
+def dump_live(reason: str = "on request") -> None:
+    for history in list(live):
+        history.dump(reason)
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import asyncio
+import collections
+import re
+import time
+
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+
+import oauth2imap
+import oauth2imap.imap as imap
+import oauth2imap.proxy as proxy
+import oauth2imap.metrics as metrics
+
+logger = oauth2imap.logger
+
+#
+# From: https://datatracker.ietf.org/doc/html/rfc2177#section-3
+#
+# The server MAY consider a client inactive if it has an IDLE command
+# running, and if such a server has an inactivity timeout it MAY log
+# the client off implicitly at the end of its timeout period. Because
+# of that, clients using IDLE are advised to terminate the IDLE and
+# re-issue it at least every 29 minutes to avoid being logged off.
+#
+RENEW = 25 * 60
+
+# Seconds a client waits for a new watch before going IDLE on its own connection.
+READY_TIMEOUT = 10
+
+# Seconds between attempts to bring a failed watch back, doubled up to the maximum.
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+# Flag changes kept for the clients that have not caught up yet.
+FLAG_CHANGES = 1024
+
+UNSOLICITED = re.compile(rb"\* (\d+) (EXISTS|EXPUNGE|FETCH)\b", re.IGNORECASE)
+EXISTS = re.compile(rb"\* (\d+) EXISTS\r\n", re.IGNORECASE)
+UIDNEXT = re.compile(rb"\* OK \[UIDNEXT (\d+)\]", re.IGNORECASE)
+FLAGS = re.compile(rb"FLAGS \(([^)]*)\)", re.IGNORECASE)
+
+Connect = Callable[[], Awaitable[imap.Upstream]]
+Release = Callable[[imap.Upstream], Awaitable[None]]
+
+
+def quote(name: bytes) -> str:
+    # Names with quotes or backslashes are never taken from the client.
+    return '"' + name.decode("utf-8", "replace") + '"'
+
+
+def search_uids(data: List[bytes]) -> List[int]:
+    uids: List[int] = []
+    for line in data:
+        if line[:9].upper() == b"* SEARCH " or line.rstrip().upper() == b"* SEARCH":
+            uids.extend(int(num) for num in line[8:].split())
+    return uids
+
+
+def changes(view: List[int], uids: List[int], top: int) -> List[str]:
+    """
+    Untagged responses that bring the UIDs a client knows to the ones of the
+    mailbox, which are applied to the view. UIDs above the top are not known
+    to be gone yet.
+    """
+    current = set(uids)
+
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.5.1
+    #
+    # The EXPUNGE response reports that the specified message sequence
+    # number has been permanently removed from the mailbox. The message
+    # sequence number for each successive message in the mailbox is
+    # immediately decremented by 1, and this decrement is reflected in
+    # message sequence numbers in subsequent responses.
+    #
+    # Going from the end, every number is still the one the client knows.
+    #
+    lines = [f"* {num} EXPUNGE" for num in range(len(view), 0, -1)
+             if view[num - 1] <= top and view[num - 1] not in current]
+    if lines:
+        view[:] = [uid for uid in view if uid > top or uid in current]
+
+    # New messages always get greater UIDs.
+    last = view[-1] if view else 0
+    new = [uid for uid in uids if uid > last]
+    if new:
+        view.extend(new)
+        lines.append(f"* {len(view)} EXISTS")
+
+    return lines
+
+
+class Watch:
+    """One upstream connection in IDLE on a mailbox for all the clients waiting on it."""
+
+    def __init__(self, key: Tuple[str, bytes], linger: float, connect: Connect, release: Release):
+        self.key     = key
+        self.linger  = linger
+        self.connect = connect
+        self.release = release
+
+        self.uidvalidity = 0
+        self.uids: List[int] = []
+        self.exists = 0
+        # The greatest UID seen, even if the message is gone.
+        self.top = 0
+
+        # Flag changes: the version they came with, the UID and the flags.
+        self.flags: Deque[Tuple[int, int, str]] = collections.deque(maxlen=FLAG_CHANGES)
+
+        self.version = 0
+        self.ready   = asyncio.Event()
+        self.changed = asyncio.Event()
+
+        self.subscribers = 0
+        self.unused_since = time.monotonic()
+        self.closing = False
+
+    def notify(self) -> None:
+        self.version += 1
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def unused(self) -> bool:
+        return not self.subscribers and time.monotonic() - self.unused_since >= self.linger
+
+    def apply(self, line: bytes) -> None:
+        match = UNSOLICITED.match(line)
+        if not match:
+            return
+
+        num, what = int(match.group(1)), match.group(2).upper()
+
+        if what == b"EXISTS":
+            self.exists = num
+
+        elif what == b"EXPUNGE":
+            self.exists -= 1
+            if 0 < num <= len(self.uids):
+                del self.uids[num - 1]
+                self.notify()
+
+        elif 0 < num <= len(self.uids):
+            flags = FLAGS.search(line)
+            if flags:
+                self.flags.append((self.version + 1, self.uids[num - 1],
+                                   flags.group(1).decode("utf-8", "replace")))
+                self.notify()
+
+    async def recv(self, up: imap.Upstream) -> bytes:
+        line = await up.recv_bytes()
+        if line == b"":
+            raise imap.UpstreamClosed("upstream closed the connection")
+
+        # Nothing of interest is inside a literal.
+        size, _ = imap.parse_literal(line)
+        while size >= 0:
+            await up.recv_literal(size)
+            rest = await up.recv_bytes()
+            if rest == b"":
+                raise imap.UpstreamClosed("upstream closed the connection")
+            line = line.rstrip(b"\r\n") + rest
+            size, _ = imap.parse_literal(rest)
+
+        return line
+
+    async def load(self, up: imap.Upstream) -> None:
+        typ, data = await up.command(f"EXAMINE {quote(self.key[1])}")
+        if typ != "OK":
+            raise ConnectionError(f"unable to examine {self.key[1]!r}: {typ}")
+        up.selected = True
+
+        uidvalidity = 0
+        for line in data:
+            match = imap.UIDVALIDITY.match(line)
+            if match:
+                uidvalidity = int(match.group(1))
+
+        typ, data = await up.command("UID SEARCH ALL")
+        if typ != "OK":
+            raise ConnectionError(f"unable to search {self.key[1]!r}: {typ}")
+
+        self.uidvalidity = uidvalidity
+        self.uids   = search_uids(data)
+        self.exists = len(self.uids)
+        self.top    = max(self.top, self.uids[-1] if self.uids else 0)
+
+        self.ready.set()
+        self.notify()
+
+    async def fetch_new(self, up: imap.Upstream) -> None:
+        last = self.top
+
+        typ, data = await up.command(f"UID FETCH {last + 1}:* (UID)")
+        if typ != "OK":
+            raise ConnectionError(f"unable to fetch new UIDs: {typ}")
+
+        new: List[int] = []
+        for line in data:
+            match = imap.FETCH_UID.match(line)
+            if match:
+                #
+                # From: https://datatracker.ietf.org/doc/html/rfc9051#section-6.4.9
+                #
+                # A "UID range" of 559:* always includes the UID of the last
+                # message in the mailbox, even if 559 is higher than any
+                # assigned UID value.
+                #
+                if int(match.group(1)) > last:
+                    new.append(int(match.group(1)))
+                continue
+            self.apply(line)
+
+        self.uids.extend(sorted(new))
+        self.top = max([self.top] + new)
+
+        if len(self.uids) != self.exists:
+            # Something was missed, start over.
+            typ, data = await up.command("UID SEARCH ALL")
+            if typ != "OK":
+                raise ConnectionError(f"unable to search {self.key[1]!r}: {typ}")
+            self.uids   = search_uids(data)
+            self.exists = len(self.uids)
+
+        self.notify()
+
+    async def idle(self, up: imap.Upstream) -> None:
+        tag = up.next_tag()
+        await up.send_bytes(f"{tag} IDLE{imap.CRLF}".encode())
+
+        while True:
+            line = await self.recv(up)
+            rtag, _ = imap.parse_server_command(line)
+            if rtag == "+":
+                break
+            if rtag == tag:
+                raise ConnectionError(f"IDLE refused: {line!r}")
+            self.apply(line)
+
+        renew = time.monotonic() + RENEW
+
+        while self.exists <= len(self.uids):
+            timeout = min(renew - time.monotonic(), self.linger)
+            if timeout <= 0:
+                break
+            try:
+                line = await asyncio.wait_for(self.recv(up), timeout)
+            except asyncio.TimeoutError:
+                if self.unused():
+                    break
+                continue
+            self.apply(line)
+
+        await up.send_bytes(f"DONE{imap.CRLF}".encode())
+
+        while True:
+            line = await self.recv(up)
+            rtag, status = imap.parse_server_command(line)
+            if rtag == tag:
+                if status != "OK":
+                    raise ConnectionError(f"IDLE failed: {line!r}")
+                break
+            self.apply(line)
+
+        if self.exists > len(self.uids):
+            await self.fetch_new(up)
+
+    async def watch(self) -> None:
+        up = await self.connect()
+        up.dirty = True
+        try:
+            await self.load(up)
+
+            logger.info("idle: watching %r for %d clients", self.key[1], self.subscribers)
+
+            while not self.unused():
+                await self.idle(up)
+
+            # Once closing, nobody else gets the watch.
+            self.closing = True
+            up.dirty = False
+        finally:
+            await self.release(up)
+
+    async def run(self) -> None:
+        delay = RETRY_MIN
+
+        metrics.idle_watches.add(1)
+        try:
+            while not self.closing:
+                try:
+                    await self.watch()
+                    return
+                except (OSError, ConnectionError) as e:
+                    logger.warning("idle: watch of %r failed: %s", self.key[1], e)
+
+                if self.unused():
+                    return
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+        finally:
+            self.closing = True
+            metrics.idle_watches.add(-1)
+
+
+class Hub:
+    """Shares upstream connections in IDLE between the clients of the same mailbox."""
+
+    def __init__(self, config: Dict[str, Any]):
+        params = config.get("idle", {})
+
+        self.shared = bool(params.get("shared", False))
+        # Seconds a watch is kept after the last client has left it.
+        self.linger = float(params.get("linger", 60))
+
+        self.watches: Dict[Tuple[str, bytes], Watch] = {}
+        self.tasks: Dict[Watch, asyncio.Task[None]] = {}
+
+    def enabled(self) -> bool:
+        return self.shared
+
+    def subscribe(self, key: Tuple[str, bytes], connect: Connect, release: Release) -> Watch:
+        watch = self.watches.get(key)
+
+        if not watch or watch.closing:
+            watch = Watch(key, self.linger, connect, release)
+            self.watches[key] = watch
+            self.tasks[watch] = asyncio.create_task(self.run(watch))
+
+        watch.subscribers += 1
+        metrics.idle_clients.add(1)
+
+        return watch
+
+    def unsubscribe(self, watch: Watch) -> None:
+        watch.subscribers -= 1
+        watch.unused_since = time.monotonic()
+        metrics.idle_clients.add(-1)
+
+    async def run(self, watch: Watch) -> None:
+        try:
+            await watch.run()
+        finally:
+            if self.watches.get(watch.key) is watch:
+                del self.watches[watch.key]
+            del self.tasks[watch]
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def client_view(self, relay: proxy.Relay) -> List[int]:
+        #
+        # The UIDs of the messages as the client knows them. Whatever the
+        # server reports meanwhile is the client's and goes to it, and then
+        # the search is repeated.
+        #
+        while True:
+            typ, data = await relay.up.command("UID SEARCH ALL")
+            if typ != "OK":
+                raise ConnectionError(f"unable to search the selected mailbox: {typ}")
+
+            moved = False
+            for line in data:
+                if line[:8].upper() != b"* SEARCH":
+                    relay.ds.write(line)
+                    match = UNSOLICITED.match(line)
+                    moved = moved or bool(match and match.group(2).upper() != b"FETCH")
+
+            await relay.ds.flush()
+
+            if not moved:
+                return search_uids(data)
+
+    async def update(self, ds: imap.Downstream, watch: Watch, view: List[int], seen: int) -> int:
+        lines = changes(view, watch.uids, watch.top)
+
+        positions: Dict[int, int] | None = None
+        for version, uid, flags in watch.flags:
+            if version <= seen:
+                continue
+            if positions is None:
+                positions = {uid: num for num, uid in enumerate(view, 1)}
+            if uid in positions:
+                lines.append(f"* {positions[uid]} FETCH (FLAGS ({flags}))")
+
+        for line in lines:
+            ds.write((line + imap.CRLF).encode())
+        await ds.flush()
+
+        return watch.version
+
+    async def wait(self, ds: imap.Downstream, watch: Watch, view: List[int]) -> Tuple[bytes, int]:
+        """
+        Passes the changes on to the client until it ends the IDLE. Returns
+        the client's reply and the greatest UID the view has been brought up to.
+        """
+        seen = 0
+        top = view[-1] if view else 0
+        done = asyncio.ensure_future(ds.recv_bytes())
+        try:
+            while not done.done():
+                changed = watch.changed
+
+                if watch.ready.is_set() and watch.version != seen:
+                    top = max(top, watch.top)
+                    seen = await self.update(ds, watch, view, seen)
+                    continue
+
+                waiter = asyncio.ensure_future(changed.wait())
+                try:
+                    await asyncio.wait([done, waiter], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+
+            return done.result(), top
+        finally:
+            done.cancel()
+
+    async def resume(self, relay: proxy.Relay, up: imap.Upstream, view: List[int], top: int) -> bool:
+        # The mailbox selected again the way the client did it.
+        typ, data = await up.command(f"{relay.selected_command} {quote(relay.selected_mailbox)}")
+        if typ != "OK":
+            logger.warning("idle: unable to select %r again: %s", relay.selected_mailbox, typ)
+            return False
+        up.selected = True
+
+        exists, uidnext = -1, 0
+        for response in data:
+            match = imap.UIDVALIDITY.match(response)
+            if match and int(match.group(1)) != relay.selected_uidvalidity:
+                logger.warning("idle: UIDVALIDITY of %r changed", relay.selected_mailbox)
+                return False
+            match = EXISTS.match(response)
+            if match:
+                exists = int(match.group(1))
+            match = UIDNEXT.match(response)
+            if match:
+                uidnext = int(match.group(1))
+
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.3.1.1
+        #
+        # The next unique identifier value is the predicted value that will
+        # be assigned to a new message in the mailbox. Unless the unique
+        # identifier validity also changes (see below), the next unique
+        # identifier value MUST have the following two characteristics.
+        # First, the next unique identifier value MUST NOT change unless new
+        # messages are added to the mailbox; and second, the next unique
+        # identifier value MUST change whenever new messages are added to
+        # the mailbox, even if those new messages are subsequently expunged.
+        #
+        # The view holds every message up to the top. With nothing above it,
+        # the messages can only have gone, and none have if the number is the
+        # same.
+        #
+        if 0 < uidnext <= top + 1 and exists == len(view):
+            return True
+
+        typ, data = await up.command("UID SEARCH ALL")
+        if typ != "OK":
+            return False
+
+        uids = search_uids(data)
+        lines = changes(view, uids, uids[-1] if uids else 0)
+
+        for line in lines:
+            relay.ds.write((line + imap.CRLF).encode())
+        await relay.ds.flush()
+
+        return view == uids
+
+    async def idle(self, relay: proxy.Relay, connect: Connect, release: Release) -> imap.Upstream | None:
+        """
+        Keeps the client in IDLE on a connection shared with the other
+        clients of the mailbox and gives its own one up meanwhile. Returns
+        the connection the session goes on with, if any.
+        """
+        ds = relay.ds
+        tag, line = relay.idling or ("", b"")
+
+        up = relay.up
+        up.dirty = True
+
+        # Whatever happens, the connection is released unless it is returned.
+        own: imap.Upstream | None = up
+
+        try:
+            view = await self.client_view(relay)
+
+            watch = self.subscribe((relay.ctx.get("account", ""), relay.selected_mailbox),
+                                   connect, release)
+            try:
+                try:
+                    await asyncio.wait_for(watch.ready.wait(), READY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+
+                if not watch.ready.is_set() or watch.uidvalidity != relay.selected_uidvalidity:
+                    # The client goes IDLE on its own connection after all.
+                    relay.command_sent(tag, "IDLE")
+                    await up.send_bytes(line)
+                    up.dirty = False
+                    own = None
+                    return up
+
+                await ds.send(["+", "idling"])
+
+                up.dirty = False
+                await release(up)
+                own = None
+
+                reply, top = await self.wait(ds, watch, view)
+            finally:
+                self.unsubscribe(watch)
+
+            if reply == b"":
+                return None
+
+            try:
+                own = await connect()
+            except OSError as e:
+                logger.critical("%s: upstream is not available: %s", ds.addr, e)
+                await ds.send(["*", "BYE", "upstream server is not available"])
+                return None
+
+            own.dirty = True
+
+            if not await self.resume(relay, own, view, top):
+                await ds.send(["*", "BYE", "mailbox state changed, please reconnect"])
+                return None
+
+            #
+            # From: https://datatracker.ietf.org/doc/html/rfc2177#section-3
+            #
+            # The IDLE command is terminated by the receipt of a "DONE"
+            # continuation from the client; such response satisfies the
+            # server's continuation request.
+            #
+            if reply.rstrip(imap.CRLF.encode()).upper() == b"DONE":
+                await ds.send([tag, "OK", "IDLE terminated"])
+            else:
+                await ds.send([tag, "BAD", "DONE expected"])
+
+            own.dirty = False
+            up, own = own, None
+            return up
+
+        finally:
+            if own:
+                await release(own)
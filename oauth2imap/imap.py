@@ -4,23 +4,101 @@
 
 __author__ = 'Alexey Gladkov <legion@kernel.org>'
 
+import asyncio
+import base64
+import logging
 import re
-import imaplib
+import socket
+import ssl
+import time
 
-from typing import Dict, Tuple, List, Any
+from typing import Callable, Dict, Tuple, List, Any
 
 import oauth2imap
 import oauth2imap.config
 import oauth2imap.auth as auth
+import oauth2imap.history as history
+import oauth2imap.metrics as metrics
 import oauth2imap.oauth2 as oauth2
+import oauth2imap.record as record
 
 CRLF = '\r\n'
-LiteralRe = br'.*{(?P<size>\d+)}\r\n$'
+
+# The longest line accepted from either side (the same limit imaplib uses).
+LINE_LIMIT = 1000000
+
+# Literals are relayed in pieces of this size instead of line by line.
+LITERAL_CHUNK = 256 * 1024
+
+# Responses to the client are written out once this much has been collected.
+FLUSH_THRESHOLD = 64 * 1024
+
+# The head of a line where the tag and the command or status are looked for.
+WORDS_PREFIX = 128
+
+# A whole FETCH response without literals, and its UID.
+FETCH_UID = re.compile(rb"\* \d+ FETCH \((?:.* )?UID (\d+)(?: .*)?\)\r\n\Z")
+
+UIDVALIDITY = re.compile(rb"\* OK \[UIDVALIDITY (\d+)\]")
 
 logger = oauth2imap.logger
 
+TRACE = oauth2imap.TRACE
+
+
+def split_line(line: bytes) -> Tuple[bytes, bytes, int]:
+    #
+    # Only the first two words of a line and the end of it are ever looked
+    # at. They are cut out of the head of the line without decoding or
+    # splitting the whole line, which can be many kilobytes long. Returns
+    # the words and the offset of the rest of the line.
+    #
+    words = line[:WORDS_PREFIX].split(b" ", 2)
+
+    if len(words) < 3 and len(line) > WORDS_PREFIX:
+        # Words longer than anything a tag or a command name could be.
+        words = line.split(b" ", 2)
+
+    if len(words) == 3:
+        return words[0], words[1], len(words[0]) + len(words[1]) + 2
+
+    if len(words) == 2:
+        return words[0], words[1].rstrip(b"\r\n"), len(line)
+
+    return words[0].rstrip(b"\r\n"), b"", len(line)
+
+
+def parse_literal(line: bytes) -> Tuple[int, bool]:
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc7888#section-3
+    #
+    # The non-synchronizing literal is distinguished from the synchronizing
+    # literal by the presence of "+" before the closing "}".
+    #
+    # Returns the size of the literal announced at the end of the line (or
+    # -1) and whether it is a synchronizing one.
+    #
+    if not line.endswith(b"}\r\n"):
+        return -1, False
+
+    start = line.rfind(b"{", 0, len(line) - 3)
+    if start < 0:
+        return -1, False
+
+    count = line[start + 1:len(line) - 3]
+    sync = True
+
+    if count.endswith(b"+"):
+        count = count[:-1]
+        sync = False
+
+    if not count.isdigit():
+        return -1, False
+
+    return int(count), sync
+
 
-def parse_client_command(line: str) -> Tuple[str,str,str]:
+def parse_client_command(line: bytes) -> Tuple[str,str,bytes]:
     #
     # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2.1
     #
@@ -29,126 +107,358 @@ def parse_client_command(line: str) -> Tuple[str,str,str]:
     # string, e.g., A0001, A0002, etc.) called a "tag". A different
     # tag is generated by the client for each command.
     #
-    tag, args = line.split(" ", 1)
-    args = args.strip()
+    tag, cmd, offset = split_line(line)
 
-    cmd = ""
-    if " " in args:
-        cmd, args = args.split(" ", 1)
-        cmd = cmd.upper()
-    else:
-        cmd = args.upper()
-        args = ""
+    if not cmd:
+        raise ValueError("command without a tag")
 
-    return tag, cmd, args
+    return tag.decode("ascii", "replace"), cmd.upper().decode("ascii", "replace"), line[offset:]
 
 
-def parse_server_command(line: str) -> Tuple[str,str]:
+def parse_server_command(line: bytes) -> Tuple[str,str]:
     #
     # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.1
     #
     # Generic Status Responses are OK, NO, BAD, PREAUTH, and BYE. OK, NO, and
     # BAD can be tagged or untagged. PREAUTH and BYE are always untagged.
     #
-    s = line.split(" ")
+    tag, word, _ = split_line(line)
 
-    if len(s) > 1:
-        # Untagged.
-        if s[0] == "*" and s[1] in ('OK', 'NO', 'BAD', 'PREAUTH', 'BYE'):
-            return "*", s[1]
+    # Server asks for more.
+    if tag == b"+":
+        return "+", ""
 
-        # Server asks for more.
-        if s[0] == "+":
-            return "+", ""
+    if word:
+        # Untagged.
+        if tag == b"*":
+            if word in (b"OK", b"NO", b"BAD", b"PREAUTH", b"BYE"):
+                return "*", word.decode()
 
         # Tagged.
-        if s[1] in ('OK', 'NO', 'BAD'):
-            return s[0], s[1]
+        elif word in (b"OK", b"NO", b"BAD"):
+            return tag.decode("ascii", "replace"), word.decode()
 
     # Something unknown.
     return "", ""
 
 
+def mailbox_name(args: bytes) -> bytes:
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-5.1
+    #
+    # The case-insensitive mailbox name INBOX is a special name reserved to
+    # mean "the primary mailbox for this user on this server".
+    #
+    # The name as the client gives it, or nothing for a literal or a quoted
+    # string with escapes.
+    #
+    args = args.rstrip(b"\r\n")
+
+    if args.startswith(b'"'):
+        end = args.find(b'"', 1)
+        name = args[1:end] if end > 0 else b""
+        if b"\\" in name:
+            return b""
+    else:
+        name = args.split(b" ", 1)[0]
+        if name.startswith(b"{"):
+            return b""
+
+    return b"INBOX" if name.upper() == b"INBOX" else name
+
+
+class UpstreamClosed(ConnectionResetError):
+    """The upstream server has gone away in the middle of a session."""
+
+
+# Capabilities last announced by each upstream server before authentication.
+upstream_capabilities: Dict[Tuple[str, int], Tuple[str, ...]] = {}
+
+
 class Context(Dict[str, Any]):
     pass
 
 
 class Downstream:
-    def __init__(self, addr: str, rfile: Any, wfile: Any):
-        self.addr  = addr
-        self.rfile = rfile
-        self.wfile = wfile
+    def __init__(self, addr: Any, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.addr   = addr
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+
+        # The exchange of the session, kept for when it goes wrong.
+        self.history = history.History(addr)
+
+        self.started = time.monotonic()
+        # Seconds from the connection to the first tagged response.
+        self.first_response: float | None = None
+
+    def responded(self) -> None:
+        if self.first_response is None:
+            self.first_response = time.monotonic() - self.started
+            metrics.first_response.observe(self.first_response)
+            logger.info("%s: first tagged response after %.1f ms",
+                        self.addr, self.first_response * 1000)
 
     def readable(self) -> bool:
-        return not self.rfile.closed and self.rfile.readable()
+        return not self.reader.at_eof()
+
+    async def recv_bytes(self, secret: bool = False) -> bytes:
+        line = await self.reader.readline()
 
-    def recv_bytes(self) -> Any:
-        line = self.rfile.readline()
+        if secret:
+            self.history.add("C>", b"<credentials>")
+        else:
+            words = line[:WORDS_PREFIX].split(b" ", 2)
+            if len(words) > 2 and words[1].upper() == b"LOGIN":
+                self.history.add("C>", words[0] + b" LOGIN <credentials>")
+            else:
+                self.history.add("C>", line)
+
+        # Commands, the client sends little else.
         logger.debug("--> downstream: %s: %s", self.addr, line)
         return line
 
-    def send_bytes(self, msg: bytes) -> None:
+    async def recv_literal(self, size: int, secret: bool = False) -> bytes:
+        try:
+            data = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionResetError("client closed the connection inside a literal") from e
+
+        if secret:
+            self.history.add("C>", b"<credentials>")
+            return data
+
+        self.history.literal("C>", data)
+
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "--> downstream: %s: %s", self.addr, data)
+        return data
+
+    def write(self, msg: bytes) -> None:
+        # What the upstream server sends is logged as it is received.
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "<-- downstream: %s: %s", self.addr, msg)
+        self.buffer += msg
+
+    async def flush(self) -> None:
+        if self.buffer:
+            metrics.sent_bytes.inc(len(self.buffer), "downstream")
+            self.writer.write(self.buffer)
+            self.buffer = bytearray()
+        await self.writer.drain()
+
+    async def send_bytes(self, msg: bytes) -> None:
+        self.write(msg)
+        await self.flush()
+
+    async def recv_astrings(self, args: bytes, count: int) -> List[str] | None:
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-4.3
+        #
+        # A string is in one of three forms: synchronizing literal,
+        # non-synchronizing literal, or quoted string.
+        #
+        # The arguments are atoms, quoted strings or literals, which end the
+        # line and are followed by the rest of the command.
+        #
+        values: List[bytes] = []
+
+        while len(values) < count:
+            args = args.lstrip(b" ")
+
+            if args.startswith(b'"'):
+                value = bytearray()
+                pos = 1
+                while pos < len(args) and args[pos] != ord('"'):
+                    if args[pos] == ord("\\"):
+                        pos += 1
+                    value += args[pos:pos + 1]
+                    pos += 1
+                if pos >= len(args):
+                    return None
+                values.append(bytes(value))
+                args = args[pos + 1:]
+
+            elif args.startswith(b"{"):
+                size, sync = parse_literal(args)
+                if size < 0 or size > LINE_LIMIT or args.find(b"}") != len(args) - 3:
+                    return None
+                if sync:
+                    await self.send(["+", "Ready for literal data"])
+                values.append(await self.recv_literal(size, secret=True))
+                args = await self.recv_bytes(secret=True)
+
+            else:
+                atom, _, args = args.partition(b" ")
+                atom = atom.rstrip(CRLF.encode())
+                if not atom or b'"' in atom:
+                    return None
+                values.append(atom)
+
+        if args.strip(b" " + CRLF.encode()):
+            return None
+
+        return [value.decode("utf-8", "replace") for value in values]
+
+    async def recv(self, secret: bool = False) -> str:
+        line = await self.recv_bytes(secret)
+        return line.decode("utf-8", "replace")
+
+    async def send(self, ans: List[str]) -> None:
+        if ans[0] not in ("*", "+"):
+            self.responded()
+
+        msg = " ".join(ans)
+        self.history.add("<C", msg.encode())
         logger.debug("<-- downstream: %s: %s", self.addr, msg)
-        self.wfile.write(msg)
-        self.wfile.flush()
+        await self.send_bytes((msg + CRLF).encode())
 
-    def recv(self) -> Any:
-        return self.recv_bytes().decode("utf-8", "replace")
+    async def close(self) -> None:
+        await close_writer(self.writer)
 
-    def send(self, ans: List[str]) -> None:
-        msg = " ".join(ans) + CRLF
-        self.send_bytes(msg.encode())
-
-    def command_capability(self, ctx: Context, up_caps: Tuple[str, ...]) -> None:
+    async def command_capability(self, ctx: Context, up_caps: Tuple[str, ...]) -> None:
         caps = ["*", "CAPABILITY", "IMAP4rev1"]
 
-        if "username" in ctx and "password" in ctx:
-            caps.extend(["AUTH=CRAM-MD5", "AUTH=PLAIN"])
+        if ctx.get("accounts"):
+            caps.append("AUTH=CRAM-MD5")
 
         for cap in up_caps:
             if not cap.startswith("AUTH="):
                 caps.append(cap)
 
-        self.send(caps)
-        self.send([ctx["tag"], "OK", "CAPABILITY completed"])
+        await self.send(caps)
+        await self.send([ctx["tag"], "OK", "CAPABILITY completed"])
 
-    def command_authenticate(self, ctx: Context, arg: str) -> bool:
-        if arg not in ("CRAM-MD5"):
-            self.send([ctx["tag"], "NO", "unsupported authentication mechanism"])
+    async def command_authenticate(self, ctx: Context, arg: str) -> bool:
+        if arg.upper() != "CRAM-MD5":
+            await self.send([ctx["tag"], "NO", "unsupported authentication mechanism"])
             return False
 
-        def auth_interact(shared: str) -> Any:
-            self.send(["+", shared])
-            return self.recv()
+        async def auth_interact(shared: str) -> str:
+            await self.send(["+", shared])
+            return await self.recv(secret=True)
+
+        def password(username: str) -> str | None:
+            account = ctx["accounts"].get(username)
+            return str(account["downstream"]["password"]) if account else None
 
-        (ret, msg) = auth.cram_md5(ctx["username"], ctx["password"], auth_interact)
+        (ret, msg, username) = await auth.cram_md5(password, auth_interact)
         if not ret:
-            self.send([ctx["tag"], "NO", msg])
+            await self.send([ctx["tag"], "NO", msg])
             return False
 
-        self.send([ctx["tag"], "OK", "CRAM-MD5 authentication successful"])
+        # The account the client goes on with.
+        ctx["config"] = ctx["accounts"][username]
+
+        # The caller completes the command once the upstream is ready.
         return True
 
-    def command_login(self, ctx: Context, args: str) -> bool:
-        (ret, msg) = auth.plain(ctx["username"], ctx["password"], args)
-        if not ret:
-            self.send([ctx["tag"], "NO", msg])
+    async def command_login(self, ctx: Context, args: bytes) -> bool:
+        given = await self.recv_astrings(args, 2)
+        if not given:
+            await self.send([ctx["tag"], "BAD", "LOGIN expects a user name and a password"])
+            return False
+
+        username = given[0]
+        account = ctx["accounts"].get(username)
+
+        (ret, msg) = auth.plain(username, str(account["downstream"]["password"]) if account else "", given)
+        if not ret or not account:
+            await self.send([ctx["tag"], "NO", msg if not ret else "authenticate failure"])
             return False
 
-        self.send([ctx["tag"], "OK", "LOGIN authentication successful"])
+        # The account the client goes on with.
+        ctx["config"] = account
+
+        # The caller completes the command once the upstream is ready.
         return True
 
 
 class Upstream:
-    def __init__(self, addr: str, port: int):
-        self.addr = (addr, port)
-        self.imap = imaplib.IMAP4_SSL(self.addr[0], self.addr[1])
-        self.imap.debug = 4
+    def __init__(self, addr: Tuple[str, int], reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.addr   = addr
+        self.reader = reader
+        self.writer = writer
+        self.tagnum = 0
+        self.capabilities: Tuple[str, ...] = ()
+
+        # The history of the session using the connection.
+        self.history: history.History | None = None
+
+        # The recorder of the session using the connection, if it is recorded.
+        self.recorder: record.Recorder | None = None
+
+        # State the connection is left in by a session.
+        self.authenticated = False
+        self.selected      = False
+        self.dirty         = False
+
+    def next_tag(self) -> str:
+        self.tagnum += 1
+        return f"OAUTH2IMAP{self.tagnum}"
+
+    async def command(self, cmd: str,
+                      interact: Callable[[bytes], bytes] | None = None) -> Tuple[str, List[bytes]]:
+        """Run a command of the proxy itself and collect its untagged responses."""
+        tag = self.next_tag()
+        if self.history:
+            self.history.add("<U", f"{tag} {cmd}".encode())
+        logger.debug("<--   upstream: %s: %s %s", self.addr, tag, cmd)
+        await self.send_bytes(f"{tag} {cmd}{CRLF}".encode())
+
+        data: List[bytes] = []
+
+        while True:
+            line = await self.recv_bytes()
+            if line == b"":
+                raise UpstreamClosed("upstream closed the connection")
+
+            rtag, status = parse_server_command(line)
+
+            if rtag == "+":
+                await self.send_bytes((interact(line) if interact else b"") + CRLF.encode())
+                continue
+
+            if rtag == tag:
+                return status, data
+
+            data.append(line)
+
+    async def greeting(self) -> None:
+        line = await self.recv_bytes()
+
+        tag, status = parse_server_command(line)
+        if tag != "*" or status not in ("OK", "PREAUTH"):
+            raise ConnectionError(f"unexpected upstream greeting: {line!r}")
 
-    def authenticate(self, config: Dict[str,Any]) -> bool:
+        typ, dat = await self.command("CAPABILITY")
+        if typ != "OK":
+            raise ConnectionError(f"unable to get upstream capabilities: {dat!r}")
+
+        for line in dat:
+            words = line.decode("utf-8", "replace").upper().split()
+            if words[:2] == ["*", "CAPABILITY"]:
+                self.capabilities = tuple(words[2:])
+
+        upstream_capabilities[self.addr] = self.capabilities
+
+    async def authenticate(self, config: Dict[str,Any]) -> bool:
+        started = time.monotonic()
+
+        if await self.do_authenticate(config):
+            metrics.upstream_auth.observe(time.monotonic() - started)
+            return True
+
+        metrics.upstream_auth_failures.inc()
+        return False
+
+    async def do_authenticate(self, config: Dict[str,Any]) -> bool:
         logger.debug("authenticate account on the upstream server ...")
 
-        token = oauth2.get_access_token(config)
+        loop = asyncio.get_running_loop()
+
+        token = await loop.run_in_executor(None, oauth2.get_access_token, config)
         if not token:
             logger.critical("%s: unable to get access token", self.addr)
             return False
@@ -157,12 +467,28 @@ class Upstream:
         if not provider:
             return False
 
-        def auth_string(_: Any) -> bytes | None:
-            return oauth2.sasl_string(provider, token)
+        sasl = oauth2.sasl_string(provider, token)
+        if not sasl:
+            logger.critical("%s: unsupported sasl method '%s'", self.addr, provider["sasl-method"])
+            return False
+
+        challenges = 0
+
+        def auth_string(_: bytes) -> bytes:
+            nonlocal challenges
+            challenges += 1
+            #
+            # The server sends a second challenge only to report an error.
+            # An empty response cancels the authentication exchange.
+            #
+            if challenges > 1:
+                return b""
+            return base64.b64encode(sasl)
 
         try:
-            typ, dat = self.imap.authenticate("XOAUTH2", auth_string)
+            typ, dat = await self.command(f"AUTHENTICATE {provider['sasl-method']}", auth_string)
             if typ == "OK":
+                self.authenticated = True
                 return True
             logger.critical("%s: %s", self.addr, dat)
         except Exception as e:
@@ -170,151 +496,110 @@ class Upstream:
 
         return False
 
-    def recv_bytes(self) -> Any:
-        line = self.imap.readline()
-        logger.debug("-->   upstream: %s: %s", self.addr, line)
-        return line
-
-    def send_bytes(self, msg: bytes) -> None:
-        logger.debug("<--   upstream: %s: %s", self.addr, msg)
-        self.imap.send(msg)
+    def buffered(self) -> int:
+        #
+        # The data received from the server and not read yet. StreamReader
+        # has no public way to tell, so this looks at its private buffer.
+        # Without it every line would look like the last one and be flushed
+        # to the client at once.
+        #
+        return len(getattr(self.reader, "_buffer", b""))
 
+    async def recv_bytes(self) -> bytes:
+        line = await self.reader.readline()
 
-def session(config: Dict[str,Any], ds: Downstream, up: Upstream) -> bool:
-    ctx = Context({})
+        if self.history:
+            self.history.add("U>", line)
+        if self.recorder:
+            self.recorder.received(line)
 
-    if "downstream" in config:
-        for param in ("username", "password"):
-            if param in config["downstream"]:
-                ctx[param] = config["downstream"][param]
+        if logger.isEnabledFor(logging.DEBUG):
+            # Status lines and continuation requests, the data only when tracing.
+            tag, status = parse_server_command(line)
+            logger.log(logging.DEBUG if status or tag == "+" else TRACE,
+                       "-->   upstream: %s: %s", self.addr, line)
 
-    session = True
-    authorized = False
+        return line
 
+    async def recv_literal(self, size: int) -> bytes:
+        try:
+            data = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            logger.critical("Ouch! literal size mismatch!")
+            raise UpstreamClosed("upstream closed the connection inside a literal") from e
+
+        if self.history:
+            self.history.literal("U>", data)
+        if self.recorder:
+            self.recorder.received(data)
+
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "-->   upstream: %s: %s", self.addr, data)
+        return data
+
+    async def send_bytes(self, msg: bytes) -> None:
+        # The commands are logged as they are received from the client.
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "<--   upstream: %s: %s", self.addr, msg)
+        metrics.sent_bytes.inc(len(msg), "upstream")
+        if self.recorder:
+            self.recorder.sent(msg)
+        self.writer.write(msg)
+        await self.writer.drain()
+
+    async def close(self) -> None:
+        await close_writer(self.writer)
+
+
+async def close_writer(writer: asyncio.StreamWriter) -> None:
+    writer.close()
     try:
-        if not up.authenticate(config):
-            return False
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError) as e:
+        logger.debug("error while closing connection: %s", e)
 
-        ds.send(["*", "OK", "IMAP4rev1 Service Ready"])
 
-        #
-        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2
-        #
-        # All interactions transmitted by client and server are in the form
-        # of lines, that is, strings that end with a CRLF. The protocol
-        # receiver of an IMAP4rev2 client or server is reading either a line
-        # or a sequence of octets with a known count followed by a line.
-        #
-        while session:
-            if not ds.readable():
-                break
+def set_nodelay(sock: socket.socket) -> None:
+    #
+    # asyncio enables TCP_NODELAY only for sockets created with an explicit
+    # IPPROTO_TCP, which is not the case for sockets accepted by socketserver
+    # or by sock_accept() from a listening socket of create_server(). Without
+    # it small responses are held back by Nagle's algorithm.
+    #
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-            line = ds.recv_bytes()
 
-            if line == b"":
-                break
+async def open_downstream(addr: Any, sock: socket.socket) -> Downstream:
+    set_nodelay(sock)
 
-            if line.rstrip(CRLF.encode()) == b"":
-                continue
+    reader, writer = await asyncio.open_connection(sock=sock, limit=LINE_LIMIT)
+    return Downstream(addr, reader, writer)
 
-            #
-            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2.1
-            #
-            # The client command begins an operation. Each client command is
-            # prefixed with an identifier (typically a short alphanumeric
-            # string, e.g., A0001, A0002, etc.) called a "tag". A different
-            # tag is generated by the client for each command.
-            #
-            # There are two cases in which a line from the client does not
-            # represent a complete command. In one case, a command argument
-            # is quoted with an octet count; in the other case, the command
-            # arguments require server feedback (see the AUTHENTICATE
-            # command). In either case, the server sends a command
-            # continuation request response if it is ready for the octets
-            # (if appropriate) and the remainder of the command. This
-            # response is prefixed with the token "+".
-            #
-            tag, cmd, args = parse_client_command(line.decode("utf-8", "replace").rstrip(CRLF))
-            ctx["tag"] = tag
 
-            if cmd == "LOGOUT":
-                session = False
+async def open_downstream_pipe(addr: Any, rfile: Any, wfile: Any) -> Downstream:
+    loop = asyncio.get_running_loop()
 
-            if not authorized:
-                if cmd == "CAPABILITY":
-                    ds.command_capability(ctx, up.imap.capabilities)
-                    continue
-                if cmd == "AUTHENTICATE":
-                    authorized = ds.command_authenticate(ctx, args)
-                    continue
-                if cmd == "LOGIN":
-                    authorized = ds.command_login(ctx, args)
-                    continue
+    reader = asyncio.StreamReader(limit=LINE_LIMIT, loop=loop)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), rfile)
 
-            up.send_bytes(line)
+    transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), loop=loop), wfile)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
 
-            literal_size = 0
+    return Downstream(addr, reader, writer)
 
-            #
-            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7
-            #
-            # Server responses are in three forms: status responses, server
-            # data, and command continuation requests.
-            #
-            # The client MUST be prepared to accept any response at all
-            # times.
-            #
-            while True:
-                line = up.recv_bytes()
-                ds.send_bytes(line)
-
-                #
-                # We don't need to look for the tag and command completion
-                # status inside the string literal.
-                #
-                if literal_size > 0:
-                    literal_size -= len(line)
-
-                    if literal_size < 0:
-                        logger.critical("Ouch! literal size mismatch!")
-                        literal_size = 0
-                    continue
-
-                #
-                # From: https://datatracker.ietf.org/doc/html/rfc9051#section-4.3
-                #
-                # A synchronizing literal is a sequence of zero or more octets
-                # (including CR and LF), prefix-quoted with an octet count in
-                # the form of an open brace ("{"), the number of octets, a close
-                # brace ("}"), and a CRLF. In the case of synchronizing literals
-                # transmitted from server to client, the CRLF is immediately
-                # followed by the octet data.
-                #
-                m = re.match(LiteralRe, line)
-                if m:
-                    literal_size = int(m.group("size"))
-                    continue
-
-                tag, status = parse_server_command(line.decode("utf-8", "replace").rstrip(CRLF))
-
-                #
-                # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.1.5
-                #
-                # The BYE response is always untagged and indicates that the
-                # server is about to close the connection.
-                #
-                if tag == "*" and status == "BYE":
-                    session = False
-                    break
-
-                if status and tag == ctx["tag"]:
-                    break
-
-    except (BrokenPipeError, ConnectionResetError) as e:
-        logger.debug("session connection error: %s", e)
-
-    except Exception as e:
-        logger.critical("session got exception: %s", repr(e))
-        return False
 
-    return True
+async def open_upstream(addr: str, port: int) -> Upstream:
+    reader, writer = await asyncio.open_connection(addr, port,
+                                                   ssl=ssl.create_default_context(),
+                                                   limit=LINE_LIMIT)
+    up = Upstream((addr, port), reader, writer)
+
+    try:
+        await up.greeting()
+    except BaseException:
+        await up.close()
+        raise
+
+    return up
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import re
+import time
+
+from typing import Any, Dict, List, Tuple
+
+import oauth2imap
+import oauth2imap.metrics as metrics
+
+logger = oauth2imap.logger
+
+# Commands answered from the cache and the untagged responses kept for them.
+COMMANDS = {
+    "LIST":      (b"LIST", b"STATUS"),
+    "LSUB":      (b"LSUB",),
+    "NAMESPACE": (b"NAMESPACE",),
+    "STATUS":    (b"STATUS",),
+}
+
+# Entries kept per account.
+MAX_ENTRIES = 4096
+
+# The FETCH items that set the \Seen flag.
+SEEN_ITEMS = re.compile(rb"(?:\b(?:BODY|BINARY)\[|\bRFC822(?:\.TEXT)?(?![.\w]))", re.IGNORECASE)
+
+# What a command changes: all the responses of the account, or the STATUS of
+# one mailbox (or of all mailboxes when no name is given).
+Change = Tuple[str, bytes]
+
+
+class Entry:
+    __slots__ = ("expires", "verb", "mailbox", "lines", "completion", "elapsed")
+
+    def __init__(self, expires: float, verb: str, mailbox: bytes,
+                 lines: List[bytes], completion: bytes, elapsed: float):
+        self.expires    = expires
+        self.verb       = verb
+        self.mailbox    = mailbox
+        self.lines      = lines
+        # The tagged response without the tag.
+        self.completion = completion
+        # How long the server took to answer.
+        self.elapsed    = elapsed
+
+
+class MetadataCache:
+    """Responses to the mailbox metadata commands by account."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.accounts: Dict[str, Dict[bytes, Entry]] = {}
+        # Counts the entries put so far.
+        self.puts = 0
+
+    def get(self, account: str, key: bytes) -> Entry | None:
+        entries = self.accounts.get(account)
+        if not entries:
+            return None
+
+        entry = entries.get(key)
+        if entry and entry.expires <= time.monotonic():
+            del entries[key]
+            return None
+
+        return entry
+
+    def put(self, account: str, key: bytes, entry: Entry) -> None:
+        entries = self.accounts.setdefault(account, {})
+
+        if len(entries) >= MAX_ENTRIES:
+            now = time.monotonic()
+            for k in [k for k, v in entries.items() if v.expires <= now]:
+                del entries[k]
+            if len(entries) >= MAX_ENTRIES:
+                entries.clear()
+
+        entries[key] = entry
+        self.puts += 1
+
+    def invalidate(self, account: str, change: Change) -> None:
+        scope, mailbox = change
+
+        if scope == "all":
+            self.accounts.pop(account, None)
+            return
+
+        # A LIST with the STATUS return option holds the status as well.
+        entries = self.accounts.get(account, {})
+        for key in [k for k, v in entries.items()
+                    if (v.verb == "STATUS" and (not mailbox or v.mailbox == mailbox)) or
+                    (v.verb == "LIST" and any(line.startswith(b"* STATUS ") for line in v.lines))]:
+            del entries[key]
+
+
+def change(cmd: str, args: bytes, mailbox: bytes, selected: bytes) -> Change | None:
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-6.3.11
+    #
+    # The STATUS command requests status information on the indicated
+    # mailbox.
+    #
+    # Mailboxes coming and going change what LIST and LSUB return. Messages
+    # coming, going and changing flags change the status of a mailbox.
+    #
+    if cmd == "UID":
+        cmd = args.split(b" ", 1)[0].upper().decode("ascii", "replace")
+
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-6.4.5
+    #
+    # The \Seen flag is implicitly set; if this causes the flags to change,
+    # they SHOULD be included as part of the FETCH responses.
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-6.4.1
+    #
+    # The CLOSE command permanently removes all messages that have the
+    # \Deleted flag set from the currently selected mailbox.
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc3501#section-2.3.2
+    #
+    # \Recent  Message is "recently" arrived in this mailbox.  This session
+    #          is the first session to have been notified about this
+    #          message; ...
+    #
+    # A SELECT takes the \Recent flags, an EXAMINE leaves them.
+    #
+    match cmd:
+        case "CREATE" | "DELETE" | "RENAME" | "SUBSCRIBE" | "UNSUBSCRIBE":
+            return ("all", b"")
+        case "APPEND" | "SELECT":
+            return ("status", mailbox)
+        case "EXPUNGE" | "STORE" | "CLOSE":
+            return ("status", selected)
+        case "FETCH" if SEEN_ITEMS.search(args):
+            return ("status", selected)
+        case "COPY" | "MOVE":
+            return ("status", b"")
+
+    return None
+
+
+class Session:
+    """The metadata cache as used by one client session."""
+
+    def __init__(self, cache: MetadataCache, account: str):
+        self.cache   = cache
+        self.account = account
+
+        # The command whose response is being collected (the tag, the key,
+        # the entry and when it was sent), and what the pending commands
+        # change.
+        self.collecting: Tuple[str, bytes, Entry, float] | None = None
+        self.changes: Dict[str, Change] = {}
+
+        # The last mailbox made stale and the number of entries put by then.
+        self.stale: Tuple[bytes, int] | None = None
+
+    @staticmethod
+    def key(cmd: str, args: bytes) -> bytes:
+        return cmd.encode() + b" " + args.rstrip(b"\r\n")
+
+    def get(self, cmd: str, args: bytes) -> Entry | None:
+        return self.cache.get(self.account, self.key(cmd, args))
+
+    def hit(self, entry: Entry) -> None:
+        metrics.metadata_cache.inc(value="hit")
+        metrics.metadata_cache_saved.inc(entry.elapsed)
+
+    def miss(self, tag: str, cmd: str, args: bytes, mailbox: bytes, collect: bool) -> None:
+        metrics.metadata_cache.inc(value="miss")
+
+        # The response can be told apart only when nothing else is in flight.
+        if collect:
+            entry = Entry(0, cmd, mailbox if cmd == "STATUS" else b"", [], b"", 0)
+            self.collecting = (tag, self.key(cmd, args), entry, time.monotonic())
+
+    def command(self, tag: str, cmd: str, args: bytes, mailbox: bytes, selected: bytes) -> None:
+        # Another command would mix its responses into the collected ones.
+        self.collecting = None
+
+        changed = change(cmd, args, mailbox, selected)
+        if changed:
+            self.changes[tag] = changed
+
+    def untagged(self, line: bytes, word: bytes, rest: bytes,
+                 selecting: Dict[str, bytes], selected: bytes) -> None:
+        if self.collecting and word in COMMANDS[self.collecting[2].verb]:
+            self.collecting[2].lines.append(line)
+            return
+
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.4.1
+        #
+        # The EXISTS response reports the number of messages in the mailbox.
+        # This response occurs if the size of the mailbox changes (e.g., new
+        # messages).
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.5.1
+        #
+        # The EXPUNGE response reports that the specified message sequence
+        # number has been permanently removed from the mailbox.
+        #
+        # Flags changed by other sessions come as FETCH responses with FLAGS.
+        #
+        if rest in (b"EXISTS\r\n", b"RECENT\r\n", b"EXPUNGE\r\n") or \
+                (rest.startswith(b"FETCH (") and b"FLAGS (" in rest):
+            for mailbox in list(selecting.values()) or [selected]:
+                self.invalidate(mailbox)
+
+    def invalidate(self, mailbox: bytes) -> None:
+        # A FETCH of many messages would go over all the entries for each line.
+        if self.stale != (mailbox, self.cache.puts):
+            self.cache.invalidate(self.account, ("status", mailbox))
+            self.stale = (mailbox, self.cache.puts)
+
+    def literal(self) -> None:
+        # Responses with literals are not cached.
+        self.collecting = None
+
+    def completed(self, tag: str, line: bytes, status: str) -> None:
+        if self.collecting and self.collecting[0] == tag:
+            _, key, entry, sent = self.collecting
+            self.collecting = None
+
+            if status == "OK":
+                now = time.monotonic()
+                entry.expires = now + self.cache.ttl
+                entry.elapsed = now - sent
+                entry.completion = line[len(tag) + 1:]
+
+                self.cache.put(self.account, key, entry)
+
+        changed = self.changes.pop(tag, None)
+        if changed:
+            self.cache.invalidate(self.account, changed)
+
+
+cache: MetadataCache | None = None
+
+
+def setup(config: Dict[str, Any]) -> None:
+    global cache
+
+    ttl = float(config.get("metadata-cache", {}).get("ttl", 0))
+    if ttl > 0:
+        cache = MetadataCache(ttl)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import bisect
+import ctypes
+import http.server
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+
+from typing import Dict, List, Tuple, Any
+
+import oauth2imap
+
+logger = oauth2imap.logger
+
+#
+# Every thread counts into its own buffer without any locking. The buffers
+# are added to the values shared by all processes (an anonymous mapping made
+# before the server forks) when a session ends, at most once a second while
+# it runs, and right away for rare events. Until the first call to setup()
+# there is nothing to add them to and they are thrown away.
+#
+
+# Upper bounds of the histogram buckets in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Seconds between flushes of a busy session.
+FLUSH_INTERVAL = 1.0
+
+# Commands with a series of their own, all the others are counted as OTHER.
+COMMANDS = (
+    "APPEND", "AUTHENTICATE", "CAPABILITY", "CHECK", "CLOSE", "COPY", "CREATE",
+    "DELETE", "ENABLE", "EXAMINE", "EXPUNGE", "FETCH", "GETQUOTAROOT", "ID",
+    "IDLE", "LIST", "LOGIN", "LOGOUT", "LSUB", "MOVE", "NAMESPACE", "NOOP",
+    "RENAME", "SEARCH", "SELECT", "STATUS", "STORE", "SUBSCRIBE", "UID",
+    "UNSELECT", "UNSUBSCRIBE", "XLIST", "OTHER",
+)
+
+size = 0
+
+
+class Metric:
+    kind  = ""
+    width = 1
+
+    def __init__(self, name: str, description: str, label: str = "",
+                 values: Tuple[str, ...] = ("",)):
+        global size
+
+        self.name   = name
+        self.description = description
+        self.label  = label
+        self.values = values
+        self.index  = { v: i for i, v in enumerate(values) }
+        self.base   = size
+
+        size += self.width * len(values)
+        registry.append(self)
+
+    def slot(self, value: str) -> int:
+        # Unknown label values end up in the last series.
+        return self.base + self.index.get(value, len(self.values) - 1) * self.width
+
+    def series(self, value: str) -> str:
+        return f'{{{self.label}="{value}"}}' if self.label else ""
+
+    def render(self, data: List[float]) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for value in self.values:
+            num = data[self.slot(value)]
+            if num or not self.label:
+                lines.append(f"{self.name}{self.series(value)} {num:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, value: str = "") -> None:
+        buffer()[self.slot(value)] += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def add(self, amount: float, value: str = "") -> None:
+        # Gauges go straight to the shared values, a buffered one would be
+        # stale the whole time it matters.
+        if shared is not None:
+            with lock:
+                shared[self.slot(value)] += amount
+
+
+class Histogram(Metric):
+    kind  = "histogram"
+    width = len(BUCKETS) + 3
+
+    def observe(self, seconds: float, value: str = "") -> None:
+        buf  = buffer()
+        base = self.slot(value)
+
+        buf[base + bisect.bisect_left(BUCKETS, seconds)] += 1
+        buf[base + len(BUCKETS) + 1] += seconds
+        buf[base + len(BUCKETS) + 2] += 1
+
+    def render(self, data: List[float]) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+        for value in self.values:
+            base  = self.slot(value)
+            count = data[base + len(BUCKETS) + 2]
+
+            if not count and self.label:
+                continue
+
+            label = f'{self.label}="{value}",' if self.label else ""
+            total = 0.0
+
+            for i, bound in enumerate(BUCKETS + (float("inf"),)):
+                total += data[base + i]
+                le = "+Inf" if i == len(BUCKETS) else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{label}le="{le}"}} {total:g}')
+
+            lines.append(f"{self.name}_sum{self.series(value)} {data[base + len(BUCKETS) + 1]:g}")
+            lines.append(f"{self.name}_count{self.series(value)} {count:g}")
+
+        return lines
+
+
+registry: List[Metric] = []
+
+connections = Counter("oauth2imap_connections_total",
+                      "Client connections accepted.")
+sessions = Gauge("oauth2imap_sessions_active",
+                 "Client sessions in progress.")
+sent_bytes = Counter("oauth2imap_sent_bytes_total",
+                     "Bytes sent to the client (downstream) and to the server (upstream).",
+                     "direction", ("downstream", "upstream"))
+commands = Histogram("oauth2imap_command_duration_seconds",
+                     "Time from a client command to its tagged response from the server.",
+                     "command", COMMANDS)
+first_response = Histogram("oauth2imap_first_response_seconds",
+                           "Time from the connection to the first tagged response.")
+upstream_auth = Histogram("oauth2imap_upstream_auth_duration_seconds",
+                          "Time to get an access token and authenticate on the server.")
+upstream_auth_failures = Counter("oauth2imap_upstream_auth_failures_total",
+                                 "Failed authentications on the server.")
+token_requests = Counter("oauth2imap_token_requests_total",
+                         "Requests to the token endpoint by result.",
+                         "result", ("ok", "error"))
+body_cache = Counter("oauth2imap_body_cache_total",
+                     "Full message fetches served from the body cache, missed, and bodies stored.",
+                     "result", ("hit", "miss", "store"))
+metadata_cache = Counter("oauth2imap_metadata_cache_total",
+                         "LIST, LSUB, NAMESPACE and STATUS commands served from the cache or not.",
+                         "result", ("hit", "miss"))
+metadata_cache_saved = Counter("oauth2imap_metadata_cache_saved_seconds_total",
+                               "Upstream response time saved by the metadata cache hits.")
+idle_watches = Gauge("oauth2imap_idle_watches_active",
+                     "Upstream connections in IDLE shared by the clients of a mailbox.")
+idle_clients = Gauge("oauth2imap_idle_clients_active",
+                     "Clients in IDLE on a shared upstream connection.")
+
+local = threading.local()
+shared: "ctypes.Array[ctypes.c_double] | None" = None
+lock: Any = None
+
+
+def buffer() -> List[float]:
+    buf: List[float] | None = getattr(local, "buffer", None)
+    if buf is None:
+        buf = local.buffer = [0.0] * size
+        local.flushed = time.monotonic()
+    return buf
+
+
+def flush() -> None:
+    buf: List[float] | None = getattr(local, "buffer", None)
+    if buf is None:
+        return
+
+    local.buffer  = [0.0] * size
+    local.flushed = time.monotonic()
+
+    if shared is None:
+        return
+
+    with lock:
+        for i, num in enumerate(buf):
+            if num:
+                shared[i] += num
+
+
+def tick() -> None:
+    if time.monotonic() - getattr(local, "flushed", 0) >= FLUSH_INTERVAL:
+        flush()
+
+
+def __after_fork() -> None:
+    # Whatever the parent has counted is its own to flush.
+    local.buffer = None
+
+os.register_at_fork(after_in_child=__after_fork)
+
+
+def render() -> str:
+    flush()
+
+    if shared is None:
+        return ""
+
+    with lock:
+        data: List[float] = shared[:]
+
+    lines: List[str] = []
+    for metric in registry:
+        lines.extend(metric.render(data))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # pylint: disable=C0103
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_: Any) -> None:
+        pass
+
+
+def setup(config: Dict[str, Any]) -> bool:
+    global shared, lock
+
+    params = config.get("metrics", {})
+    if "port" not in params:
+        return False
+
+    # Anonymous mappings are shared with the children forked later.
+    shared = (ctypes.c_double * max(1, size)).from_buffer(mmap.mmap(-1, max(1, size) * 8))
+    lock = multiprocessing.Lock()
+
+    addr = (str(params.get("address", "127.0.0.1")), int(params["port"]))
+
+    server = http.server.ThreadingHTTPServer(addr, MetricsHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+
+    logger.info("metrics are served at http://%s:%d/metrics", addr[0], addr[1])
+    return True
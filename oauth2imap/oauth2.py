@@ -5,19 +5,21 @@
 __author__ = 'Alexey Gladkov <legion@kernel.org>'
 
 import os
-import os.path
-import fcntl
+import logging
 import json
 import hashlib
 import urllib.parse
 import urllib.request
 import string
 import pprint
+import threading
 
 from datetime import timedelta, datetime
-from typing import Dict, Any
+from typing import Dict, List, Tuple, Any
 
 import oauth2imap
+import oauth2imap.metrics as metrics
+import oauth2imap.tokenstore as tokenstore
 
 logger = oauth2imap.logger
 
@@ -35,6 +37,7 @@ def __register_google() -> None:
     providers["google"] = Provider({})
     providers["google"]["sasl-method"]         = "OAUTHBEARER"
     providers["google"]["imap-endpoint"]       = "imap.gmail.com"
+    providers["google"]["imap-port"]           = "993"
     providers["google"]["client-id"]           = ""
     providers["google"]["client-secret"]       = ""
     providers["google"]["username"]            = ""
@@ -48,6 +51,7 @@ def __register_microsoft() -> None:
     providers["microsoft"] = Provider({})
     providers["microsoft"]["sasl-method"]        = "XOAUTH2"
     providers["microsoft"]["imap-endpoint"]      = "outlook.office365.com"
+    providers["microsoft"]["imap-port"]          = "993"
     providers["microsoft"]["client-id"]          = ""
     providers["microsoft"]["client-secret"]      = ""
     providers["microsoft"]["username"]           = ""
@@ -66,24 +70,43 @@ def get_provider(name: str) -> Provider | None:
     return providers.get(name, None)
 
 
-def get_upstream_provider(config: Dict[str,Any]) -> Provider | None:
-    if "provider" not in config["upstream"]:
+class ResolvedProvider(Provider):
+    """A provider with the config applied. It is shared and read-only."""
+
+    def __init__(self, data: Dict[str,str]):
+        super().__init__(data)
+        self.token_key = get_token_key(self)
+
+    def __readonly(self, *args: Any, **kwargs: Any) -> Any:
+        raise TypeError("resolved provider is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = __readonly # type: ignore[assignment, unused-ignore]
+    clear = pop = popitem = setdefault = update = __readonly # type: ignore[assignment, unused-ignore]
+
+
+# Resolved providers keyed by the upstream section of the config they were
+# resolved from, along with a copy of that section.
+resolved_providers: Dict[int, Tuple[Dict[str,Any], ResolvedProvider]] = {}
+
+
+def resolve_provider(upstream: Dict[str,Any]) -> ResolvedProvider | None:
+    if "provider" not in upstream:
         logger.critical("provider required")
         return None
 
-    if config["upstream"]["provider"] not in providers:
-        logger.critical("unknown provider '%s'", config["upstream"]["provider"])
+    if upstream["provider"] not in providers:
+        logger.critical("unknown provider '%s'", upstream["provider"])
         return None
 
-    provider = get_provider(config["upstream"]["provider"])
+    provider = get_provider(upstream["provider"])
     if not provider:
         return None
 
     new = Provider({})
 
     for key in provider.keys():
-        if key in config["upstream"]:
-            new[key] = str(config["upstream"][key])
+        if key in upstream:
+            new[key] = str(upstream[key])
         else:
             new[key] = provider[key]
 
@@ -91,39 +114,41 @@ def get_upstream_provider(config: Dict[str,Any]) -> Provider | None:
         s = string.Template(new[key]).safe_substitute(new)
         new[key] = s
 
-    return new
+    return ResolvedProvider(new)
 
 
-def get_token_cache(filename: str) -> Dict[str,Token]:
-    if not os.path.exists(filename):
-        return {}
+def get_upstream_provider(config: Dict[str,Any]) -> Provider | None:
+    upstream = config["upstream"]
 
-    fp = os.open(filename, os.O_RDONLY)
-    fcntl.flock(fp, fcntl.LOCK_SH)
+    #
+    # The provider is resolved once per config. The copy of the section
+    # catches a config that has been changed or a new one that happens to
+    # reuse the address of a freed one.
+    #
+    cached = resolved_providers.get(id(upstream))
+    if cached and cached[0] == upstream:
+        return cached[1]
 
-    with os.fdopen(fp, "r", encoding="utf-8") as file:
-        data = file.read() or "{}"
+    provider = resolve_provider(upstream)
+    if provider:
+        resolved_providers[id(upstream)] = (dict(upstream), provider)
 
-    cache: Dict[str,Token] = json.loads(data or "{}")
-    return cache
+    return provider
 
 
-def write_token(config: Dict[str,Any], provider: Provider, token: Token) -> None:
-    filename = config["upstream"]["tokens-file"]
+def get_token_store(config: Dict[str,Any]) -> tokenstore.TokenStore:
+    return tokenstore.open_store(config["upstream"]["tokens-file"])
 
-    fp = os.open(filename, os.O_CREAT|os.O_RDWR, 0o600)
-    fcntl.flock(fp, fcntl.LOCK_EX)
 
-    with os.fdopen(fp, "w+", encoding="utf-8") as file:
-        data = file.read() or "{}"
-        cache = json.loads(data)
+def read_token(config: Dict[str,Any], provider: Provider) -> Token | None:
+    token = get_token_store(config).get(get_token_key(provider))
+    if not token:
+        return None
+    return Token(token)
 
-        token_key = get_token_key(provider)
-        cache[token_key] = token
 
-        os.ftruncate(fp, 0)
-        file.seek(0)
-        json.dump(cache, file, indent=4, sort_keys=True)
+def write_token(config: Dict[str,Any], provider: Provider, token: Token) -> None:
+    get_token_store(config).put(get_token_key(provider), token)
 
 
 def valid_token(token: Token) -> bool:
@@ -134,7 +159,17 @@ def valid_token(token: Token) -> bool:
     return False
 
 
+def token_lifetime(token: Token | None) -> float:
+    if token and token.get("access_token_expiration"):
+        exp = datetime.fromisoformat(token["access_token_expiration"])
+        return (exp - datetime.now()).total_seconds()
+    return 0
+
+
 def get_token_key(provider: Provider) -> str:
+    if isinstance(provider, ResolvedProvider) and hasattr(provider, "token_key"):
+        return provider.token_key
+
     data = []
     for key in ("authorize-endpoint", "tenant", "client-secret", "client-id", "username"):
         if key in provider:
@@ -144,6 +179,17 @@ def get_token_key(provider: Provider) -> str:
 
 
 def get_token(provider: Provider, params: Dict[str,str]) -> Token | None:
+    token = None
+    try:
+        token = request_token(provider, params)
+        return token
+    finally:
+        metrics.token_requests.inc(value="ok" if token else "error")
+        # Token requests are rare and come from any thread.
+        metrics.flush()
+
+
+def request_token(provider: Provider, params: Dict[str,str]) -> Token | None:
     try:
         #
         # From: https://datatracker.ietf.org/doc/html/rfc6749#section-4.1.3
@@ -169,7 +215,8 @@ def get_token(provider: Provider, params: Dict[str,str]) -> Token | None:
     response = response.read()
     result = json.loads(response)
 
-    logger.debug(pprint.pformat(result))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", pprint.pformat(result))
 
     if "access_token" in result:
         d = {
@@ -213,24 +260,60 @@ def do_refresh_token(provider: Provider, token: Token) -> Token | None:
     return get_token(provider, params)
 
 
-def get_access_token(config: Dict[str,Any]) -> str | None:
-    cache = get_token_cache(config["upstream"]["tokens-file"])
+refresh_locks: Dict[str, threading.Lock] = {}
+refresh_locks_guard = threading.Lock()
+
+
+def __reset_refresh_locks() -> None:
+    global refresh_locks_guard
 
+    # Only the forking thread survives in the child.
+    refresh_locks_guard = threading.Lock()
+    refresh_locks.clear()
+
+os.register_at_fork(after_in_child=__reset_refresh_locks)
+
+
+def refresh_token(config: Dict[str,Any], provider: Provider, token: Token,
+                  min_lifetime: float = 0) -> Token | None:
+    #
+    # Only one refresh of a token is in flight at a time. Threads of the
+    # process queue up on a lock, processes on a lease of the token store.
+    # Whoever comes next finds the new token in the store and uses it
+    # instead of asking the token endpoint again.
+    #
+    store = get_token_store(config)
+    token_key = get_token_key(provider)
+
+    with refresh_locks_guard:
+        lock = refresh_locks.setdefault(token_key, threading.Lock())
+
+    with lock, store.lease():
+        stored = read_token(config, provider)
+
+        if stored and stored.get("access_token") != token.get("access_token") and \
+           token_lifetime(stored) > min_lifetime:
+            logger.debug("token has already been refreshed")
+            return stored
+
+        new = do_refresh_token(provider, stored or token)
+
+        if new:
+            write_token(config, provider, new)
+
+        return new
+
+
+def get_valid_token(config: Dict[str,Any]) -> Token | None:
     provider = get_upstream_provider(config)
     if not provider:
         return None
 
-    token_key = get_token_key(provider)
-    token = None
-
-    if token_key in cache:
-        token = cache[token_key]
+    token = read_token(config, provider)
 
+    if token:
         if not valid_token(token):
-            token = do_refresh_token(provider, token)
-
-            if token:
-                write_token(config, provider, token)
+            token = refresh_token(config, provider, token)
 
     if not token:
         logger.critical("no valid access token")
@@ -240,13 +323,169 @@ def get_access_token(config: Dict[str,Any]) -> str | None:
         logger.critical("unable to get actual access token")
         return None
 
+    return token
+
+
+class TokenBroker:
+    """Keeps access tokens in memory and refreshes them before they expire."""
+
+    # Seconds to wait before retrying a failed refresh.
+    retry = 60.0
+
+    def __init__(self, margin: float):
+        self.margin  = margin
+        # Accounts can have a margin of their own.
+        self.margins: Dict[str, float] = {}
+        self.tokens:  Dict[str, Token] = {}
+        self.configs: Dict[str, Dict[str,Any]] = {}
+        self.lock    = threading.Lock()
+        self.wakeup  = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def after_fork(self) -> None:
+        # Only the forking thread survives in the child.
+        self.lock   = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def add(self, config: Dict[str,Any]) -> None:
+        provider = get_upstream_provider(config)
+        if not provider:
+            return
+
+        token_key = get_token_key(provider)
+        token = read_token(config, provider)
+
+        with self.lock:
+            self.configs[token_key] = config
+            self.margins[token_key] = float(config["upstream"].get("refresh-margin", self.margin))
+            if token:
+                self.tokens[token_key] = token
+
+        self.wakeup.set()
+
+    def get(self, config: Dict[str,Any]) -> Token | None:
+        provider = get_upstream_provider(config)
+        if not provider:
+            return None
+
+        token_key = get_token_key(provider)
+
+        with self.lock:
+            token = self.tokens.get(token_key)
+
+        if token and valid_token(token):
+            return token
+
+        # Not refreshed in time, so do it the slow way.
+        token = get_valid_token(config)
+
+        if token:
+            with self.lock:
+                self.configs[token_key] = config
+                self.tokens[token_key] = token
+
+        return token
+
+    def refresh(self, token_key: str) -> float:
+        with self.lock:
+            config = self.configs[token_key]
+            token = self.tokens.get(token_key)
+            margin = self.margins.get(token_key, self.margin)
+
+        lifetime = token_lifetime(token)
+        if lifetime > margin:
+            return lifetime - margin
+
+        provider = get_upstream_provider(config)
+        if not provider:
+            return self.retry
+
+        # The token might have been refreshed by someone else already.
+        stored = read_token(config, provider)
+
+        if token_lifetime(stored) > token_lifetime(token):
+            token = stored
+
+        if not token:
+            logger.critical("no token to refresh")
+            return self.retry
+
+        if token_lifetime(token) <= margin:
+            logger.info("refreshing access token in advance ...")
+
+            token = refresh_token(config, provider, token, margin)
+
+        if not token:
+            logger.critical("unable to refresh access token in advance")
+            return self.retry
+
+        with self.lock:
+            self.tokens[token_key] = token
+
+        #
+        # Tokens that live shorter than the margin are refreshed halfway
+        # through their lifetime.
+        #
+        lifetime = token_lifetime(token)
+        return max(1.0, lifetime - margin, lifetime / 2)
+
+    def run(self) -> None:
+        while True:
+            delay = 3600.0
+
+            for token_key in list(self.configs):
+                try:
+                    delay = min(delay, self.refresh(token_key))
+                except Exception as e:
+                    logger.critical("token refresh got exception: %s", repr(e))
+                    delay = min(delay, self.retry)
+
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="token-broker", daemon=True)
+        self.thread.start()
+
+
+broker: TokenBroker | None = None
+
+
+def __reset_broker() -> None:
+    if broker:
+        broker.after_fork()
+
+os.register_at_fork(after_in_child=__reset_broker)
+
+
+def start_broker(configs: List[Dict[str,Any]]) -> TokenBroker:
+    global broker
+
+    broker = TokenBroker(300)
+    for config in configs:
+        broker.add(config)
+    broker.start()
+
+    return broker
+
+
+def get_access_token(config: Dict[str,Any]) -> str | None:
+    if broker:
+        token = broker.get(config)
+    else:
+        token = get_valid_token(config)
+
+    if not token:
+        return None
+
     return str(token["access_token"])
 
 
 def sasl_string(provider: Provider, token: str) -> bytes | None:
     user = provider["username"]
     host = provider["imap-endpoint"]
-    port = 993
+    port = provider["imap-port"]
 
     if provider["sasl-method"] == "OAUTHBEARER":
         return f"n,a={user},\x01host={host}\x01port={port}\x01auth=Bearer {token}\x01\x01".encode()
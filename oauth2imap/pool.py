@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import asyncio
+import time
+
+from typing import Dict, List, Tuple, Any
+
+import oauth2imap
+import oauth2imap.oauth2 as oauth2
+import oauth2imap.imap as imap
+
+logger = oauth2imap.logger
+
+
+class Pool:
+    """Keeps authenticated upstream connections between downstream sessions."""
+
+    def __init__(self, config: Dict[str, Any]):
+        params = config.get("pool", {})
+
+        # Idle connections kept per account.
+        self.size = int(params.get("size", 0))
+        # Idle connections opened in advance per account.
+        self.min_idle = min(self.size, int(params.get("min-idle", 0)))
+        # Seconds an idle connection is kept.
+        self.idle_ttl = float(params.get("idle-ttl", 300))
+        # Seconds between NOOPs sent to idle connections.
+        self.keepalive = float(params.get("keepalive", 60))
+
+        self.hits   = 0
+        self.misses = 0
+
+        self.idle: Dict[str, List[Tuple[float, imap.Upstream]]] = {}
+        self.accounts: Dict[str, Dict[str, Any]] = {}
+        self.task: asyncio.Task[None] | None = None
+
+    def limits(self, config: Dict[str, Any]) -> Tuple[int, int]:
+        # Accounts can have limits of their own.
+        params = config.get("pool", {})
+        size = int(params.get("size", self.size))
+        return size, min(size, int(params.get("min-idle", self.min_idle)))
+
+    def enabled(self, configs: List[Dict[str, Any]]) -> bool:
+        return any(self.limits(config)[0] > 0 for config in configs)
+
+    async def acquire(self, config: Dict[str, Any], provider: oauth2.Provider) -> imap.Upstream:
+        key = oauth2.get_token_key(provider)
+        self.accounts[key] = config
+
+        idle = self.idle.get(key, [])
+
+        while idle:
+            _, up = idle.pop()
+            if up.reader.at_eof() or up.buffered():
+                await up.close()
+                continue
+
+            self.hits += 1
+            logger.debug("pool: reusing upstream connection (hits=%d, misses=%d)",
+                         self.hits, self.misses)
+            return up
+
+        self.misses += 1
+        logger.debug("pool: opening upstream connection (hits=%d, misses=%d)",
+                     self.hits, self.misses)
+
+        return await imap.open_upstream(provider["imap-endpoint"], int(provider["imap-port"]))
+
+    async def release(self, config: Dict[str, Any], provider: oauth2.Provider,
+                      up: imap.Upstream) -> None:
+        key = oauth2.get_token_key(provider)
+        idle = self.idle.setdefault(key, [])
+
+        size, _ = self.limits(config)
+
+        # The untagged data left unread would reach the next client.
+        if (not up.authenticated or up.dirty or up.reader.at_eof() or up.buffered() or
+                len(idle) >= size):
+            await up.close()
+            return
+
+        try:
+            if up.selected:
+                if "UNSELECT" not in up.capabilities:
+                    await up.close()
+                    return
+
+                typ, _ = await up.command("UNSELECT")
+                if typ != "OK":
+                    await up.close()
+                    return
+
+                up.selected = False
+
+                # The server may have sent more right after UNSELECT.
+                if up.buffered():
+                    await up.close()
+                    return
+
+        except (OSError, ConnectionError) as e:
+            logger.debug("pool: unable to reset upstream connection: %s", e)
+            await up.close()
+            return
+
+        self.accounts[key] = config
+        idle.append((time.monotonic(), up))
+
+    async def open(self, key: str) -> bool:
+        config = self.accounts[key]
+
+        provider = oauth2.get_upstream_provider(config)
+        if not provider:
+            return False
+
+        up = await imap.open_upstream(provider["imap-endpoint"], int(provider["imap-port"]))
+
+        if not await up.authenticate(config):
+            await up.close()
+            return False
+
+        self.idle.setdefault(key, []).append((time.monotonic(), up))
+        return True
+
+    async def maintain(self, key: str) -> None:
+        idle = self.idle.setdefault(key, [])
+        now = time.monotonic()
+
+        for entry in list(idle):
+            # The connection might have been handed out in the meantime.
+            if entry not in idle:
+                continue
+
+            idle.remove(entry)
+            since, up = entry
+
+            if now - since > self.idle_ttl:
+                await up.close()
+                continue
+
+            try:
+                typ, _ = await up.command("NOOP")
+            except (OSError, ConnectionError) as e:
+                logger.debug("pool: upstream connection is gone: %s", e)
+                typ = ""
+
+            if typ != "OK":
+                await up.close()
+                continue
+
+            idle.append(entry)
+
+        _, min_idle = self.limits(self.accounts[key])
+
+        while len(idle) < min_idle:
+            try:
+                if not await self.open(key):
+                    break
+            except OSError as e:
+                logger.critical("pool: unable to connect to upstream: %s", e)
+                break
+
+    async def maintenance(self) -> None:
+        while True:
+            await asyncio.sleep(self.keepalive)
+
+            for key in list(self.accounts):
+                await self.maintain(key)
+
+            logger.info("pool: idle=%d hits=%d misses=%d",
+                        sum(len(v) for v in self.idle.values()), self.hits, self.misses)
+
+    async def start(self, configs: List[Dict[str, Any]]) -> None:
+        for config in configs:
+            provider = oauth2.get_upstream_provider(config)
+            if provider:
+                self.accounts[oauth2.get_token_key(provider)] = config
+
+        await asyncio.gather(*[self.maintain(key) for key in list(self.accounts)])
+
+        self.task = asyncio.create_task(self.maintenance())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+        for idle in self.idle.values():
+            for _, up in idle:
+                await up.close()
+
+        self.idle = {}
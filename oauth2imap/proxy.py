@@ -0,0 +1,769 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import asyncio
+import time
+
+from typing import Awaitable, Callable, Dict, Set, Tuple, List, Any
+
+import oauth2imap
+import oauth2imap.bodycache as bodycache
+import oauth2imap.history as history
+import oauth2imap.imap as imap
+import oauth2imap.metacache as metacache
+import oauth2imap.metrics as metrics
+import oauth2imap.oauth2 as oauth2
+import oauth2imap.record as record
+import oauth2imap.trace as trace
+
+logger = oauth2imap.logger
+
+
+class Relay:
+    """Pumps both directions of a session at once."""
+
+    def __init__(self, ctx: imap.Context, ds: imap.Downstream, up: imap.Upstream, keep_upstream: bool = False,
+                 shared_idle: bool = False):
+        self.ctx = ctx
+        self.ds  = ds
+        self.up  = up
+
+        # Answer LOGOUT ourselves and leave the upstream logged in.
+        self.keep_upstream = keep_upstream
+
+        # Stop at an IDLE the session can wait out on a shared connection,
+        # and the tag and the line of that IDLE.
+        self.shared_idle = shared_idle
+        self.idling: Tuple[str, bytes] | None = None
+
+        # The client has enabled extensions that change the untagged responses.
+        self.extensions = False
+
+        self.closing = False
+
+        # The command the upstream server has asked to go on with.
+        self.continuation: str | None = None
+
+        # The command waiting for permission to send a literal.
+        self.literal: Tuple[str, asyncio.Future[bool]] | None = None
+
+        # Commands sent upstream and not yet completed by tag, and when they were sent.
+        self.pending: Dict[str, Tuple[str, float]] = {}
+        self.quiet = asyncio.Event()
+        self.quiet.set()
+
+        # Spans of the sampled commands among the pending ones.
+        self.tracer = trace.tracer
+        self.spans: Dict[str, trace.Span] = {}
+
+        # The mailboxes being selected by tag and the selected one, how it
+        # was selected and its UIDVALIDITY.
+        self.selecting: Dict[str, bytes] = {}
+        self.selected_mailbox = b""
+        self.selected_command = ""
+        self.selected_uidvalidity = 0
+
+        # The UIDVALIDITY reported by the SELECT in progress.
+        self.uidvalidity = 0
+
+        # Message bodies are cached by the selected mailbox and its UIDVALIDITY.
+        self.bodies: bodycache.Session | None = None
+        if bodycache.cache:
+            self.bodies = bodycache.Session(bodycache.cache, ctx.get("account", ""))
+
+        # Tags of our own commands, which the client does not know about.
+        self.internal: Set[str] = set()
+
+        # The responses to the metadata commands by account.
+        self.metacache: metacache.Session | None = None
+        if metacache.cache:
+            self.metacache = metacache.Session(metacache.cache, ctx.get("account", ""))
+
+    def command_sent(self, tag: str, cmd: str) -> None:
+        self.pending[tag] = (cmd, time.monotonic())
+        self.quiet.clear()
+
+    def command_completed(self, tag: str) -> str:
+        cmd, sent = self.pending.pop(tag)
+        if not self.pending:
+            self.quiet.set()
+
+        metrics.commands.observe(time.monotonic() - sent, cmd)
+        metrics.tick()
+
+        return cmd
+
+    async def logout(self) -> None:
+        #
+        # Answer only when nothing is in flight so that our own responses
+        # do not get mixed into the responses of the upstream server.
+        #
+        await self.quiet.wait()
+
+        await self.ds.send(["*", "BYE", "IMAP4rev1 Server logging out"])
+        await self.ds.send([self.ctx["tag"], "OK", "LOGOUT completed"])
+
+    async def downstream_loop(self) -> None:
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2
+        #
+        # All interactions transmitted by client and server are in the form
+        # of lines, that is, strings that end with a CRLF. The protocol
+        # receiver of an IMAP4rev2 client or server is reading either a line
+        # or a sequence of octets with a known count followed by a line.
+        #
+        while not self.closing and self.ds.readable():
+            line = await self.ds.recv_bytes()
+            received = time.monotonic() if self.tracer else 0.0
+
+            if line == b"":
+                break
+
+            #
+            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2.1
+            #
+            # There are two cases in which a line from the client does not
+            # represent a complete command. In one case, a command argument
+            # is quoted with an octet count; in the other case, the command
+            # arguments require server feedback (see the AUTHENTICATE
+            # command). In either case, the server sends a command
+            # continuation request response if it is ready for the octets
+            # (if appropriate) and the remainder of the command. This
+            # response is prefixed with the token "+".
+            #
+            if self.continuation is not None:
+                self.continuation = None
+                await self.up.send_bytes(line)
+                continue
+
+            if line.rstrip(imap.CRLF.encode()) == b"":
+                continue
+
+            #
+            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-2.2.1
+            #
+            # The client command begins an operation. Each client command is
+            # prefixed with an identifier (typically a short alphanumeric
+            # string, e.g., A0001, A0002, etc.) called a "tag". A different
+            # tag is generated by the client for each command.
+            #
+            try:
+                tag, cmd, args = imap.parse_client_command(line)
+            except ValueError:
+                # Not a command at all. Let the upstream server judge.
+                await self.up.send_bytes(line)
+                continue
+
+            self.ctx["tag"] = tag
+
+            if cmd == "LOGOUT" and self.keep_upstream:
+                await self.logout()
+                break
+
+            if cmd in ("SELECT", "EXAMINE"):
+                if self.bodies:
+                    self.bodies.select(b"", 0)
+                self.selecting[tag] = imap.mailbox_name(args)
+
+            elif cmd == "UID" and self.bodies and not self.pending:
+                line = await self.cached_fetch(tag, args) or line
+
+            elif cmd == "ENABLE":
+                self.extensions = True
+
+            elif (cmd == "IDLE" and self.shared_idle and self.selected_mailbox and
+                  not self.extensions and not self.pending and not self.internal):
+                self.idling = (tag, line)
+                break
+
+            if self.metacache:
+                mailbox = imap.mailbox_name(args) if cmd in ("APPEND", "STATUS", "SELECT") else b""
+
+                self.metacache.command(tag, cmd, args, mailbox, self.selected_mailbox)
+
+                if cmd in metacache.COMMANDS and await self.cached_response(tag, cmd, args, line, mailbox):
+                    continue
+
+            self.command_sent(tag, cmd)
+
+            span = self.tracer.start(tag, cmd, received) if self.tracer else None
+            if span:
+                self.spans[tag] = span
+
+            await self.send_command(tag, line, span)
+
+            if cmd == "LOGOUT":
+                break
+
+        if not self.closing and any(cmd == "IDLE" for cmd, _ in self.pending.values()):
+            # The client has gone in IDLE, nobody is going to end it.
+            self.continuation = None
+            await self.up.send_bytes(b"DONE" + imap.CRLF.encode())
+
+        elif self.continuation is not None:
+            # The rest of the command is not coming, the upstream is left as is.
+            return
+
+        # Let the responses to the commands already sent reach the client.
+        await self.quiet.wait()
+
+    async def send_command(self, tag: str, line: bytes, span: trace.Span | None = None) -> None:
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-4.3
+        #
+        # In the case of synchronizing literals transmitted from client to
+        # server, the client MUST wait to receive a command continuation
+        # request (...) before sending the octet data (and the remainder of
+        # the command).
+        #
+        # The continuation request is passed to the client, which is waiting
+        # for it as well. The octets are not lines, so they are streamed
+        # upstream by count. A command can carry any number of literals.
+        #
+        if span:
+            span.sent = time.monotonic()
+            span.proxy += span.sent - span.received
+
+        while True:
+            size, sync = imap.parse_literal(line)
+
+            if size >= 0 and sync:
+                self.literal = (tag, asyncio.get_running_loop().create_future())
+
+            if span:
+                span.bytes_in += len(line) + max(size, 0)
+
+            await self.up.send_bytes(line)
+
+            if size < 0:
+                return
+
+            if self.literal:
+                accepted = await self.literal[1]
+                self.literal = None
+
+                # The server has rejected the command instead.
+                if not accepted:
+                    return
+
+            while size > 0:
+                chunk = await self.ds.recv_literal(min(size, imap.LITERAL_CHUNK))
+                await self.up.send_bytes(chunk)
+                size -= len(chunk)
+
+            # The remainder of the command.
+            line = await self.ds.recv_bytes()
+            if line == b"":
+                raise ConnectionResetError("client closed the connection inside a command")
+
+    async def cached_fetch(self, tag: str, args: bytes) -> bytes | None:
+        assert self.bodies
+
+        fetch = await self.bodies.fetch(tag, args)
+        if not fetch:
+            return None
+
+        line, store = fetch
+        if store:
+            seen = self.up.next_tag()
+            self.internal.add(seen)
+            if self.metacache:
+                self.metacache.command(seen, "UID", store[len(b"UID "):], b"", self.selected_mailbox)
+            await self.up.send_bytes(seen.encode() + b" " + store)
+
+        return line
+
+    async def cached_response(self, tag: str, cmd: str, args: bytes, line: bytes,
+                              mailbox: bytes) -> bool:
+        #
+        # Our responses are written only when nothing is in flight so that
+        # they do not get mixed into the responses of the upstream server.
+        #
+        if not self.metacache or imap.parse_literal(line)[0] >= 0:
+            return False
+
+        entry = self.metacache.get(cmd, args)
+        if entry and self.pending:
+            await self.quiet.wait()
+            entry = self.metacache.get(cmd, args)
+
+        if not entry:
+            self.metacache.miss(tag, cmd, args, mailbox, collect=not self.pending)
+            return False
+
+        self.metacache.hit(entry)
+
+        for data in entry.lines:
+            self.ds.write(data)
+        self.ds.write(tag.encode() + b" " + entry.completion)
+        await self.ds.flush()
+
+        return True
+
+    async def forward(self, data: bytes, boundary: bool = False) -> None:
+        #
+        # Responses are collected and written to the client in one piece at
+        # the end of a response, when everything the upstream server has
+        # sent so far has been handled, or when enough has been collected.
+        # A long untagged response turns into a few large writes instead of
+        # one per line.
+        #
+        self.ds.write(data)
+
+        if boundary or len(self.ds.buffer) >= imap.FLUSH_THRESHOLD or not self.up.buffered():
+            await self.ds.flush()
+
+    async def relay_literal(self, size: int, keep: List[bytes] | None = None) -> None:
+        #
+        # The octets are read by count straight from the upstream stream,
+        # so neither a long literal nor one without line breaks is ever held
+        # in memory as a whole, unless it is kept for the cache.
+        #
+        while size > 0:
+            chunk = await self.up.recv_literal(min(size, imap.LITERAL_CHUNK))
+            await self.forward(chunk)
+            size -= len(chunk)
+            if keep is not None:
+                keep.append(chunk)
+
+    @staticmethod
+    def trace_response(span: trace.Span, started: float, nbytes: int) -> None:
+        # The part of a response handled for a sampled command.
+        if not span.first_byte:
+            span.first_byte = started
+        span.bytes_out += nbytes
+        span.proxy += time.monotonic() - started
+
+    async def upstream_loop(self) -> None:
+        #
+        # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7
+        #
+        # Server responses are in three forms: status responses, server
+        # data, and command continuation requests.
+        #
+        # The client MUST be prepared to accept any response at all
+        # times.
+        #
+        while True:
+            line = await self.up.recv_bytes()
+
+            if line == b"":
+                if self.closing:
+                    return
+                raise imap.UpstreamClosed("upstream closed the connection")
+
+            # Untagged data is taken for the response to the oldest command.
+            started = time.monotonic() if self.spans else 0.0
+            span = self.spans.get(next(iter(self.pending), "")) if started else None
+
+            #
+            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-4.3
+            #
+            # A synchronizing literal is a sequence of zero or more octets
+            # (including CR and LF), prefix-quoted with an octet count in
+            # the form of an open brace ("{"), the number of octets, a close
+            # brace ("}"), and a CRLF. In the case of synchronizing literals
+            # transmitted from server to client, the CRLF is immediately
+            # followed by the octet data.
+            #
+            # We don't need to look for the tag and command completion
+            # status inside the string literal.
+            #
+            size, _ = imap.parse_literal(line)
+            if size >= 0:
+                if self.metacache:
+                    self.metacache.literal()
+
+                await self.forward(line)
+                if span:
+                    self.trace_response(span, started, len(line) + size)
+
+                uid = self.bodies.body_uid(line, size) if self.bodies else 0
+                if not self.bodies or not uid:
+                    await self.relay_literal(size)
+                    continue
+
+                chunks: List[bytes] = []
+                await self.relay_literal(size, chunks)
+                await self.bodies.store(uid, chunks)
+                continue
+
+            tag, status = imap.parse_server_command(line)
+
+            if self.metacache and not tag:
+                _, word, offset = imap.split_line(line)
+                self.metacache.untagged(line, word, line[offset:], self.selecting, self.selected_mailbox)
+
+            if self.bodies and self.bodies.hits and not tag:
+                match = imap.FETCH_UID.match(line)
+                if match and await self.bodies.respond(match.group(1), line, self.forward):
+                    if span:
+                        self.trace_response(span, started, len(line))
+                    continue
+
+            if self.selecting and tag == "*" and status == "OK":
+                match = imap.UIDVALIDITY.match(line)
+                if match:
+                    self.uidvalidity = int(match.group(1))
+
+            if status and tag in self.internal:
+                self.internal.discard(tag)
+                if self.metacache:
+                    self.metacache.completed(tag, line, status)
+                continue
+
+            if started and status and tag in self.spans:
+                span = self.spans[tag]
+
+            if tag == "+":
+                if self.literal and not self.literal[1].done():
+                    # Go ahead with the literal.
+                    self.literal[1].set_result(True)
+                else:
+                    # The next line from the client belongs to the current command.
+                    self.continuation = next(reversed(self.pending), "")
+
+            # Tagged responses, continuation requests and BYE end a response.
+            await self.forward(line, boundary=tag not in ("", "*") or status == "BYE")
+
+            if span:
+                self.trace_response(span, started, len(line))
+
+            #
+            # From: https://datatracker.ietf.org/doc/html/rfc9051#section-7.1.5
+            #
+            # The BYE response is always untagged and indicates that the
+            # server is about to close the connection.
+            #
+            if tag == "*" and status == "BYE":
+                self.closing = True
+                # Not asked to log out, the server is dropping the session.
+                if all(cmd != "LOGOUT" for cmd, _ in self.pending.values()):
+                    self.ds.history.dump("upstream sent BYE")
+                if not self.pending:
+                    return
+
+            if status and tag in self.pending:
+                self.ds.responded()
+
+                if self.literal and self.literal[0] == tag and not self.literal[1].done():
+                    self.literal[1].set_result(False)
+
+                cmd = self.command_completed(tag)
+
+                # The command has ended without the rest of it from the client.
+                if self.continuation == tag:
+                    self.continuation = None
+
+                if self.bodies:
+                    self.bodies.completed(tag)
+
+                if self.metacache:
+                    self.metacache.completed(tag, line, status)
+
+                if self.tracer and tag in self.spans:
+                    span = self.spans.pop(tag)
+                    span.status = status
+                    span.completed = started
+                    self.tracer.finish(span, time.monotonic())
+
+                if cmd in ("SELECT", "EXAMINE"):
+                    self.up.selected = status == "OK"
+                    self.selected(tag, cmd, status)
+                elif cmd in ("CLOSE", "UNSELECT") and status == "OK":
+                    self.up.selected = False
+                    self.selected_mailbox = b""
+                    self.selected_uidvalidity = 0
+                    if self.bodies:
+                        self.bodies.select(b"", 0)
+                elif cmd == "LOGOUT":
+                    return
+
+                if self.closing and not self.pending:
+                    return
+
+    def selected(self, tag: str, cmd: str, status: str) -> None:
+        name = self.selecting.pop(tag, b"")
+        uidvalidity, self.uidvalidity = self.uidvalidity, 0
+
+        self.selected_mailbox = name if status == "OK" else b""
+        self.selected_command = cmd
+        self.selected_uidvalidity = uidvalidity if status == "OK" else 0
+
+        if self.bodies:
+            self.bodies.select(self.selected_mailbox, self.selected_uidvalidity)
+
+    async def run(self) -> None:
+        tasks = [
+            asyncio.create_task(self.downstream_loop()),
+            asyncio.create_task(self.upstream_loop()),
+        ]
+
+        # Until proven otherwise, the upstream is left in an unknown state.
+        self.up.dirty = True
+
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if self.bodies:
+                self.bodies.close()
+
+        for task in done:
+            task.result()
+
+        # The extensions enabled by the client would change the responses to the next one.
+        self.up.dirty = (self.closing or self.continuation is not None or self.extensions or
+                         bool(self.pending or self.internal))
+
+
+# Gives the upstream connection of the account a client has logged in to.
+Route = Callable[[Dict[str,Any]], "asyncio.Task[imap.Upstream]"]
+
+
+async def prepare_upstream(config: Dict[str,Any],
+                           connect: Callable[[], Awaitable[imap.Upstream]]) -> imap.Upstream:
+    up = await connect()
+
+    try:
+        if not up.authenticated and not await up.authenticate(config):
+            raise ConnectionError("unable to authenticate on the upstream server")
+    except BaseException:
+        await up.close()
+        raise
+
+    return up
+
+
+async def settle_upstream(upstream: "asyncio.Task[imap.Upstream]") -> imap.Upstream | None:
+    # The upstream connection left after a session, if there is one.
+    if not upstream.done():
+        upstream.cancel()
+        await asyncio.gather(upstream, return_exceptions=True)
+        return None
+
+    if upstream.cancelled() or upstream.exception():
+        return None
+
+    return upstream.result()
+
+
+async def probe_upstream(configs: List[Dict[str,Any]]) -> None:
+    # Learn the capabilities of the upstream servers before any client asks.
+    addrs = set()
+    for config in configs:
+        provider = oauth2.get_upstream_provider(config)
+        if provider:
+            addrs.add((provider["imap-endpoint"], int(provider["imap-port"])))
+
+    async def probe(addr: Tuple[str, int]) -> None:
+        try:
+            up = await imap.open_upstream(*addr)
+            await up.close()
+        except OSError as e:
+            logger.warning("unable to reach upstream %s: %s", addr, e)
+
+    await asyncio.gather(*[probe(addr) for addr in addrs])
+
+
+async def wait_upstream(ds: imap.Downstream, upstream: "asyncio.Task[imap.Upstream] | None") -> imap.Upstream | None:
+    try:
+        if upstream:
+            return await upstream
+    except OSError as e:
+        logger.critical("%s: upstream is not available: %s", ds.addr, e)
+
+    await ds.send(["*", "BYE", "upstream server is not available"])
+    return None
+
+
+async def login(ctx: imap.Context, ds: imap.Downstream, upstream: "asyncio.Task[imap.Upstream] | None",
+                route: Route | None, upstream_addr: Tuple[str, int]) -> imap.Upstream | None:
+    #
+    # From: https://datatracker.ietf.org/doc/html/rfc9051#section-3.1
+    #
+    # In the not authenticated state, the client MUST supply authentication
+    # credentials before most commands will be permitted.
+    #
+    # The client is served here while the upstream connection is still being
+    # set up. It is needed only once the client has logged in, or to learn
+    # the capabilities if they are not known yet. Which account the client
+    # logs in to is known only then, and the route gives its connection.
+    #
+    while ds.readable():
+        line = await ds.recv_bytes()
+        received = time.monotonic()
+
+        if line == b"":
+            break
+
+        if line.rstrip(imap.CRLF.encode()) == b"":
+            continue
+
+        try:
+            tag, cmd, args = imap.parse_client_command(line)
+        except ValueError:
+            await ds.send(["*", "BAD", "command without a tag"])
+            continue
+
+        ctx["tag"] = tag
+
+        match cmd:
+            case "CAPABILITY":
+                caps = imap.upstream_capabilities.get(upstream_addr)
+                if caps is None and upstream:
+                    up = await wait_upstream(ds, upstream)
+                    if not up:
+                        break
+                    caps = up.capabilities
+
+                await ds.command_capability(ctx, caps or ())
+
+            case "NOOP":
+                await ds.send([tag, "OK", "NOOP completed"])
+
+            case "LOGOUT":
+                await ds.send(["*", "BYE", "IMAP4rev1 Server logging out"])
+                await ds.send([tag, "OK", "LOGOUT completed"])
+                break
+
+            case "AUTHENTICATE" | "LOGIN":
+                if cmd == "AUTHENTICATE":
+                    mechanism = "CRAM-MD5"
+                    ok = await ds.command_authenticate(ctx, args.decode("utf-8", "replace").strip())
+                else:
+                    mechanism = "LOGIN"
+                    ok = await ds.command_login(ctx, args)
+
+                if not ok:
+                    continue
+
+                #
+                # Traced as waiting for the upstream connection and the
+                # authentication on it, which is what the client waits for.
+                #
+                span = trace.tracer.start(tag, cmd, received) if trace.tracer else None
+                if span:
+                    span.sent = time.monotonic()
+                    span.proxy = span.sent - span.received
+                    span.bytes_in = len(line)
+
+                up = await wait_upstream(ds, route(ctx["config"]) if route else upstream)
+
+                if span:
+                    span.completed = time.monotonic()
+
+                if not up:
+                    answer = [tag, "NO", "[UNAVAILABLE] upstream server is not available"]
+                else:
+                    answer = [tag, "OK", f"{mechanism} authentication successful"]
+
+                await ds.send(answer)
+
+                if span and trace.tracer:
+                    span.status = answer[1]
+                    span.bytes_out = len(" ".join(answer)) + len(imap.CRLF)
+                    done = time.monotonic()
+                    span.proxy += done - span.completed
+                    trace.tracer.finish(span, done)
+
+                return up
+
+            case _:
+                await ds.send([tag, "BAD", "command not allowed before authentication"])
+
+    return None
+
+
+async def session(config: Dict[str,Any], ds: imap.Downstream, upstream: "asyncio.Task[imap.Upstream] | None",
+                  keep_upstream: bool = False, preauth: bool = False,
+                  shared_idle: Callable[[Relay], Awaitable[imap.Upstream | None]] | None = None,
+                  accounts: Dict[str, Dict[str,Any]] | None = None,
+                  route: Route | None = None) -> bool:
+    ctx = imap.Context({})
+
+    #
+    # The accounts the client can log in to by the downstream username, and
+    # the one used until it does.
+    #
+    if accounts is None:
+        downstream = config.get("downstream", {})
+        accounts = {}
+        if "username" in downstream and "password" in downstream:
+            accounts[str(downstream["username"])] = config
+
+    ctx["accounts"] = accounts
+    ctx["config"] = config
+
+    provider = oauth2.get_upstream_provider(config)
+    if not provider:
+        return False
+
+    history.live.add(ds.history)
+    try:
+        #
+        # The greeting goes out at once. The upstream connection and the
+        # authentication on it are made in the meantime.
+        #
+        if not preauth:
+            await ds.send(["*", "OK", "IMAP4rev1 Service Ready"])
+            up = await login(ctx, ds, upstream, route,
+                             (provider["imap-endpoint"], int(provider["imap-port"])))
+
+            provider = oauth2.get_upstream_provider(ctx["config"])
+            if not provider:
+                return False
+        else:
+            # The tunnel talks to the client that started it, which is logged in already.
+            await ds.send(["*", "PREAUTH", "IMAP4rev1 Service Ready"])
+            up = await wait_upstream(ds, upstream)
+
+        ctx["account"] = oauth2.get_token_key(provider)
+
+        if up:
+            relay = Relay(ctx, ds, up, keep_upstream, shared_idle is not None)
+            recorder = record.start(ds.addr)
+            try:
+                while up:
+                    relay.up = up
+                    up.history = ds.history
+                    up.recorder = recorder
+                    try:
+                        await relay.run()
+                    finally:
+                        up.history = None
+                        up.recorder = None
+
+                    if not relay.idling or not shared_idle:
+                        break
+
+                    # The session goes on with whatever connection it gets back.
+                    up = await shared_idle(relay)
+                    relay.idling = None
+            finally:
+                if recorder:
+                    recorder.close()
+
+    except imap.UpstreamClosed as e:
+        logger.critical("%s: %s", ds.addr, e)
+        ds.history.dump(str(e))
+
+    except (BrokenPipeError, ConnectionResetError) as e:
+        logger.debug("session connection error: %s", e)
+
+    except Exception as e:
+        logger.critical("session got exception: %s", repr(e))
+        ds.history.dump(repr(e))
+        return False
+
+    finally:
+        history.live.discard(ds.history)
+        trace.flush()
+
+    return True
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import os.path
+import random
+import socket
+import time
+
+from typing import Any, Dict, IO, List, Tuple
+
+import oauth2imap
+
+logger = oauth2imap.logger
+
+#
+# A record is the upstream side of the relayed part of a session: what the
+# proxy sent to the upstream server (C, the client's commands) and what it
+# received (U). The login on either side is not part of it. Each line of the
+# gzipped file is [seconds since the start, "C" or "U", data as latin-1].
+# The first line is a JSON header.
+#
+
+RECORD_VERSION = 1
+
+# Client commands whose arguments are credentials.
+SECRET_COMMANDS = (b"LOGIN", b"AUTHENTICATE")
+
+# A replay that gets nothing for this many seconds has diverged from the record.
+STALL_TIMEOUT = 10
+
+Record = Tuple[float, str, bytes]
+
+
+class Recorder:
+    def __init__(self, path: str, client: Any):
+        self.path = path
+        self.started = time.monotonic()
+        self.file: IO[str] = gzip.open(path, "wt", encoding="latin-1", compresslevel=6)
+        # The tag of a command with credentials, until it is completed.
+        self.secret: bytes | None = None
+
+        self.file.write(json.dumps({
+            "version": RECORD_VERSION,
+            "started": time.time(),
+            "client":  str(client),
+        }) + "\n")
+
+    def add(self, direction: str, data: bytes) -> None:
+        self.file.write(json.dumps([round(time.monotonic() - self.started, 6), direction,
+                                    data.decode("latin-1")]) + "\n")
+
+    def sent(self, data: bytes) -> None:
+        words = data[:128].split(b" ", 2)
+
+        if len(words) > 1 and words[1].upper().rstrip(b"\r\n") in SECRET_COMMANDS:
+            self.secret = words[0]
+            data = words[0] + b" NOOP\r\n"
+        elif self.secret is not None:
+            # AUTHENTICATE responses.
+            data = b"\r\n"
+
+        self.add("C", data)
+
+    def received(self, data: bytes) -> None:
+        if self.secret is not None and data.startswith(self.secret + b" "):
+            self.secret = None
+        self.add("U", data)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+settings: Dict[str, Any] = {}
+counter = itertools.count()
+
+
+def setup(config: Dict[str, Any]) -> None:
+    params = config.get("record", {})
+    if "dir" not in params:
+        return
+
+    settings["dir"] = os.path.expanduser(str(params["dir"]))
+    settings["sample"] = float(params.get("sample", 1))
+
+    os.makedirs(settings["dir"], mode=0o700, exist_ok=True)
+
+
+def start(client: Any) -> Recorder | None:
+    if not settings or random.random() >= settings["sample"]:
+        return None
+
+    name = f"session-{int(time.time())}-{os.getpid()}-{next(counter)}.rec.gz"
+    try:
+        return Recorder(os.path.join(settings["dir"], name), client)
+    except OSError as e:
+        logger.warning("unable to record session: %s", e)
+        return None
+
+
+def load(path: str) -> List[Record]:
+    records: List[Record] = []
+
+    with gzip.open(path, "rt", encoding="latin-1") as file:
+        header = json.loads(file.readline())
+        if header.get("version") != RECORD_VERSION:
+            raise ValueError(f"unsupported record version {header.get('version')}")
+
+        for line in file:
+            stamp, direction, data = json.loads(line)
+            records.append((stamp, direction, data.encode("latin-1")))
+
+    return records
+
+
+class Peer:
+    """One end of a replayed connection counting what it has received."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.received = 0
+        self.changed = asyncio.Event()
+
+    async def pump(self) -> None:
+        while data := await self.reader.read(2**16):
+            self.received += len(data)
+            self.changed.set()
+        self.changed.set()
+
+    async def until(self, count: int) -> None:
+        while self.received < count:
+            if self.reader.at_eof():
+                raise ConnectionResetError(f"got {self.received} of {count} bytes")
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), STALL_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                raise ConnectionResetError(f"stalled at {self.received} of {count} bytes") from e
+
+    async def play(self, records: List[Record], mine: str, started: float, realtime: bool) -> None:
+        #
+        # Every piece is sent once the other side has got all it had been
+        # sent before that piece in the record.
+        #
+        expected = 0
+        for stamp, direction, data in records:
+            if direction != mine:
+                expected += len(data)
+                continue
+
+            await self.until(expected)
+
+            if realtime:
+                await asyncio.sleep(started + stamp - time.monotonic())
+
+            self.writer.write(data)
+            await self.writer.drain()
+
+
+async def stream_pair() -> Tuple[Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                                 Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    a, b = socket.socketpair()
+    return (await asyncio.open_unix_connection(sock=a, limit=2**24),
+            await asyncio.open_unix_connection(sock=b, limit=2**24))
+
+
+async def replay(records: List[Record], realtime: bool = False) -> Tuple[float, int]:
+    # pylint: disable-next=import-outside-toplevel
+    import oauth2imap.imap as imap
+    # pylint: disable-next=import-outside-toplevel
+    import oauth2imap.proxy as proxy
+
+    config = {"upstream": {"provider": "microsoft", "client-id": "replay",
+                           "username": "replay@localhost", "tokens-file": os.devnull}}
+
+    (ds_reader, ds_writer), (cl_reader, cl_writer) = await stream_pair()
+    (up_reader, up_writer), (sv_reader, sv_writer) = await stream_pair()
+
+    async def connect() -> imap.Upstream:
+        up = imap.Upstream(("replay", 0), up_reader, up_writer)
+        up.authenticated = True
+        return up
+
+    ds = imap.Downstream("replay", ds_reader, ds_writer)
+    upstream = asyncio.create_task(proxy.prepare_upstream(config, connect))
+    relayed = asyncio.create_task(proxy.session(config, ds, upstream, preauth=True))
+
+    client = Peer(cl_reader, cl_writer)
+    server = Peer(sv_reader, sv_writer)
+
+    # PREAUTH.
+    await client.reader.readline()
+
+    pumps = [asyncio.create_task(client.pump()), asyncio.create_task(server.pump())]
+
+    started = time.monotonic()
+    try:
+        await asyncio.gather(client.play(records, "C", started, realtime),
+                             server.play(records, "U", started, realtime))
+
+        await client.until(sum(len(data) for _, d, data in records if d == "U"))
+        elapsed = time.monotonic() - started
+    finally:
+        cl_writer.close()
+        sv_writer.close()
+        await asyncio.gather(relayed, *pumps, return_exceptions=True)
+
+        up = await proxy.settle_upstream(upstream)
+        if up:
+            await up.close()
+        await ds.close()
+
+    return elapsed, client.received
+
+
+def main(cmdargs: argparse.Namespace) -> int:
+    ret = oauth2imap.EX_SUCCESS
+
+    print(f"{'record':<40} {'commands':>9} {'to client':>12} {'best s':>9} {'MiB/s':>8}")
+
+    for path in cmdargs.files:
+        try:
+            records = load(path)
+        except (OSError, ValueError) as e:
+            logger.critical("%s: %s", path, e)
+            return oauth2imap.EX_FAILURE
+
+        expected = sum(len(data) for _, d, data in records if d == "U")
+        commands = sum(1 for _, d, data in records if d == "C" and data.endswith(b"\r\n"))
+
+        best = float("inf")
+        for _ in range(cmdargs.repeat):
+            try:
+                elapsed, received = asyncio.run(replay(records, cmdargs.realtime))
+            except ConnectionError as e:
+                logger.critical("%s: replay diverged: %s", path, e)
+                ret = oauth2imap.EX_FAILURE
+                break
+
+            if received != expected:
+                logger.critical("%s: client got %d bytes instead of %d", path, received, expected)
+                ret = oauth2imap.EX_FAILURE
+                break
+
+            best = min(best, elapsed)
+        else:
+            print(f"{os.path.basename(path):<40} {commands:>9} {expected:>12} "
+                  f"{best:>9.3f} {expected / best / 2**20 if best else 0:>8.1f}")
+
+    return ret
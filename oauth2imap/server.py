@@ -5,49 +5,364 @@
 __author__ = 'Alexey Gladkov <legion@kernel.org>'
 
 import argparse
+import asyncio
+import functools
+import gc
+import os
+import signal
 import socket
 import socketserver
+import time
 
-from typing import Dict, Any
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Set
 
 import oauth2imap
 import oauth2imap.config
 import oauth2imap.oauth2 as oauth2
+import oauth2imap.bodycache as bodycache
+import oauth2imap.history as history
+import oauth2imap.idle as idle
+import oauth2imap.metacache as metacache
 import oauth2imap.imap as imap
+import oauth2imap.proxy as proxy
+import oauth2imap.metrics as metrics
+import oauth2imap.pool as pool
+import oauth2imap.record as record
+import oauth2imap.trace as trace
 
 logger = oauth2imap.logger
 
 
-class ImapTCPHandler(socketserver.StreamRequestHandler):
-    def handle(self) -> None:
-        config = getattr(self.server, "config")
+async def handle_connection(accounts: Dict[str, Dict[str, Any]], ds: imap.Downstream,
+                            upstream_pool: pool.Pool | None = None,
+                            idle_hub: idle.Hub | None = None) -> None:
+    try:
+        logger.info("%s: new connection", ds.addr)
+
+        metrics.connections.inc()
+        metrics.sessions.add(1)
+
+        #
+        # The account of the session. Until the client logs in, it is the
+        # first one, whose server answers CAPABILITY. When it is the only
+        # one, the connection to it is made right away.
+        #
+        config = next(iter(accounts.values()))
+        upstream: asyncio.Task[imap.Upstream] | None = None
+
+        def connector(config: Dict[str, Any]) -> Callable[[], Awaitable[imap.Upstream]]:
+            provider = oauth2.get_upstream_provider(config)
+            assert provider
+
+            if upstream_pool:
+                return functools.partial(upstream_pool.acquire, config, provider)
+
+            return functools.partial(imap.open_upstream,
+                                     provider["imap-endpoint"], int(provider["imap-port"]))
+
+        def route(account: Dict[str, Any]) -> asyncio.Task[imap.Upstream]:
+            nonlocal config, upstream
+
+            if not upstream:
+                config = account
+                upstream = asyncio.create_task(proxy.prepare_upstream(config, connector(config)))
 
-        provider = oauth2.get_upstream_provider(config)
-        if not provider:
-            return None
+            return upstream
 
-        logger.info("%s: new connection", self.client_address)
+        if len(accounts) == 1:
+            route(config)
 
-        up = imap.Upstream(provider["imap-endpoint"], 993)
-        ds = imap.Downstream(self.client_address, self.rfile, self.wfile)
+        async def release(up: imap.Upstream) -> None:
+            provider = oauth2.get_upstream_provider(config)
+            if upstream_pool and provider:
+                await upstream_pool.release(config, provider, up)
+            else:
+                await up.close()
 
-        imap.session(config, ds, up)
+        # The connection the session has gone on with after a shared IDLE.
+        swapped: List[imap.Upstream | None] = []
 
-        logger.debug("%s: finish", self.client_address)
+        async def shared_idle(relay: proxy.Relay) -> imap.Upstream | None:
+            assert idle_hub
+            # The session hands its connection over to the hub.
+            swapped[:] = [None]
+            up = await idle_hub.idle(relay, functools.partial(proxy.prepare_upstream, config,
+                                                              connector(config)),
+                                     release)
+            swapped[:] = [up]
+            return up
+
+        try:
+            await proxy.session(config, ds, upstream, keep_upstream=upstream_pool is not None,
+                               shared_idle=shared_idle if idle_hub else None,
+                               accounts=accounts if len(accounts) > 1 else None, route=route)
+        finally:
+            metrics.sessions.add(-1)
+
+            if swapped:
+                up = swapped[0]
+            else:
+                up = await proxy.settle_upstream(upstream) if upstream else None
+            if up:
+                await release(up)
+
+        logger.debug("%s: finish", ds.addr)
+    finally:
+        await ds.close()
+        metrics.flush()
+
+
+class ImapTCPHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        accounts = getattr(self.server, "accounts")
+        try:
+            asyncio.run(self.session(accounts))
+        finally:
+            # The child leaves with os._exit().
+            oauth2imap.flush_logger()
+
+    async def session(self, accounts: Dict[str, Dict[str, Any]]) -> None:
+        ds = await imap.open_downstream(self.client_address, self.request)
+        await handle_connection(accounts, ds)
 
 
 class ImapServer(socketserver.ForkingTCPServer):
-    config: Dict[str, Any]
+    accounts: Dict[str, Dict[str, Any]]
 
     def __init__(self, addr: Any, handler: Any):
         self.address_family = socket.AF_INET
         self.socket_type = socket.SOCK_STREAM
         self.allow_reuse_address = True
+        self.request_queue_size = 100
 
         super().__init__(addr, handler)
 
 
-# pylint: disable-next=unused-argument
+def serve_fork(accounts: Dict[str, Dict[str, Any]], saddr: Any) -> None:
+    with ImapServer(saddr, ImapTCPHandler) as server:
+        server.accounts = accounts
+
+        parent = os.getpid()
+
+        # pylint: disable-next=unused-argument
+        def dump_sessions(signum: int, frame: Any) -> None:
+            # The children inherit the handler and dump their own session.
+            history.dump_live()
+
+            if os.getpid() == parent:
+                for pid in list(server.active_children or ()):
+                    try:
+                        os.kill(pid, signal.SIGUSR1)
+                    except ProcessLookupError:
+                        pass
+
+        signal.signal(signal.SIGUSR1, dump_sessions)
+
+        server.serve_forever()
+
+
+async def serve_worker(sock: socket.socket,
+                       handler: Callable[[asyncio.StreamReader, asyncio.StreamWriter], Coroutine[Any, Any, None]],
+                       max_sessions: int) -> None:
+    #
+    # The connections are taken from the shared socket one at a time: the
+    # workers get them in turns, and a worker leaving holds none that it
+    # has not started to serve. The asyncio server accepts them in batches
+    # and drops the rest of a batch when it is closed.
+    #
+    loop = asyncio.get_running_loop()
+    sessions: Set[asyncio.Task[None]] = set()
+    served = 0
+
+    while not max_sessions or served < max_sessions:
+        conn, _ = await loop.sock_accept(sock)
+        try:
+            imap.set_nodelay(conn)
+            reader, writer = await asyncio.open_connection(sock=conn, limit=imap.LINE_LIMIT)
+        except OSError as e:
+            logger.critical("unable to accept connection: %s", e)
+            conn.close()
+            continue
+
+        task = asyncio.create_task(handler(reader, writer))
+        sessions.add(task)
+        task.add_done_callback(sessions.discard)
+        served += 1
+
+    # The other workers accept meanwhile.
+    logger.info("worker %d: %d sessions served, retiring", os.getpid(), served)
+
+    await asyncio.gather(*sessions)
+
+
+async def serve_asyncio(config: Dict[str, Any], accounts: Dict[str, Dict[str, Any]],
+                        saddr: Any, sock: socket.socket | None = None,
+                        max_sessions: int = 0) -> None:
+    #
+    # Upstream connections can be handed over between sessions only when
+    # they live in the same process.
+    #
+    upstream_pool: pool.Pool | None = None
+
+    new_pool = pool.Pool(config)
+
+    if new_pool.enabled(list(accounts.values())):
+        await new_pool.start(list(accounts.values()))
+        upstream_pool = new_pool
+
+    #
+    # Only sessions in the same process can wait on one connection. Every
+    # client ending the IDLE needs a connection again, which only the pool
+    # has ready.
+    #
+    idle_hub: idle.Hub | None = None
+    new_hub = idle.Hub(config)
+
+    if new_hub.enabled():
+        if upstream_pool:
+            idle_hub = new_hub
+        else:
+            logger.warning("idle: the shared IDLE needs the connection pool, not sharing")
+
+    #
+    # The loop refers to its tasks weakly and the server forgets a session
+    # once the client has closed the connection. A session finishing with
+    # the upstream after that would be collected in the middle.
+    #
+    sessions: Set[asyncio.Task[Any]] = set()
+
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task
+        sessions.add(task)
+
+        ds = imap.Downstream(writer.get_extra_info("peername"), reader, writer)
+        try:
+            await handle_connection(accounts, ds, upstream_pool, idle_hub)
+        except Exception as e:
+            logger.critical("%s: connection got exception: %s", ds.addr, repr(e))
+        finally:
+            sessions.discard(task)
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, history.dump_live)
+
+    try:
+        if sock:
+            await serve_worker(sock, handler, max_sessions)
+        else:
+            server = await asyncio.start_server(handler, saddr[0], saddr[1],
+                                                family=socket.AF_INET,
+                                                reuse_address=True,
+                                                limit=imap.LINE_LIMIT)
+            async with server:
+                await server.serve_forever()
+    finally:
+        if idle_hub:
+            await idle_hub.stop()
+        if upstream_pool:
+            await upstream_pool.stop()
+
+
+def serve_prefork(config: Dict[str, Any], accounts: Dict[str, Dict[str, Any]], saddr: Any) -> None:
+    params = config.get("workers", {})
+
+    # Long-lived workers, each serving many sessions like the asyncio engine.
+    count = int(params.get("count", os.cpu_count() or 1))
+    # Sessions after which a worker is replaced with a fresh one (0 never).
+    max_sessions = int(params.get("max-sessions", 0))
+
+    #
+    # All workers accept from the same socket, so the connections waiting in
+    # its queue are not lost when a worker leaves.
+    #
+    sock = socket.create_server(saddr, family=socket.AF_INET, backlog=1024)
+    sock.setblocking(False)
+
+    #
+    # From: https://docs.python.org/3/library/gc.html#gc.freeze
+    #
+    # If a process will fork() without exec(), avoiding unnecessary
+    # copy-on-write in child processes will maximize memory sharing and
+    # reduce overall memory usage.
+    #
+    gc.collect()
+    gc.freeze()
+
+    workers: Dict[int, float] = {}
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid:
+            workers[pid] = time.monotonic()
+            return
+
+        code = oauth2imap.EX_SUCCESS
+        try:
+            # The worker dumps its sessions once its loop is running.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+            # The tokens are refreshed in advance in every worker.
+            oauth2.start_broker(list(accounts.values()))
+
+            asyncio.run(serve_asyncio(config, accounts, saddr, sock, max_sessions))
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logger.critical("worker %d got exception: %s", os.getpid(), repr(e))
+            code = oauth2imap.EX_FAILURE
+        finally:
+            oauth2imap.flush_logger()
+            os._exit(code)
+
+    # pylint: disable-next=unused-argument
+    def terminate(signum: int, frame: Any) -> None:
+        raise KeyboardInterrupt
+
+    # pylint: disable-next=unused-argument
+    def dump_sessions(signum: int, frame: Any) -> None:
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGUSR1, dump_sessions)
+
+    try:
+        for _ in range(count):
+            spawn()
+
+        logger.info("started %d workers", count)
+
+        while True:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+
+            if os.waitstatus_to_exitcode(status) != oauth2imap.EX_SUCCESS:
+                logger.critical("worker %d exited with status %d", pid, os.waitstatus_to_exitcode(status))
+                # A worker failing at once would be restarted in a loop.
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+
+            spawn()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
+
+
 def main(cmdargs: argparse.Namespace) -> int:
     config = oauth2imap.config.read()
 
@@ -55,12 +370,47 @@ def main(cmdargs: argparse.Namespace) -> int:
         logger.critical("%s", config.message)
         return oauth2imap.EX_FAILURE
 
+    accounts = oauth2imap.config.accounts(config)
+
+    if isinstance(accounts, oauth2imap.Error):
+        logger.critical("%s", accounts.message)
+        return oauth2imap.EX_FAILURE
+
+    for account in accounts.values():
+        # Anyone able to connect would be let in otherwise.
+        downstream = account.get("downstream", {})
+        if "username" not in downstream or "password" not in downstream:
+            logger.critical("the server needs the downstream username and password")
+            return oauth2imap.EX_FAILURE
+
+        if not oauth2.get_upstream_provider(account):
+            return oauth2imap.EX_FAILURE
+
     saddr = (config["downstream"]["server"], config["downstream"]["port"])
 
+    # Before anything forks or starts counting.
+    metrics.setup(config)
+    trace.setup(config)
+    record.setup(config)
+    bodycache.setup(config)
+    metacache.setup(config)
+
+    # The prefork workers start their own after the fork: threads are not inherited.
+    if cmdargs.engine != "prefork":
+        oauth2.start_broker(list(accounts.values()))
+
+    asyncio.run(proxy.probe_upstream(list(accounts.values())))
+
+    logger.info("serving %d accounts", len(accounts))
+
     try:
-        with ImapServer(saddr, ImapTCPHandler) as server:
-            server.config = config
-            server.serve_forever()
+        match cmdargs.engine:
+            case "asyncio":
+                asyncio.run(serve_asyncio(config, accounts, saddr))
+            case "prefork":
+                serve_prefork(config, accounts, saddr)
+            case _:
+                serve_fork(accounts, saddr)
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import abc
+import os
+import os.path
+import fcntl
+import json
+import sqlite3
+import tempfile
+import threading
+import contextlib
+
+from datetime import datetime
+from typing import Dict, Iterator, Set, Tuple, Any
+
+import oauth2imap
+
+logger = oauth2imap.logger
+
+SQLITE_PREFIX = "sqlite://"
+
+# Leases on token stores held by the current thread.
+leases = threading.local()
+
+
+def expiration(token: Dict[str,str]) -> float:
+    if token.get("access_token_expiration"):
+        return datetime.fromisoformat(token["access_token_expiration"]).timestamp()
+    return 0
+
+
+class TokenStore(abc.ABC):
+    """Persistent storage of tokens indexed by the token key."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[None]:
+        #
+        # Serializes the writers of the store across processes. The lease is
+        # reentrant within a thread because flock(2) locks taken through
+        # different file descriptors of the same process conflict with each
+        # other.
+        #
+        held: Set[str] = leases.__dict__.setdefault("held", set())
+
+        if self.path in held:
+            yield
+            return
+
+        fp = os.open(self.path + ".lock", os.O_CREAT|os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            held.add(self.path)
+            yield
+        finally:
+            held.discard(self.path)
+            os.close(fp)
+
+    @abc.abstractmethod
+    def get(self, token_key: str) -> Dict[str,str] | None:
+        ...
+
+    @abc.abstractmethod
+    def put(self, token_key: str, token: Dict[str,str]) -> None:
+        ...
+
+    @abc.abstractmethod
+    def items(self) -> Dict[str, Dict[str,str]]:
+        ...
+
+    def expiring(self, seconds: float) -> Dict[str, Dict[str,str]]:
+        deadline = datetime.now().timestamp() + seconds
+        return { k: v for k, v in self.items().items() if expiration(v) <= deadline }
+
+
+class JsonStore(TokenStore):
+    """All tokens in a single JSON file."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.cache: Tuple[Tuple[int,int,int,int], Dict[str, Dict[str,str]]] | None = None
+
+    @staticmethod
+    def stat_key(st: os.stat_result) -> Tuple[int,int,int,int]:
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def items(self) -> Dict[str, Dict[str,str]]:
+        #
+        # The file is only ever replaced as a whole (see put), so it can be
+        # read without a lock, and it is parsed again only when it has been
+        # replaced. The returned dictionary is shared and must not be
+        # modified.
+        #
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+
+        cached = self.cache
+        if cached and cached[0] == self.stat_key(st):
+            return cached[1]
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            st = os.fstat(file.fileno())
+            data = file.read()
+
+        tokens: Dict[str, Dict[str,str]] = json.loads(data or "{}")
+        self.cache = (self.stat_key(st), tokens)
+
+        return tokens
+
+    def get(self, token_key: str) -> Dict[str,str] | None:
+        return self.items().get(token_key)
+
+    def put(self, token_key: str, token: Dict[str,str]) -> None:
+        with self.lease():
+            tokens = dict(self.items())
+            tokens[token_key] = token
+
+            #
+            # Readers see either the old file or the new one, never a
+            # partially written one.
+            #
+            target = os.path.realpath(self.path)
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(target),
+                                           prefix=".oauth2imap-tokens-")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as file:
+                    json.dump(tokens, file, indent=4, sort_keys=True)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    st = os.fstat(file.fileno())
+
+                os.rename(tmpname, target)
+
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+
+            # rename(2) keeps the inode and the mtime.
+            self.cache = (self.stat_key(st), tokens)
+
+
+class SqliteStore(TokenStore):
+    """One row per token in an SQLite database."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS tokens (
+            key     TEXT PRIMARY KEY,
+            expires REAL NOT NULL,
+            data    TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires);
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.local = threading.local()
+
+    def db(self) -> sqlite3.Connection:
+        # Connections are not shared between threads or inherited by children.
+        conn: sqlite3.Connection | None = getattr(self.local, "conn", None)
+
+        if conn and getattr(self.local, "pid", 0) == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+        # Readers do not block the writer and the writer does not block them.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(self.schema)
+
+        os.chmod(self.path, 0o600)
+
+        self.local.conn = conn
+        self.local.pid  = os.getpid()
+
+        return conn
+
+    def get(self, token_key: str) -> Dict[str,str] | None:
+        row = self.db().execute("SELECT data FROM tokens WHERE key = ?",
+                                (token_key,)).fetchone()
+        if not row:
+            return None
+
+        token: Dict[str,str] = json.loads(row[0])
+        return token
+
+    def put(self, token_key: str, token: Dict[str,str]) -> None:
+        self.db().execute("""
+            INSERT INTO tokens (key, expires, data) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET expires = excluded.expires, data = excluded.data
+        """, (token_key, expiration(token), json.dumps(token, sort_keys=True)))
+
+    def select(self, query: str, *args: Any) -> Dict[str, Dict[str,str]]:
+        return { k: json.loads(v) for k, v in self.db().execute(query, args) }
+
+    def items(self) -> Dict[str, Dict[str,str]]:
+        return self.select("SELECT key, data FROM tokens")
+
+    def expiring(self, seconds: float) -> Dict[str, Dict[str,str]]:
+        return self.select("SELECT key, data FROM tokens WHERE expires <= ? ORDER BY expires",
+                           datetime.now().timestamp() + seconds)
+
+
+stores: Dict[str, TokenStore] = {}
+
+
+def open_store(tokens_file: str) -> TokenStore:
+    store = stores.get(tokens_file)
+
+    if not store:
+        if tokens_file.startswith(SQLITE_PREFIX):
+            store = SqliteStore(os.path.expanduser(tokens_file[len(SQLITE_PREFIX):]))
+        else:
+            store = JsonStore(tokens_file)
+
+        stores[tokens_file] = store
+
+    return store
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2024  Alexey Gladkov <legion@kernel.org>
+
+__author__ = 'Alexey Gladkov <legion@kernel.org>'
+
+import argparse
+import json
+import os
+import os.path
+import random
+import time
+
+from typing import Dict, List, Any
+
+import oauth2imap
+
+logger = oauth2imap.logger
+
+# Records collected by a process before they are written out.
+BATCH = 64
+
+# The timings summarized by the analyzer.
+COLUMNS = ("total_ms", "upstream_ms", "first_byte_ms", "proxy_ms")
+
+
+class Span:
+    """Timings of one client command, all taken with time.monotonic()."""
+
+    __slots__ = ("tag", "verb", "received", "sent", "first_byte", "completed",
+                 "status", "bytes_in", "bytes_out", "proxy")
+
+    def __init__(self, tag: str, verb: str, received: float):
+        self.tag        = tag
+        self.verb       = verb
+        self.received   = received
+        self.sent       = received
+        self.first_byte = 0.0
+        self.completed  = 0.0
+        self.status     = ""
+        self.bytes_in   = 0
+        self.bytes_out  = 0
+        # Seconds spent in the proxy itself rather than waiting for a peer.
+        self.proxy      = 0.0
+
+
+def milliseconds(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+class Tracer:
+    def __init__(self, path: str, sample: float):
+        self.path   = path
+        self.sample = sample
+        self.fd     = -1
+        self.records: List[str] = []
+
+    def start(self, tag: str, verb: str, received: float) -> Span | None:
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        return Span(tag, verb, received)
+
+    def finish(self, span: Span, done: float) -> None:
+        self.records.append(json.dumps({
+            "time":      round(time.time() - (time.monotonic() - span.received), 3),
+            "pid":       os.getpid(),
+            "tag":       span.tag,
+            "verb":      span.verb,
+            "status":    span.status,
+            "bytes_in":  span.bytes_in,
+            "bytes_out": span.bytes_out,
+            "first_byte_ms": milliseconds(span.first_byte - span.sent) if span.first_byte else None,
+            "upstream_ms":   milliseconds(span.completed - span.sent),
+            "proxy_ms":      milliseconds(span.proxy),
+            "total_ms":      milliseconds(done - span.received),
+        }) + "\n")
+
+        if len(self.records) >= BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.records:
+            return
+
+        data = "".join(self.records).encode()
+        self.records = []
+
+        try:
+            if self.fd < 0:
+                self.fd = os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o600)
+            #
+            # One write with O_APPEND per batch, so the records of the
+            # processes sharing the file do not interleave.
+            #
+            os.write(self.fd, data)
+        except OSError as e:
+            logger.warning("unable to write trace: %s", e)
+
+
+tracer: Tracer | None = None
+
+
+def setup(config: Dict[str, Any]) -> None:
+    global tracer
+
+    params = config.get("trace", {})
+    if "file" not in params:
+        return
+
+    tracer = Tracer(os.path.expanduser(str(params["file"])), float(params.get("sample", 1)))
+
+
+def flush() -> None:
+    if tracer:
+        tracer.flush()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main(cmdargs: argparse.Namespace) -> int:
+    verbs: Dict[str, Dict[str, List[float]]] = {}
+
+    for filename in cmdargs.files:
+        try:
+            with open(filename, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if not isinstance(record, dict) or "verb" not in record:
+                        continue
+
+                    timings = verbs.setdefault(record["verb"], {})
+                    for field in COLUMNS:
+                        if record.get(field) is not None:
+                            timings.setdefault(field, []).append(record[field])
+
+        except OSError as e:
+            logger.critical("%s: %s", filename, e)
+            return oauth2imap.EX_FAILURE
+
+    print(f"{'verb':<14} {'count':>7}", *[f"{c[:-3] + ' p50/p90/p99':>26}" for c in COLUMNS])
+
+    for verb, timings in sorted(verbs.items(), key=lambda x: -len(x[1].get("total_ms", []))):
+        row = [f"{verb:<14} {len(timings.get('total_ms', [])):>7}"]
+        for column in COLUMNS:
+            values = timings.get(column)
+            if values:
+                row.append(f"{'/'.join(f'{percentile(values, p):.1f}' for p in (50, 90, 99)):>26}")
+            else:
+                row.append(f"{'-':>26}")
+        print(*row)
+
+    return oauth2imap.EX_SUCCESS
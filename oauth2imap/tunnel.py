@@ -5,20 +5,53 @@
 __author__ = 'Alexey Gladkov <legion@kernel.org>'
 
 import argparse
+import asyncio
+import functools
+import signal
 import sys
 
+from typing import Dict, Any
+
 import oauth2imap
 import oauth2imap.config
 import oauth2imap.oauth2 as oauth2
+import oauth2imap.bodycache as bodycache
+import oauth2imap.history as history
+import oauth2imap.metacache as metacache
 import oauth2imap.imap as imap
+import oauth2imap.proxy as proxy
+import oauth2imap.record as record
+import oauth2imap.trace as trace
 
 logger = oauth2imap.logger
 
 
-# pylint: disable-next=unused-argument
+async def tunnel(config: Dict[str, Any], provider: oauth2.Provider) -> None:
+    connect = functools.partial(imap.open_upstream,
+                                provider["imap-endpoint"], int(provider["imap-port"]))
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, history.dump_live)
+
+    upstream = asyncio.create_task(proxy.prepare_upstream(config, connect))
+    try:
+        ds = await imap.open_downstream_pipe("pipe", sys.stdin.buffer, sys.stdout.buffer)
+        try:
+            # The client has started us itself, there is nobody to check.
+            await proxy.session(config, ds, upstream, preauth=True)
+        finally:
+            await ds.close()
+    finally:
+        up = await proxy.settle_upstream(upstream)
+        if up:
+            await up.close()
+
+
 def main(cmdargs: argparse.Namespace) -> int:
     config = oauth2imap.config.read()
 
+    if not isinstance(config, oauth2imap.Error):
+        config = oauth2imap.config.select(config, cmdargs.account)
+
     if isinstance(config, oauth2imap.Error):
         logger.critical("%s", config.message)
         return oauth2imap.EX_FAILURE
@@ -27,13 +60,15 @@ def main(cmdargs: argparse.Namespace) -> int:
     if not provider:
         return oauth2imap.EX_FAILURE
 
+    trace.setup(config)
+    record.setup(config)
+    bodycache.setup(config)
+    metacache.setup(config)
+
     logger.info("new connection")
 
     try:
-        up = imap.Upstream(provider["imap-endpoint"], 993)
-        ds = imap.Downstream("pipe", sys.stdin.buffer, sys.stdout.buffer)
-
-        imap.session(config, ds, up)
+        asyncio.run(tunnel(config, provider))
 
     except KeyboardInterrupt:
         pass